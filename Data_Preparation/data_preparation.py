@@ -13,6 +13,9 @@ import numpy as np
 import _pickle as pickle
 from Data_Preparation import Prepare_QTDatabase, Prepare_NSTDB
 
+TEST_INDEX_FILE = 'data/test_index.pkl'
+
+
 def Data_Preparation():
 
     print('Getting the Data ready ... ')
@@ -58,6 +61,10 @@ def Data_Preparation():
     beats_train = []
     beats_test = []
 
+    # Record and beat number of each test beat
+    test_records = []
+    test_beat_numbers = []
+
     # QTDatabese signals Dataset splitting. Considering the following link
     # https://www.physionet.org/physiobank/database/qtdb/doc/node3.html
     #  Distribution of the 105 records according to the original Database.
@@ -70,27 +77,30 @@ def Data_Preparation():
     # https://www.physionet.org/physiobank/database/qtdb/doc/node4.html
     # Selected test signal amount (14) represent ~13 % of the total
 
-    test_set = ['sel123',  # Record from MIT-BIH Arrhythmia Database
-                'sel233',  # Record from MIT-BIH Arrhythmia Database
+    # Test records and their pathology group (saved in the test index)
+    test_groups = {'sel123': 'Arrhythmia',  # Record from MIT-BIH Arrhythmia Database
+                   'sel233': 'Arrhythmia',  # Record from MIT-BIH Arrhythmia Database
 
-                'sel302',  # Record from MIT-BIH ST Change Database
-                'sel307',  # Record from MIT-BIH ST Change Database
+                   'sel302': 'ST Change',  # Record from MIT-BIH ST Change Database
+                   'sel307': 'ST Change',  # Record from MIT-BIH ST Change Database
 
-                'sel820',  # Record from MIT-BIH Supraventricular Arrhythmia Database
-                'sel853',  # Record from MIT-BIH Supraventricular Arrhythmia Database
+                   'sel820': 'Supraventricular',  # Record from MIT-BIH Supraventricular Arrhythmia Database
+                   'sel853': 'Supraventricular',  # Record from MIT-BIH Supraventricular Arrhythmia Database
 
-                'sel16420',  # Record from MIT-BIH Normal Sinus Rhythm Database
-                'sel16795',  # Record from MIT-BIH Normal Sinus Rhythm Database
+                   'sel16420': 'Normal Sinus Rhythm',  # Record from MIT-BIH Normal Sinus Rhythm Database
+                   'sel16795': 'Normal Sinus Rhythm',  # Record from MIT-BIH Normal Sinus Rhythm Database
 
-                'sele0106',  # Record from European ST-T Database
-                'sele0121',  # Record from European ST-T Database
+                   'sele0106': 'European ST-T',  # Record from European ST-T Database
+                   'sele0121': 'European ST-T',  # Record from European ST-T Database
 
-                'sel32',  # Record from ``sudden death'' patients from BIH
-                'sel49',  # Record from ``sudden death'' patients from BIH
+                   'sel32': 'Sudden Death',  # Record from ``sudden death'' patients from BIH
+                   'sel49': 'Sudden Death',  # Record from ``sudden death'' patients from BIH
 
-                'sel14046',  # Record from MIT-BIH Long-Term ECG Database
-                'sel15814',  # Record from MIT-BIH Long-Term ECG Database
-                ]
+                   'sel14046': 'Long-Term',  # Record from MIT-BIH Long-Term ECG Database
+                   'sel15814': 'Long-Term',  # Record from MIT-BIH Long-Term ECG Database
+                   }
+
+    test_set = list(test_groups.keys())
 
 
     # Creating the train and test dataset, each datapoint has 512 samples and is zero padded
@@ -103,7 +113,7 @@ def Data_Preparation():
     for i in range(len(qtdb_keys)):
         signal_name = qtdb_keys[i]
 
-        for b in qtdb[signal_name]:
+        for beat_number, b in enumerate(qtdb[signal_name]):
 
             b_np = np.zeros(samples)
             b_sq = np.array(b)
@@ -125,6 +135,8 @@ def Data_Preparation():
 
             if signal_name in test_set:
                 beats_test.append(b_np)
+                test_records.append(signal_name)
+                test_beat_numbers.append(beat_number)
             else:
                 beats_train.append(b_np)
 
@@ -156,6 +168,8 @@ def Data_Preparation():
             noise_index = 0
 
     # Adding noise to test
+    # The SNR (dB) of each noisy test beat, power of the beat over power of the added noise
+    snr_test = []
     noise_index = 0
     rnd_test = np.random.randint(low=20, high=200, size=len(beats_test)) / 100
     for i in range(len(beats_test)):
@@ -166,6 +180,7 @@ def Data_Preparation():
         alpha = rnd_test[i] / Ase
         signal_noise = beats_test[i] + alpha * noise
         sn_test.append(signal_noise)
+        snr_test.append(10 * np.log10(np.sum(np.square(beats_test[i])) / np.sum(np.square(alpha * noise))))
         noise_index += samples
 
         if noise_index > (len(noise_test) - samples):
@@ -187,6 +202,18 @@ def Data_Preparation():
 
     Dataset = [X_train, y_train, X_test, y_test]
 
+    # Test index, the record, pathology group, noise amplitude (noise over beat peak to peak) and
+    # SNR of each test beat (same order as X_test), to evaluate the metrics by groups of beats (see
+    # utils/evaluation.py)
+    test_index = {'record': np.array(test_records),
+                  'group': np.array([test_groups[record] for record in test_records]),
+                  'beat': np.array(test_beat_numbers),
+                  'noise_amplitude': rnd_test,
+                  'snr': np.array(snr_test)}
+
+    with open(TEST_INDEX_FILE, 'wb') as output:  # Overwrites any existing file.
+        pickle.dump(test_index, output)
+
     print('Dataset ready to use.')
 
     return Dataset
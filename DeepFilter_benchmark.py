@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Latency and throughput benchmark of all the methods
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import _pickle as pickle
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import visualization as vs
+from utils.benchmark import FilterPredict, benchmark_method, save_benchmark
+from deepFilter.dl_scheduler import job_dir
+
+
+def dl_predict(experiment, results_dir, threads, backend='keras'):
+    # Predict function of a trained experiment, the whole batch at once
+    # The TensorFlow session (or the ONNX Runtime session) is created with threads intra op threads
+    if backend == 'onnx':
+        from deepFilter.dl_onnx import OnnxModel
+        from deepFilter.dl_pipeline import get_model_label
+
+        model = OnnxModel(os.path.join(job_dir(results_dir, experiment), get_model_label(experiment) + '.onnx'),
+                          intra_op_threads=threads)
+        return lambda x: model.predict(x, batch_size=len(x))
+
+    from keras import backend as K
+    from deepFilter.dl_pipeline import configure_session, get_model, load_weights
+
+    K.clear_session()
+    configure_session(intra_op_threads=threads, inter_op_threads=1)
+    model, _ = get_model(experiment)
+    load_weights(model, experiment, job_dir(results_dir, experiment))
+
+    return model.predict_on_batch
+
+
+def benchmark_threads(threads, methods, dl_experiments, results_dir, backend, x, batch_sizes, warmup, repeats,
+                      max_seconds):
+    # Benchmarks all the methods with a thread count, in its own process: the intra op pool of
+    # TensorFlow 1.x is shared by the whole process and sized by its first session, so the thread
+    # counts can not be swept in the same process
+    results = []
+
+    for method in methods:
+        predict = FilterPredict(method, threads)
+        results += benchmark_method(method, predict, x, batch_sizes, threads, warmup, repeats, max_seconds)
+        predict.close()
+
+    for experiment in dl_experiments:
+        predict = dl_predict(experiment, results_dir, threads, backend)
+        results += benchmark_method(experiment, predict, x, batch_sizes, threads, warmup, repeats, max_seconds)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    dl_experiments = ['DRNN',
+                      'FCN-DAE',
+                      'Vanilla L',
+                      'Vanilla NL',
+                      'Multibranch LANL',
+                      'Multibranch LANLD'
+                      ]
+
+    # The models trained by DeepFilter_main.py
+    results_dir = 'results'
+
+    # Inference backend of the deep learning models, 'keras' or 'onnx'
+    backend = 'keras'
+
+    # Sweeps
+    batch_sizes = [1, 8, 32, 128, 512]
+    thread_counts = [1, 2, 4]
+
+    # Calls per batch size, the warm up ones are not timed. The measurement of a batch size stops
+    # after max_seconds
+    warmup = 5
+    repeats = 50
+    max_seconds = 60
+
+    # Test beats used as input
+    n_beats = 1024
+    with open('data/dataset.pkl', 'rb') as input:
+        [X_train, y_train, X_test, y_test] = pickle.load(input)
+    x = X_test[:n_beats]
+
+    results = []
+
+    # A freshly spawned process per thread count (TensorFlow is only imported there)
+    for threads in thread_counts:
+        # Inherited by the process, the OpenMP/MKL pools are sized when it imports numpy
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+        os.environ['MKL_NUM_THREADS'] = str(threads)
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+            results += executor.submit(benchmark_threads, threads, ['FIR', 'IIR'], dl_experiments, results_dir,
+                                       backend, x, batch_sizes, warmup, repeats, max_seconds).result()
+
+    settings = {'backend': backend, 'batch_sizes': batch_sizes, 'thread_counts': thread_counts,
+                'warmup': warmup, 'repeats': repeats, 'max_seconds': max_seconds, 'n_beats': len(x)}
+
+    benchmark_filepath = os.path.join(results_dir, 'benchmark.json')
+    save_benchmark(benchmark_filepath, results, settings)
+    print('Benchmark saved to ' + benchmark_filepath)
+
+    vs.generate_table_benchmark(results)
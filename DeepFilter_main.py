@@ -11,16 +11,20 @@
 #
 #===========================================================
 
+import os
+import sys
 import _pickle as pickle
 from datetime import datetime
 import numpy as np
 
-from utils.metrics import MAD, SSD, PRD, COS_SIM
 from utils import visualization as vs
+from utils.evaluation import StratifiedMetrics, compare_methods, load_test_index
+from utils.benchmark import load_benchmark
+from utils.report import run_summary, save_run, load_run, load_baseline, set_baseline, compare_runs, write_report
 from Data_Preparation import data_preparation as dp
 
 from digitalFilters.dfilters import FIR_test_Dataset, IIR_test_Dataset
-from deepFilter.dl_pipeline import train_dl, test_dl
+from deepFilter.dl_scheduler import run_experiments, save_results, load_results, load_timing, results_store
 
 
 if __name__ == "__main__":
@@ -48,26 +52,21 @@ if __name__ == "__main__":
         Dataset = pickle.load(input)
 
 
-    train_time_list = []
-    test_time_list = []
+    # Deep Learning experiments, several of them run in parallel processes.
+    # Each experiment saves its results inside its own folder on results_dir, finished
+    # experiments are skipped if the script is executed again.
+    results_dir = 'results'
 
-    for experiment in range(len(dl_experiments)):
-        start_train = datetime.now()
-        train_dl(Dataset, dl_experiments[experiment])
-        end_train = datetime.now()
-        train_time_list.append(end_train - start_train)
+    # Inference backend of the tests, 'keras' or 'onnx' (ONNX Runtime, see deepFilter/dl_onnx.py)
+    backend = 'keras'
 
-        start_test = datetime.now()
-        [X_test, y_test, y_pred] = test_dl(Dataset, dl_experiments[experiment])
-        end_test = datetime.now()
-        test_time_list.append(end_test - start_test)
+    run_experiments(dl_experiments,
+                    dataset_path='data/dataset.pkl',
+                    results_dir=results_dir,
+                    n_jobs=3,
+                    backend=backend)
 
-        test_results = [X_test, y_test, y_pred]
-
-        # Save Results
-        with open('test_results_' + dl_experiments[experiment] +'.pkl', 'wb') as output:  # Overwrites any existing file.
-            pickle.dump(test_results, output)
-        print('Results from experiment ' + dl_experiments[experiment] + ' saved')
+    [train_time_list, test_time_list] = load_timing(results_dir, dl_experiments)
 
     # Classical Filters
 
@@ -81,8 +80,7 @@ if __name__ == "__main__":
     test_results_FIR = [X_test_f, y_test_f, y_filter]
 
     # Save FIR filter results
-    with open('test_results_FIR.pkl', 'wb') as output:  # Overwrites any existing file.
-        pickle.dump(test_results_FIR, output)
+    save_results(results_dir, 'FIR', test_results_FIR)
     print('Results from experiment FIR filter saved')
 
     # IIR
@@ -95,13 +93,12 @@ if __name__ == "__main__":
     test_results_IIR = [X_test_f, y_test_f, y_filter]
 
     # Save IIR filter results
-    with open('test_results_IIR.pkl', 'wb') as output:  # Overwrites any existing file.
-        pickle.dump(test_results_IIR, output)
+    save_results(results_dir, 'IIR', test_results_IIR)
     print('Results from experiment IIR filter saved')
 
     # Saving timing list
     timing = [train_time_list, test_time_list]
-    with open('timing.pkl', 'wb') as output:  # Overwrites any existing file.
+    with open(os.path.join(results_dir, 'timing.pkl'), 'wb') as output:  # Overwrites any existing file.
         pickle.dump(timing, output)
     print('Timing saved')
 
@@ -109,213 +106,78 @@ if __name__ == "__main__":
     ####### LOAD EXPERIMENTS #######
 
     # Load timing
-    with open('timing.pkl', 'rb') as input:
+    with open(os.path.join(results_dir, 'timing.pkl'), 'rb') as input:
         timing = pickle.load(input)
         [train_time_list, test_time_list] = timing
 
-    # Load Results DRNN
-    with open('test_results_' + dl_experiments[0] + '.pkl', 'rb') as input:
-       test_DRNN = pickle.load(input)
-
-    # Load Results FCN_DAE
-    with open('test_results_' + dl_experiments[1] +'.pkl', 'rb') as input:
-        test_FCN_DAE = pickle.load(input)
-
-    # Load Results Vanilla L
-    with open('test_results_' + dl_experiments[2] +'.pkl', 'rb') as input:
-        test_Vanilla_L = pickle.load(input)
-
-    # Load Results Exp Vanilla NL
-    with open('test_results_' + dl_experiments[3] +'.pkl', 'rb') as input:
-        test_Vanilla_NL = pickle.load(input)
-
-    # Load Results Multibranch LANL
-    with open('test_results_' + dl_experiments[4] +'.pkl', 'rb') as input:
-        test_Multibranch_LANL = pickle.load(input)
-
+    # The results are memory mapped from the store, only the ones plotted below are loaded
     # Load Results Multibranch LANLD
-    with open('test_results_' + dl_experiments[5] +'.pkl', 'rb') as input:
-        test_Multibranch_LANLD = pickle.load(input)
-
-    # Load Result FIR Filter
-    with open('test_results_FIR.pkl', 'rb') as input:
-        test_FIR = pickle.load(input)
+    test_Multibranch_LANLD = load_results(results_dir, dl_experiments[5])
 
     # Load Result IIR Filter
-    with open('test_results_IIR.pkl', 'rb') as input:
-        test_IIR = pickle.load(input)
+    test_IIR = load_results(results_dir, 'IIR')
 
 
     ####### Calculate Metrics #######
 
     print('Calculating metrics ...')
 
-    # DL Metrics
-
-    # Exp FCN-DAE
-
-    [X_test, y_test, y_pred] = test_DRNN
-
-    SSD_values_DL_DRNN = SSD(y_test, y_pred)
-
-    MAD_values_DL_DRNN = MAD(y_test, y_pred)
-
-    PRD_values_DL_DRNN = PRD(y_test, y_pred)
-
-    COS_SIM_values_DL_DRNN = COS_SIM(y_test, y_pred)
-
-
-    # Exp FCN-DAE
-
-    [X_test, y_test, y_pred] = test_FCN_DAE
-
-    SSD_values_DL_FCN_DAE = SSD(y_test, y_pred)
-
-    MAD_values_DL_FCN_DAE = MAD(y_test, y_pred)
-
-    PRD_values_DL_FCN_DAE = PRD(y_test, y_pred)
-
-    COS_SIM_values_DL_FCN_DAE = COS_SIM(y_test, y_pred)
-
-
-    # Vanilla L
-
-    [X_test, y_test, y_pred] = test_Vanilla_L
-
-    SSD_values_DL_exp_1 = SSD(y_test, y_pred)
-
-    MAD_values_DL_exp_1 = MAD(y_test, y_pred)
-
-    PRD_values_DL_exp_1 = PRD(y_test, y_pred)
-
-    COS_SIM_values_DL_exp_1 = COS_SIM(y_test, y_pred)
-
-
-    # Vanilla_NL
-
-    [X_test, y_test, y_pred] = test_Vanilla_NL
-
-    SSD_values_DL_exp_2 = SSD(y_test, y_pred)
-
-    MAD_values_DL_exp_2 = MAD(y_test, y_pred)
-
-    PRD_values_DL_exp_2 = PRD(y_test, y_pred)
-
-    COS_SIM_values_DL_exp_2 = COS_SIM(y_test, y_pred)
-
-
-    # Multibranch_LANL
-
-    [X_test, y_test, y_pred] = test_Multibranch_LANL
-
-    SSD_values_DL_exp_3 = SSD(y_test, y_pred)
-
-    MAD_values_DL_exp_3 = MAD(y_test, y_pred)
-
-    PRD_values_DL_exp_3 = PRD(y_test, y_pred)
-
-    COS_SIM_values_DL_exp_3 = COS_SIM(y_test, y_pred)
-
-
-    # Multibranch_LANLD
-
-    [X_test, y_test, y_pred] = test_Multibranch_LANLD
-
-    SSD_values_DL_exp_4 = SSD(y_test, y_pred)
-
-    MAD_values_DL_exp_4 = MAD(y_test, y_pred)
-
-    PRD_values_DL_exp_4 = PRD(y_test, y_pred)
-
-    COS_SIM_values_DL_exp_4 = COS_SIM(y_test, y_pred)
-
-
-    # Digital Filtering
-
-    # FIR Filtering Metrics
-    [X_test, y_test, y_filter] = test_FIR
-
-    SSD_values_FIR = SSD(y_test, y_filter)
-
-    MAD_values_FIR = MAD(y_test, y_filter)
-
-    PRD_values_FIR = PRD(y_test, y_filter)
-
-    COS_SIM_values_FIR = COS_SIM(y_test, y_filter)
-
-
-    # IIR Filtering Metrics (Best)
-    [X_test, y_test, y_filter] = test_IIR
-
-    SSD_values_IIR = SSD(y_test, y_filter)
-
-    MAD_values_IIR = MAD(y_test, y_filter)
-
-    PRD_values_IIR = PRD(y_test, y_filter)
+    Exp_names = ['FIR Filter', 'IIR Filter'] + dl_experiments
 
-    COS_SIM_values_IIR = COS_SIM(y_test, y_filter)
+    # The per beat metrics are computed when the results are saved, the store only maps them
+    store = results_store(results_dir)
+    metrics_table = store.metrics_table(['FIR', 'IIR'] + dl_experiments, labels=Exp_names)
 
 
     ####### Results Visualization #######
 
-    SSD_all = [SSD_values_FIR,
-               SSD_values_IIR,
-               SSD_values_DL_FCN_DAE,
-               SSD_values_DL_DRNN,
-               SSD_values_DL_exp_1,
-               SSD_values_DL_exp_2,
-               SSD_values_DL_exp_3,
-               SSD_values_DL_exp_4,
-               ]
-
-    MAD_all = [MAD_values_FIR,
-               MAD_values_IIR,
-               MAD_values_DL_FCN_DAE,
-               MAD_values_DL_DRNN,
-               MAD_values_DL_exp_1,
-               MAD_values_DL_exp_2,
-               MAD_values_DL_exp_3,
-               MAD_values_DL_exp_4,
-               ]
-
-    PRD_all = [PRD_values_FIR,
-               PRD_values_IIR,
-               PRD_values_DL_FCN_DAE,
-               PRD_values_DL_DRNN,
-               PRD_values_DL_exp_1,
-               PRD_values_DL_exp_2,
-               PRD_values_DL_exp_3,
-               PRD_values_DL_exp_4,
-               ]
-
-    CORR_all = [COS_SIM_values_FIR,
-                COS_SIM_values_IIR,
-                COS_SIM_values_DL_FCN_DAE,
-                COS_SIM_values_DL_DRNN,
-                COS_SIM_values_DL_exp_1,
-                COS_SIM_values_DL_exp_2,
-                COS_SIM_values_DL_exp_3,
-                COS_SIM_values_DL_exp_4,
-                ]
-
-
-    Exp_names = ['FIR Filter', 'IIR Filter'] + dl_experiments
-    
     metrics = ['SSD', 'MAD', 'PRD', 'COS_SIM']
-    metric_values = [SSD_all, MAD_all, PRD_all, CORR_all]
+    metric_values = metrics_table.metric_values()   # metric_values[metric][method][beat]
+
+    [SSD_all, MAD_all, PRD_all, CORR_all] = metric_values
 
     # Metrics table
     vs.generate_table(metrics, metric_values, Exp_names)
 
+    # Paired bootstrap confidence intervals and Wilcoxon tests against the proposed model
+    for metric in ['SSD', 'PRD']:
+        comparisons = compare_methods(metrics_table, Exp_names[-1], metric)
+        vs.generate_table_comparison(comparisons, Exp_names[-1], metric)
+
+    # Metrics by pathology group and input SNR, from the test index saved by Data_Preparation
+    test_index = load_test_index(dp.TEST_INDEX_FILE)
+    for by in ['group', 'snr']:
+        stratified = StratifiedMetrics(metrics_table, test_index, by=by)
+        vs.generate_table_strata(stratified, 'SSD')
+
+    # Records where the proposed model degrades the most with respect to the IIR filter
+    stratified = StratifiedMetrics(metrics_table, test_index, by='record')
+    records, degradation = stratified.degradation(Exp_names[-1], 'IIR Filter', 'SSD')
+    print('\nSSD of ' + Exp_names[-1] + ' relative to the IIR Filter by record (worst first):')
+    for record, value in zip(records, degradation):
+        print('  ' + record + ': ' + '{:+.1f} %'.format(100 * value))
+
     # Timing table
     timing_var = ['training', 'test']
     vs.generate_table_time(timing_var, timing, Exp_names, gpu=True)
 
+    # Figures, shown one by one or rendered headless to figures_dir in parallel processes (the
+    # figures whose data did not change are not drawn again)
+    render_headless = True
+    figures_dir = os.path.join(results_dir, 'figures')
+
+    figures = []
+
     # Metrics graphs
-    vs.generate_hboxplot(SSD_all, Exp_names, 'SSD (au)', log=False, set_x_axis_size=(0, 100.1))
-    vs.generate_hboxplot(MAD_all, Exp_names, 'MAD (au)', log=False, set_x_axis_size=(0, 3.01))
-    vs.generate_hboxplot(PRD_all, Exp_names, 'PRD (au)', log=False, set_x_axis_size=(0, 100.1))
-    vs.generate_hboxplot(CORR_all, Exp_names, 'Cosine Similarity (0-1)', log=False, set_x_axis_size=(0, 1))
+    figures.append((vs.generate_hboxplot, {'np_data': SSD_all, 'description': Exp_names, 'ylabel': 'SSD (au)',
+                                           'log': False, 'set_x_axis_size': (0, 100.1)}))
+    figures.append((vs.generate_hboxplot, {'np_data': MAD_all, 'description': Exp_names, 'ylabel': 'MAD (au)',
+                                           'log': False, 'set_x_axis_size': (0, 3.01)}))
+    figures.append((vs.generate_hboxplot, {'np_data': PRD_all, 'description': Exp_names, 'ylabel': 'PRD (au)',
+                                           'log': False, 'set_x_axis_size': (0, 100.1)}))
+    figures.append((vs.generate_hboxplot, {'np_data': CORR_all, 'description': Exp_names,
+                                           'ylabel': 'Cosine Similarity (0-1)', 'log': False,
+                                           'set_x_axis_size': (0, 1)}))
 
 
     # Visualize signals
@@ -331,30 +193,61 @@ if __name__ == "__main__":
 
     [X_test, y_test, y_pred] = test_Multibranch_LANLD
     for id in signals_index:
-        ecgbl_signals2plot.append(X_test[id])
-        ecg_signals2plot.append(y_test[id])
-        dl_signals2plot.append(y_pred[id])
+        ecgbl_signals2plot.append(np.array(X_test[id]))
+        ecg_signals2plot.append(np.array(y_test[id]))
+        dl_signals2plot.append(np.array(y_pred[id]))
 
     [X_test, y_test, y_filter] = test_IIR
     for id in signals_index:
-        fil_signals2plot.append(y_filter[id])
+        fil_signals2plot.append(np.array(y_filter[id]))
 
     for i in range(len(signals_index)):
-        vs.ecg_view(ecg=ecg_signals2plot[i],
-                    ecg_blw=ecgbl_signals2plot[i],
-                    ecg_dl=dl_signals2plot[i],
-                    ecg_f=fil_signals2plot[i],
-                    signal_name=None,
-                    beat_no=None)
-
-        vs.ecg_view_diff(ecg=ecg_signals2plot[i],
-                         ecg_blw=ecgbl_signals2plot[i],
-                         ecg_dl=dl_signals2plot[i],
-                         ecg_f=fil_signals2plot[i],
-                         signal_name=None,
-                         beat_no=None)
-
-
-
-
-
+        signals = {'ecg': ecg_signals2plot[i],
+                   'ecg_blw': ecgbl_signals2plot[i],
+                   'ecg_dl': dl_signals2plot[i],
+                   'ecg_f': fil_signals2plot[i],
+                   'signal_name': None,
+                   'beat_no': None}
+
+        figures.append((vs.ecg_view, dict(signals, filename='ecg_view_' + str(signals_index[i]))))
+        figures.append((vs.ecg_view_diff, dict(signals, filename='ecg_view_diff_' + str(signals_index[i]))))
+
+    if render_headless:
+        vs.render_figures(figures, figures_dir)
+        print('Figures saved to ' + figures_dir)
+    else:
+        for function, kwargs in figures:
+            function(**kwargs)
+
+
+    ####### Regression report #######
+
+    # The summary of every run is kept in results/runs and compared with the baseline run, with the
+    # last benchmark of DeepFilter_benchmark.py if there is one (its timings are only compared if it
+    # was run after the baseline run, on the same machine). The training is not seeded, so the
+    # metrics drift a bit between runs: the report is only informative unless fail_on_regression,
+    # then a run with regressions beyond the tolerances exits with an error.
+    fail_on_regression = False
+
+    benchmark_filepath = os.path.join(results_dir, 'benchmark.json')
+    benchmark = load_benchmark(benchmark_filepath) if os.path.exists(benchmark_filepath) else None
+
+    run_filepath = save_run(results_dir, run_summary(metrics_table, benchmark))
+    current_run = load_run(run_filepath)
+    baseline_run = load_baseline(results_dir)
+
+    if baseline_run is None:
+        set_baseline(results_dir, run_filepath)
+        print('There was no baseline, this run is the baseline now')
+    else:
+        findings = compare_runs(current_run, baseline_run,
+                                metric_tolerance=0.02,
+                                latency_tolerance=0.10,
+                                throughput_tolerance=0.10)
+
+        report_filepath = os.path.join(results_dir, 'report.md')
+        passed = write_report(report_filepath, findings, current_run, baseline_run)
+        print('Report saved to ' + report_filepath + (', no regressions' if passed else ', REGRESSIONS found'))
+
+        if not passed and fail_on_regression:
+            sys.exit(1)
@@ -0,0 +1,243 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Keras callbacks
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+import time
+import random
+import _pickle as pickle
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+from keras import backend as K
+from keras.callbacks import Callback, ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
+
+try:
+    import resource  # Peak RSS, only available on Unix
+except ImportError:
+    resource = None
+
+
+# Counters that each Keras callback keeps between epochs
+_CALLBACK_STATE = {ModelCheckpoint: ['best', 'epochs_since_last_save'],
+                   ReduceLROnPlateau: ['best', 'wait', 'cooldown_counter'],
+                   EarlyStopping: ['best', 'wait', 'stopped_epoch']}
+
+
+def load_training_state(filepath):
+    # Returns the state saved by TrainingStateCheckpoint or None when there is nothing to resume
+    if not os.path.exists(filepath):
+        return None
+
+    with open(filepath, 'rb') as input:
+        return pickle.load(input)
+
+
+class TrainingStateCheckpoint(Callback):
+    """
+        Saves everything needed to continue an interrupted training: model weights, optimizer
+        state (the learning rate included), epoch, the counters of the other callbacks and the
+        numpy/python random states (Keras shuffles the training set with numpy).
+
+        filepath: file where the state is pickled
+        callbacks: list of callbacks whose counters are saved, ModelCheckpoint, ReduceLROnPlateau
+                   and EarlyStopping are supported
+        period: interval (in epochs) between saves
+        state: a state returned by load_training_state to restore at the beginning of the training
+
+        The callback has to be placed after the callbacks in the list given to fit, their
+        on_train_begin resets the counters this callback restores.
+    """
+
+    def __init__(self, filepath, callbacks, period=1, state=None):
+        super(TrainingStateCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.tracked_callbacks = callbacks
+        self.period = period
+        self.state = state
+        self.last_epoch = 0 if state is None else state['epoch']
+
+    def on_train_begin(self, logs=None):
+        if self.state is None:
+            return
+
+        # The optimizer slots are created with the train function
+        self.model._make_train_function()
+        self.model.set_weights(self.state['weights'])
+        self.model.optimizer.set_weights(self.state['optimizer_weights'])
+        # The optimizer weights do not include the learning rate (ReduceLROnPlateau changes it)
+        K.set_value(self.model.optimizer.lr, self.state['lr'])
+
+        for callback, callback_state in zip(self.tracked_callbacks, self.state['callbacks']):
+            for attribute, value in callback_state.items():
+                setattr(callback, attribute, value)
+
+        np.random.set_state(self.state['numpy_rng'])
+        random.setstate(self.state['python_rng'])
+
+        print('Training resumed from epoch ' + str(self.state['epoch']) + ' with lr ' +
+              str(K.get_value(self.model.optimizer.lr)))
+
+        # Release the memory, the state is not needed anymore
+        self.state = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.last_epoch = epoch + 1
+        if self.last_epoch % self.period == 0:
+            self.save(stopped=False)
+
+    def on_train_end(self, logs=None):
+        # Keep the last epoch even when it does not fall in the period and flag the run as stopped
+        # when it ended because of the early stopping, a resumed run must not train again
+        stopped = any(isinstance(callback, EarlyStopping) and callback.stopped_epoch > 0
+                      for callback in self.tracked_callbacks)
+        self.save(stopped=stopped or self.model.stop_training)
+
+    def save(self, stopped):
+        callbacks_state = []
+        for callback in self.tracked_callbacks:
+            attributes = _CALLBACK_STATE.get(type(callback), [])
+            callbacks_state.append({attribute: getattr(callback, attribute) for attribute in attributes})
+
+        state = {'epoch': self.last_epoch,
+                 'stopped': stopped,
+                 'weights': self.model.get_weights(),
+                 'optimizer_weights': self.model.optimizer.get_weights(),
+                 'lr': float(K.get_value(self.model.optimizer.lr)),
+                 'callbacks': callbacks_state,
+                 'numpy_rng': np.random.get_state(),
+                 'python_rng': random.getstate()}
+
+        # Write and rename, a preemption while saving keeps the previous state intact
+        with open(self.filepath + '.tmp', 'wb') as output:
+            pickle.dump(state, output)
+        os.replace(self.filepath + '.tmp', self.filepath)
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class TrainingProfiler(Callback):
+    """
+        Measures where the training time goes. For each epoch it records the wall time, the time
+        spent waiting for the data (between the end of a batch and the beginning of the next one,
+        when Keras slices and feeds the batch) versus the compute time of the train step, the
+        examples per second and the peak RSS. The report is written as JSON at the end of every
+        epoch.
+
+        filepath: JSON file for the report
+        trace_steps: (first, last) training steps (batches counted from 0 across the epochs) for
+                     which a TensorFlow trace is captured, None disables the tracing
+        trace_dir: folder for the traces, one chrome trace (chrome://tracing) per step
+
+        When tracing, the model has to be compiled with the session arguments of the profiler:
+            model.compile(..., **profiler.session_kwargs())
+    """
+
+    def __init__(self, filepath, trace_steps=None, trace_dir=None):
+        super(TrainingProfiler, self).__init__()
+        self.filepath = filepath
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir if trace_dir is not None else os.path.splitext(filepath)[0] + '_trace'
+
+        self.run_options = None
+        self.run_metadata = None
+        if trace_steps is not None:
+            self.run_options = tf.RunOptions(trace_level=tf.RunOptions.NO_TRACE)
+            self.run_metadata = tf.RunMetadata()
+
+        self.step = 0
+        self.epochs = []
+
+    def session_kwargs(self):
+        # Keras passes them to the session run of the train function
+        if self.run_options is None:
+            return {}
+
+        return {'options': self.run_options, 'run_metadata': self.run_metadata}
+
+    def _set_trace_level(self, trace_level):
+        self.run_options.trace_level = trace_level
+
+        # Keras copies the run options when the session callable is built, drop the cached
+        # callables so they are built again with the new trace level
+        for function in [self.model.train_function, self.model.test_function]:
+            if function is not None and hasattr(function, '_callable_fn'):
+                function._callable_fn = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.last_batch_end = self.epoch_start
+        self.data_wait = []
+        self.compute = []
+        self.examples = 0
+
+    def on_batch_begin(self, batch, logs=None):
+        if self.trace_steps is not None and self.step == self.trace_steps[0]:
+            self._set_trace_level(tf.RunOptions.FULL_TRACE)
+
+        self.batch_start = time.time()
+        self.data_wait.append(self.batch_start - self.last_batch_end)
+
+    def on_batch_end(self, batch, logs=None):
+        self.last_batch_end = time.time()
+        self.compute.append(self.last_batch_end - self.batch_start)
+        self.examples += (logs or {}).get('size', 0)
+
+        if self.trace_steps is not None and self.trace_steps[0] <= self.step <= self.trace_steps[1]:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            trace = timeline.Timeline(self.run_metadata.step_stats).generate_chrome_trace_format()
+            with open(os.path.join(self.trace_dir, 'step_' + str(self.step) + '.json'), 'w') as output:
+                output.write(trace)
+            self.run_metadata.Clear()
+
+            if self.step == self.trace_steps[1]:
+                self._set_trace_level(tf.RunOptions.NO_TRACE)
+
+        self.step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        wall_time = time.time() - self.epoch_start
+        data_wait = np.array(self.data_wait)
+        compute = np.array(self.compute)
+        step_time = data_wait + compute
+
+        record = {'epoch': epoch,
+                  'wall_time': wall_time,
+                  'steps': len(compute),
+                  'examples': int(self.examples),
+                  'examples_per_second': self.examples / float(np.sum(step_time)) if len(step_time) else 0.0,
+                  'data_wait_time': float(np.sum(data_wait)),
+                  'compute_time': float(np.sum(compute)),
+                  'data_wait_fraction': float(np.sum(data_wait) / np.sum(step_time)) if len(step_time) else 0.0,
+                  'step_time_p50': float(np.percentile(step_time, 50)) if len(step_time) else 0.0,
+                  'step_time_p95': float(np.percentile(step_time, 95)) if len(step_time) else 0.0,
+                  # Everything out of the train steps: validation, callbacks (checkpoints, logs)
+                  'other_time': wall_time - float(np.sum(step_time)),
+                  'peak_rss_mb': _peak_rss_mb()}
+
+        self.epochs.append(record)
+        self.save()
+
+    def save(self):
+        report = {'epochs': self.epochs,
+                  'trace_steps': list(self.trace_steps) if self.trace_steps is not None else None,
+                  'trace_dir': self.trace_dir if self.trace_steps is not None else None}
+
+        with open(self.filepath + '.tmp', 'w') as output:
+            json.dump(report, output, indent=2)
+        os.replace(self.filepath + '.tmp', self.filepath)
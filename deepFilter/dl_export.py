@@ -0,0 +1,459 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Inference models export
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.layers import Conv1D, BatchNormalization, Concatenate
+
+from deepFilter.dl_models import ChannelFloor
+from deepFilter.dl_pipeline import get_model, load_weights
+
+
+# Experiments whose models have a BatchNormalization after each multibranch module
+FOLDABLE_EXPERIMENTS = ['Multibranch LANL', 'Multibranch LANLD']
+
+# Builder arguments needed to convert the model of an experiment to TFLite or ONNX. The DRNN LSTM
+# is a while loop in the graph, it is built unrolled (same weights) for the converters.
+EXPORT_PARAMS = {'DRNN': {'unroll': True}}
+
+
+def _inbound_layers(layer):
+    return layer._inbound_nodes[0].inbound_layers
+
+
+def _next_layer(model, layer):
+    # The layer that takes the output of the given one (the models are a chain of modules)
+    for candidate in model.layers:
+        if candidate._inbound_nodes and layer in _inbound_layers(candidate):
+            return candidate
+    return None
+
+
+def _random_beats(model, n=64):
+    # Random inputs to verify the converted models, 512 samples for the models of any input length
+    length, channels = K.int_shape(model.input)[1:]
+    return np.random.RandomState(1).normal(size=(n, length or 512, channels)).astype(np.float32)
+
+
+def multibranch_modules(model):
+    # [(branch convolutions, layer after the concatenation)] for each multibranch module, in order
+    return [(_inbound_layers(layer), _next_layer(model, layer))
+            for layer in model.layers if isinstance(layer, Concatenate)]
+
+
+def load_trained_model(experiment, model_dir, model_params=None):
+    """
+        Builds the inference graph of an experiment model (learning phase 0, BatchNormalization
+        with its moving statistics) and loads its trained weights, for the converters.
+
+        experiment: experiment of the model
+        model_dir: folder with the weights of the model (output_dir of train_dl)
+        model_params: arguments used to build the model, added to EXPORT_PARAMS
+
+        Returns the model and its label
+    """
+    model_params = dict(EXPORT_PARAMS.get(experiment, {}), **(model_params or {}))
+
+    K.clear_session()
+    K.set_learning_phase(0)
+
+    model, model_label = get_model(experiment, model_params)
+    load_weights(model, experiment, model_dir)
+
+    return model, model_label
+
+
+def verify_equivalence(model, inference_model, x, atol=1e-4):
+    """
+        Checks that two models give the same outputs.
+
+        model, inference_model: models to compare
+        x: input beats (n, 512, 1)
+        atol: maximum absolute difference allowed
+
+        Returns the maximum absolute difference, raises ValueError if it is bigger than atol
+    """
+    y = model.predict(x, batch_size=32)
+    y_inference = inference_model.predict(x, batch_size=32)
+
+    max_diff = float(np.max(np.abs(y - y_inference)))
+    if max_diff > atol:
+        raise ValueError('The models are not equivalent, maximum absolute difference ' + str(max_diff))
+
+    return max_diff
+
+
+def fold_batchnorm(model, experiment, model_params=None, x=None, atol=1e-4):
+    """
+        Folds each BatchNormalization of a Multibranch model into the preceding module.
+
+        At inference time the BatchNormalization is the per channel affine transform a * x + c with
+        a = gamma / sqrt(var + eps) and c = beta - mean * a. For a linear branch it folds into the
+        convolution (kernel * a, bias * a + c). For a ReLU branch, a * relu(z) + c is
+        max(a * z + c, c) for a >= 0 and min(a * z + c, c) for a < 0, so the convolution takes the
+        same values and the ReLU becomes a ChannelFloor with floor c (or ceiling c for the channels
+        with a negative scale). The folded model has no BatchNormalization and one ChannelFloor per
+        module instead of the per branch ReLUs.
+
+        model: trained Multibranch LANL or LANLD model
+        experiment: experiment of the model
+        model_params: arguments used to build the model
+        x: beats used to verify the equivalence of the folded model, random beats if None
+        atol: maximum absolute difference allowed in the verification
+
+        Returns the folded model
+    """
+    if experiment not in FOLDABLE_EXPERIMENTS:
+        raise ValueError('Only the models of ' + str(FOLDABLE_EXPERIMENTS) + ' can be folded')
+
+    model_params = {} if model_params is None else dict(model_params)
+    model_params['folded'] = True
+    folded_model, _ = get_model(experiment, model_params)
+
+    source_modules = multibranch_modules(model)
+    target_modules = multibranch_modules(folded_model)
+
+    for (source_branches, batch_norm), (target_branches, channel_floor) in zip(source_modules, target_modules):
+        if not isinstance(batch_norm, BatchNormalization):
+            raise ValueError('Layer ' + batch_norm.name + ' after a module is not a BatchNormalization')
+
+        gamma, beta, mean, variance = batch_norm.get_weights()
+        scale = gamma / np.sqrt(variance + batch_norm.epsilon)
+        shift = beta - mean * scale
+
+        floor = np.full(shift.shape, -np.inf, dtype=np.float32)
+        ceiling = np.full(shift.shape, np.inf, dtype=np.float32)
+        channel = 0
+
+        for source, target in zip(source_branches, target_branches):
+            kernel, bias = source.get_weights()
+            filters = kernel.shape[-1]
+            branch_scale = scale[channel:channel + filters]
+            branch_shift = shift[channel:channel + filters]
+
+            target.set_weights([kernel * branch_scale, bias * branch_scale + branch_shift])
+
+            if source.get_config()['activation'] == 'relu':
+                negative = branch_scale < 0
+                floor[channel:channel + filters] = np.where(negative, -np.inf, branch_shift)
+                ceiling[channel:channel + filters] = np.where(negative, branch_shift, np.inf)
+
+            channel += filters
+
+        channel_floor.set_weights([floor, ceiling])
+
+    # Output convolution
+    folded_model.layers[-1].set_weights(model.layers[-1].get_weights())
+
+    if x is None:
+        x = _random_beats(model)
+
+    max_diff = verify_equivalence(model, folded_model, x, atol)
+    print('BatchNormalization folded, maximum absolute difference ' + str(max_diff))
+
+    return folded_model
+
+
+def export_folded(experiment, weights_filepath, output_filepath=None, model_params=None, x=None, atol=1e-4):
+    """
+        Builds a trained Multibranch model, folds its BatchNormalization layers and saves the
+        weights of the folded model (load them in the model built with folded=True).
+
+        experiment: experiment of the model
+        weights_filepath: weights of the trained model
+        output_filepath: weights of the folded model, by default next to the trained weights
+        model_params, x, atol: as in fold_batchnorm
+    """
+    if output_filepath is None:
+        output_filepath = weights_filepath.replace('_weights.best.hdf5', '_folded_weights.hdf5')
+        if output_filepath == weights_filepath:
+            output_filepath = os.path.splitext(weights_filepath)[0] + '_folded.hdf5'
+
+    model, _ = get_model(experiment, model_params)
+    model.load_weights(weights_filepath)
+
+    folded_model = fold_batchnorm(model, experiment, model_params, x, atol)
+    folded_model.save_weights(output_filepath)
+    print('Folded model weights saved to ' + output_filepath)
+
+    K.clear_session()
+
+    return output_filepath
+
+
+def merge_kernels(kernels, biases, kernel_sizes, dilation_rate, width):
+    """
+        Zero pads the kernels of parallel 'same' convolutions to a common width and stacks them
+        along the filters axis, so a single convolution of that width gives the concatenation of
+        their outputs.
+
+        kernels: list of kernels (kernel_size, input_dim, filters) of the branches
+        biases: list of biases of the branches
+        kernel_sizes: kernel size of each branch
+        dilation_rate: dilation rate shared by all the branches
+        width: kernel size of the merged convolution
+
+        Returns the merged kernel and bias
+    """
+    filters = sum(kernel.shape[-1] for kernel in kernels)
+    merged_kernel = np.zeros((width, kernels[0].shape[1], filters), dtype=kernels[0].dtype)
+
+    channel = 0
+    for kernel, kernel_size in zip(kernels, kernel_sizes):
+        # 'same' padding puts ((kernel_size - 1) * dilation_rate) // 2 samples before the signal,
+        # the branch taps are placed so that they keep their offset with respect to the output
+        shift = ((width - 1) * dilation_rate) // 2 - ((kernel_size - 1) * dilation_rate) // 2
+        if shift % dilation_rate != 0:
+            raise ValueError('A kernel of size ' + str(kernel_size) + ' can not be centered in a kernel of size ' +
+                             str(width) + ' with dilation ' + str(dilation_rate))
+        offset = shift // dilation_rate
+
+        merged_kernel[offset:offset + kernel_size, :, channel:channel + kernel.shape[-1]] = kernel
+        channel += kernel.shape[-1]
+
+    return merged_kernel, np.concatenate(biases)
+
+
+def merge_branches(model, merged_model, x=None, atol=1e-4):
+    """
+        Copies the weights of a multibranch model into the same model built with merged=True
+        (one convolution per module) and verifies that both give the same outputs.
+
+        The branches of a module are zero padded to the widest kernel (see merge_kernels). In the
+        modules with linear and non linear branches the ReLU is applied by the ChannelFloor after
+        the merged convolution, its floor is 0 for the non linear channels and -inf for the linear
+        ones (or the folded floor and ceiling when the model was folded with fold_batchnorm first).
+
+        model: trained multibranch model (LFilter, NLFilter, LANL or LANLD modules), folded or not
+        merged_model: the same model built with merged=True (and folded=True if model is folded)
+        x: beats used to verify the equivalence, random beats if None
+        atol: maximum absolute difference allowed in the verification
+
+        Returns merged_model
+    """
+    source_modules = multibranch_modules(model)
+    target_convs = [layer for layer in merged_model.layers if isinstance(layer, Conv1D)][:-1]
+
+    if len(source_modules) != len(target_convs):
+        raise ValueError('The model has ' + str(len(source_modules)) + ' multibranch modules but the merged model has ' +
+                         str(len(target_convs)) + ' module convolutions')
+
+    copied_source = []
+    copied_target = []
+
+    for (branches, source_next), target_conv in zip(source_modules, target_convs):
+        kernels = [branch.get_weights()[0] for branch in branches]
+        biases = [branch.get_weights()[1] for branch in branches]
+        kernel_sizes = [branch.kernel_size[0] for branch in branches]
+        dilation_rate = branches[0].dilation_rate[0]
+
+        merged_kernel, merged_bias = merge_kernels(kernels, biases, kernel_sizes, dilation_rate,
+                                                   target_conv.kernel_size[0])
+        target_conv.set_weights([merged_kernel, merged_bias])
+        copied_source += branches
+        copied_target.append(target_conv)
+
+        target_next = _next_layer(merged_model, target_conv)
+        if isinstance(target_next, ChannelFloor):
+            if isinstance(source_next, ChannelFloor):
+                # Folded model, the floor and ceiling already hold the BatchNormalization shift
+                bounds = source_next.get_weights()
+                copied_source.append(source_next)
+            else:
+                floor = np.concatenate([np.full(branch.filters, 0.0 if branch.get_config()['activation'] == 'relu'
+                                                else -np.inf, dtype=np.float32) for branch in branches])
+                bounds = [floor, np.full(floor.shape, np.inf, dtype=np.float32)]
+            target_next.set_weights(bounds)
+            copied_target.append(target_next)
+
+    # The other layers (BatchNormalization, output convolution) are the same in both models
+    source_layers = [layer for layer in model.layers if layer.weights and layer not in copied_source]
+    target_layers = [layer for layer in merged_model.layers if layer.weights and layer not in copied_target]
+    for source, target in zip(source_layers, target_layers):
+        target.set_weights(source.get_weights())
+
+    if x is None:
+        x = _random_beats(model)
+
+    max_diff = verify_equivalence(model, merged_model, x, atol)
+    print('Branches merged, maximum absolute difference ' + str(max_diff))
+
+    return merged_model
+
+
+def export_merged(experiment, weights_filepath, output_filepath=None, model_params=None, fold=True, x=None,
+                  atol=1e-4):
+    """
+        Builds a trained Multibranch model and saves the weights of its inference version with the
+        branches merged (and the BatchNormalization folded when fold is True). Load them in the
+        model built with merged=True, folded=fold.
+
+        experiment: experiment of the model
+        weights_filepath: weights of the trained model
+        output_filepath: weights of the merged model, by default next to the trained weights
+        model_params, x, atol: as in fold_batchnorm
+        fold: fold the BatchNormalization layers before merging the branches
+    """
+    if output_filepath is None:
+        suffix = '_merged_folded_weights.hdf5' if fold else '_merged_weights.hdf5'
+        output_filepath = weights_filepath.replace('_weights.best.hdf5', suffix)
+        if output_filepath == weights_filepath:
+            output_filepath = os.path.splitext(weights_filepath)[0] + suffix
+
+    model_params = {} if model_params is None else dict(model_params)
+    model, _ = get_model(experiment, model_params)
+    model.load_weights(weights_filepath)
+
+    if fold:
+        model = fold_batchnorm(model, experiment, model_params, x, atol)
+
+    merged_params = dict(model_params)
+    merged_params['merged'] = True
+    merged_params['folded'] = fold
+    merged_model, _ = get_model(experiment, merged_params)
+
+    merge_branches(model, merged_model, x, atol)
+    merged_model.save_weights(output_filepath)
+    print('Merged model weights saved to ' + output_filepath)
+
+    K.clear_session()
+
+    return output_filepath
+
+
+def export_onnx(experiment, model_dir, output_filepath=None, model_params=None, opset=10):
+    """
+        Saves a trained experiment model as an ONNX model for the ONNX Runtime backend (see dl_onnx).
+
+        The graph is frozen (variables as constants) and converted with tf2onnx, the batch dimension
+        is kept dynamic.
+
+        experiment: experiment of the model
+        model_dir: folder with the weights of the model (output_dir of train_dl)
+        output_filepath: ONNX file, by default label.onnx inside model_dir
+        model_params: arguments used to build the model
+        opset: ONNX opset of the model
+
+        Returns the path of the ONNX model
+    """
+    # Only needed to export
+    from tf2onnx import optimizer
+    from tf2onnx.tfonnx import process_tf_graph
+
+    model, model_label = load_trained_model(experiment, model_dir, model_params)
+
+    if output_filepath is None:
+        output_filepath = os.path.join(model_dir, model_label + '.onnx')
+
+    input_name = model.input.name
+    output_name = model.output.name
+
+    session = K.get_session()
+    frozen_graph_def = tf.graph_util.convert_variables_to_constants(session,
+                                                                    session.graph.as_graph_def(),
+                                                                    [output_name.split(':')[0]])
+    K.clear_session()
+
+    with tf.Graph().as_default() as tf_graph:
+        tf.import_graph_def(frozen_graph_def, name='')
+
+        onnx_graph = process_tf_graph(tf_graph, opset=opset, input_names=[input_name], output_names=[output_name])
+        onnx_graph = optimizer.optimize_graph(onnx_graph)
+        model_proto = onnx_graph.make_model(model_label)
+
+    with open(output_filepath, 'wb') as output:
+        output.write(model_proto.SerializeToString())
+    print('ONNX model saved to ' + output_filepath)
+
+    return output_filepath
+
+
+def verify_onnx(experiment, model_dir, x, onnx_filepath=None, model_params=None, atol=1e-4):
+    """
+        Checks that the ONNX model of an experiment gives the same outputs as the Keras model.
+
+        experiment, model_dir, model_params: as in export_onnx
+        x: input beats (n, 512, 1)
+        onnx_filepath: ONNX model, by default label.onnx inside model_dir
+        atol: maximum absolute difference allowed
+
+        Returns the maximum absolute difference, raises ValueError if it is bigger than atol
+    """
+    from deepFilter.dl_onnx import OnnxModel
+
+    model, model_label = load_trained_model(experiment, model_dir, model_params)
+    y = model.predict(x, batch_size=32)
+    K.clear_session()
+
+    if onnx_filepath is None:
+        onnx_filepath = os.path.join(model_dir, model_label + '.onnx')
+    y_onnx = OnnxModel(onnx_filepath).predict(x, batch_size=32)
+
+    max_diff = float(np.max(np.abs(y - y_onnx)))
+    if max_diff > atol:
+        raise ValueError('The ONNX model of ' + experiment + ' is not equivalent, maximum absolute difference ' +
+                         str(max_diff))
+
+    return max_diff
+
+
+def _time_predict(predict, x, batch_size, repeats):
+    # Median wall time of predict over the beats, after a warm up run
+    predict(x[:batch_size], batch_size)
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(x, batch_size)
+        times.append(time.perf_counter() - start)
+
+    return float(np.median(times))
+
+
+def compare_backends(experiment, model_dir, x, onnx_filepath=None, model_params=None, batch_size=32, repeats=5,
+                     intra_op_threads=0):
+    """
+        Latency and throughput of the Keras predict against the ONNX Runtime model.
+
+        experiment, model_dir, onnx_filepath, model_params: as in verify_onnx
+        x: input beats (n, 512, 1)
+        batch_size: beats per batch
+        repeats: timed runs over x, the median is reported
+        intra_op_threads: ONNX Runtime threads, 0 lets it decide
+
+        Returns a dict {backend: {'time', 'batch_latency', 'throughput'}}, times in seconds and
+        throughput in beats per second
+    """
+    from deepFilter.dl_onnx import OnnxModel
+
+    model, model_label = load_trained_model(experiment, model_dir, model_params)
+    keras_time = _time_predict(lambda beats, size: model.predict(beats, batch_size=size), x, batch_size, repeats)
+    K.clear_session()
+
+    if onnx_filepath is None:
+        onnx_filepath = os.path.join(model_dir, model_label + '.onnx')
+    onnx_model = OnnxModel(onnx_filepath, intra_op_threads=intra_op_threads)
+    onnx_time = _time_predict(onnx_model.predict, x, batch_size, repeats)
+
+    n_batches = int(np.ceil(len(x) / batch_size))
+    comparison = {}
+    for backend, backend_time in [('keras', keras_time), ('onnx', onnx_time)]:
+        comparison[backend] = {'time': backend_time,
+                               'batch_latency': backend_time / n_batches,
+                               'throughput': len(x) / backend_time}
+        print(experiment + ' ' + backend + ': {:.2f} ms per batch of '.format(1000 * backend_time / n_batches) +
+              str(batch_size) + ', {:.0f} beats/s'.format(len(x) / backend_time))
+
+    return comparison
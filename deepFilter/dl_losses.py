@@ -0,0 +1,72 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Losses and metrics
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+from keras import backend as K
+from keras import losses
+
+# Every loss and metric builds the residual as square(y_pred - y_true) with the same ops, TensorFlow's
+# graph optimizer (common subexpression elimination) merges the copies of the loss and the metrics
+# into one, and XLA fuses the element-wise ops and the reductions.
+
+
+def _squared_residual(y_true, y_pred):
+    return K.square(y_pred - y_true)
+
+
+# Custom loss SSD
+def ssd_loss(y_true, y_pred):
+    return K.sum(_squared_residual(y_true, y_pred), axis=-2)
+
+# Combined loss SSD + MSE
+def combined_ssd_mse_loss(y_true, y_pred):
+    square = _squared_residual(y_true, y_pred)
+    return K.mean(square, axis=-2) * 500 + K.sum(square, axis=-2)
+
+def combined_ssd_mad_loss(y_true, y_pred):
+    square = _squared_residual(y_true, y_pred)
+    return K.max(square, axis=-2) * 50 + K.sum(square, axis=-2)
+
+# Custom loss SAD
+def sad_loss(y_true, y_pred):
+    # abs instead of sqrt(square(x)), same value and a defined gradient on zero
+    return K.sum(K.abs(y_pred - y_true), axis=-2)
+
+# Custom loss MAD
+def mad_loss(y_true, y_pred):
+    return K.max(_squared_residual(y_true, y_pred), axis=-2)
+
+
+# Metrics reported while training and testing
+training_metrics = [losses.mean_squared_error, losses.mean_absolute_error, ssd_loss, mad_loss]
+
+
+# Knowledge distillation, the targets are the clean beats and the teacher outputs concatenated in
+# the channels axis (n, 512, 2), see dl_pipeline.train_distillation
+
+def distillation_loss(alpha=0.5):
+    # (1 - alpha) * loss against the clean beats + alpha * loss against the teacher outputs
+    def distillation_loss(y_true, y_pred):
+        return (1 - alpha) * combined_ssd_mad_loss(y_true[:, :, :1], y_pred) + \
+               alpha * combined_ssd_mad_loss(y_true[:, :, 1:], y_pred)
+
+    return distillation_loss
+
+
+def _on_ground_truth(metric):
+    # The metric against the clean beats channel
+    def wrapped(y_true, y_pred):
+        return metric(y_true[:, :, :1], y_pred)
+
+    wrapped.__name__ = metric.__name__
+    return wrapped
+
+
+distillation_metrics = [_on_ground_truth(metric) for metric in training_metrics]
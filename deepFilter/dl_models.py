@@ -10,37 +10,208 @@
 #===========================================================
 
 
+import h5py
+import numpy as np
 import keras
 from keras.models import Sequential, Model
-from keras.layers import Dense, Conv1D, Flatten, Dropout, BatchNormalization,\
+from keras.layers import Dense, Conv1D, SeparableConv1D, Flatten, Dropout, BatchNormalization,\
                          concatenate, Activation, Input, Conv2DTranspose, Lambda, LSTM, Reshape, Embedding
+from keras.engine.base_layer import Layer, InputSpec
+from keras import activations, initializers
 
 import keras.backend as K
 
-def Conv1DTranspose(input_tensor, filters, kernel_size, strides=2, activation='relu', padding='same'):
+class Conv1DTranspose(Layer):
     """
-        https://stackoverflow.com/a/45788699
+        Transposed 1D convolution layer.
+
+        Keras has no 1D transposed convolution, it used to be built as a Conv2DTranspose between two
+        Lambda layers (https://stackoverflow.com/a/45788699). This layer computes the same inside a
+        single layer without Lambda layers, so the models can be serialized and converted (XLA,
+        TFLite). The kernel has the shape (kernel_size, filters, input_dim), the Conv2DTranspose
+        kernel without its unit dimension, see load_FCN_DAE_weights to load the former weights.
 
-        input_tensor: tensor, with the shape (batch_size, time_steps, dims)
         filters: int, output dimension, i.e. the output tensor will have the shape of (batch_size, time_steps, filters)
         kernel_size: int, size of the convolution kernel
         strides: int, convolution step size
+        activation: activation function
         padding: 'same' | 'valid'
     """
-    x = Lambda(lambda x: K.expand_dims(x, axis=2))(input_tensor)
-    x = Conv2DTranspose(filters=filters,
-                        kernel_size=(kernel_size, 1),
-                        activation=activation,
-                        strides=(strides, 1),
-                        padding=padding)(x)
-    x = Lambda(lambda x: K.squeeze(x, axis=2))(x)
-    return x
+
+    def __init__(self, filters, kernel_size, strides=2, activation='relu', padding='same', use_bias=True,
+                 kernel_initializer='glorot_uniform', bias_initializer='zeros', **kwargs):
+        super(Conv1DTranspose, self).__init__(**kwargs)
+        self.filters = filters
+        self.kernel_size = kernel_size
+        self.strides = strides
+        self.activation = activations.get(activation)
+        self.padding = padding
+        self.use_bias = use_bias
+        self.kernel_initializer = initializers.get(kernel_initializer)
+        self.bias_initializer = initializers.get(bias_initializer)
+        self.input_spec = InputSpec(ndim=3)
+
+    def build(self, input_shape):
+        input_dim = input_shape[-1]
+
+        self.kernel = self.add_weight(shape=(self.kernel_size, self.filters, input_dim),
+                                      initializer=self.kernel_initializer,
+                                      name='kernel')
+        if self.use_bias:
+            self.bias = self.add_weight(shape=(self.filters,),
+                                        initializer=self.bias_initializer,
+                                        name='bias')
+        else:
+            self.bias = None
+
+        self.input_spec = InputSpec(ndim=3, axes={-1: input_dim})
+        self.built = True
+
+    def _output_length(self, length):
+        if self.padding == 'same':
+            return length * self.strides
+        return length * self.strides + max(self.kernel_size - self.strides, 0)
+
+    def call(self, inputs):
+        input_shape = K.shape(inputs)
+        output_shape = (input_shape[0], self._output_length(input_shape[1]), 1, self.filters)
+
+        # The time axis is computed as the height of a 2D transposed convolution of width 1
+        outputs = K.conv2d_transpose(K.expand_dims(inputs, axis=2),
+                                     K.expand_dims(self.kernel, axis=1),
+                                     output_shape,
+                                     strides=(self.strides, 1),
+                                     padding=self.padding)
+        outputs = K.squeeze(outputs, axis=2)
+
+        if self.use_bias:
+            outputs = K.bias_add(outputs, self.bias)
+
+        if self.activation is not None:
+            return self.activation(outputs)
+        return outputs
+
+    def compute_output_shape(self, input_shape):
+        length = input_shape[1]
+        if length is not None:
+            length = self._output_length(length)
+        return (input_shape[0], length, self.filters)
+
+    def get_config(self):
+        config = {'filters': self.filters,
+                  'kernel_size': self.kernel_size,
+                  'strides': self.strides,
+                  'activation': activations.serialize(self.activation),
+                  'padding': self.padding,
+                  'use_bias': self.use_bias,
+                  'kernel_initializer': initializers.serialize(self.kernel_initializer),
+                  'bias_initializer': initializers.serialize(self.bias_initializer)}
+        base_config = super(Conv1DTranspose, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def load_FCN_DAE_weights(model, filepath):
+    """
+        Loads FCN_DAE weights saved with the former Conv1DTranspose (Conv2DTranspose between Lambda
+        layers) or with the current one. The layers with weights are matched in order and the
+        Conv2DTranspose kernels (kernel_size, 1, filters, input_dim) are reshaped to
+        (kernel_size, filters, input_dim).
+
+        model: FCN_DAE model
+        filepath: HDF5 weights file (model.save_weights or model.save)
+    """
+    with h5py.File(filepath, mode='r') as f:
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+
+        file_weights = []
+        for name in f.attrs['layer_names']:
+            name = name.decode('utf8') if hasattr(name, 'decode') else name
+            group = f[name]
+            weight_names = [w.decode('utf8') if hasattr(w, 'decode') else w for w in group.attrs['weight_names']]
+            if weight_names:
+                file_weights.append([np.asarray(group[weight_name]) for weight_name in weight_names])
+
+    layers = [layer for layer in model.layers if layer.weights]
+    if len(layers) != len(file_weights):
+        raise ValueError('The file ' + filepath + ' has weights for ' + str(len(file_weights)) +
+                         ' layers but the model has ' + str(len(layers)) + ' layers with weights')
+
+    for layer, layer_weights in zip(layers, file_weights):
+        layer.set_weights([np.reshape(value, K.int_shape(weight))
+                           for value, weight in zip(layer_weights, layer.weights)])
+
+
+def convert_FCN_DAE_weights(old_filepath, new_filepath):
+    # Rewrites a FCN_DAE weights file saved with the former Conv1DTranspose in the current format
+    model = FCN_DAE()
+    load_FCN_DAE_weights(model, old_filepath)
+    model.save_weights(new_filepath)
+    K.clear_session()
+
+class ChannelFloor(Layer):
+    """
+        Per channel bounds, y = min(max(x, floor), ceiling). A floor of 0 is a ReLU and a floor of
+        -inf leaves the channel as it is, so this single layer applies the activations of the linear
+        and the non linear branches of a module after their concatenation. The floor and the ceiling
+        are non trainable weights, folding a BatchNormalization moves its shift into the floor (or
+        into the ceiling for the channels with a negative scale, see dl_export.fold_batchnorm).
+
+        floor: list with the initial floor of each channel
+        ceiling: list with the initial ceiling of each channel, +inf if None
+    """
+
+    def __init__(self, floor, ceiling=None, **kwargs):
+        super(ChannelFloor, self).__init__(**kwargs)
+        self.floor_init = [float(value) for value in floor]
+        self.ceiling_init = [np.inf] * len(self.floor_init) if ceiling is None else [float(value) for value in ceiling]
+
+    def build(self, input_shape):
+        self.floor = self.add_weight(shape=(input_shape[-1],),
+                                     initializer=lambda shape, dtype=None: K.constant(self.floor_init, shape=shape,
+                                                                                      dtype=dtype),
+                                     trainable=False,
+                                     name='floor')
+        self.ceiling = self.add_weight(shape=(input_shape[-1],),
+                                       initializer=lambda shape, dtype=None: K.constant(self.ceiling_init,
+                                                                                        shape=shape, dtype=dtype),
+                                       trainable=False,
+                                       name='ceiling')
+        self.built = True
+
+    def call(self, inputs):
+        return K.minimum(K.maximum(inputs, self.floor), self.ceiling)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = {'floor': self.floor_init, 'ceiling': self.ceiling_init}
+        base_config = super(ChannelFloor, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def _BatchNormalization(tensor, folded):
+    # Folded models have the BatchNormalization merged into the previous module
+    if folded:
+        return tensor
+    return BatchNormalization()(tensor)
 
 ##########################################################################
 
 ###### MODULES #######
 
-def LFilter_module(x, layers):
+def LFilter_module(x, layers, merged=False):
+    # merged: a single convolution with the kernels of all the branches zero padded (centered) to the
+    # widest one, same outputs with one kernel instead of four plus the concatenation.
+    # The weights of a multibranch module are converted with dl_export.merge_branches
+    if merged:
+        return Conv1D(filters=4 * int(layers / 4),
+                      kernel_size=15,
+                      activation='linear',
+                      strides=1,
+                      padding='same')(x)
+
     LB0 = Conv1D(filters=int(layers / 4),
                  kernel_size=3,
                  activation='linear',
@@ -68,7 +239,14 @@ def LFilter_module(x, layers):
     return x
 
 
-def NLFilter_module(x, layers):
+def NLFilter_module(x, layers, merged=False):
+    # merged: as in LFilter_module
+    if merged:
+        return Conv1D(filters=4 * int(layers / 4),
+                      kernel_size=15,
+                      activation='relu',
+                      strides=1,
+                      padding='same')(x)
 
     NLB0 = Conv1D(filters=int(layers / 4),
                   kernel_size=3,
@@ -97,103 +275,95 @@ def NLFilter_module(x, layers):
     return x
 
 
-def LANLFilter_module(x, layers):
-    LB0 = Conv1D(filters=int(layers / 8),
-                 kernel_size=3,
-                 activation='linear',
-                 strides=1,
-                 padding='same')(x)
-    LB1 = Conv1D(filters=int(layers / 8),
-                kernel_size=5,
-                activation='linear',
-                strides=1,
-                padding='same')(x)
-    LB2 = Conv1D(filters=int(layers / 8),
-                kernel_size=9,
-                activation='linear',
-                strides=1,
-                padding='same')(x)
-    LB3 = Conv1D(filters=int(layers / 8),
-                kernel_size=15,
-                activation='linear',
-                strides=1,
-                padding='same')(x)
+def _branches(x, branch_filters, kernel_sizes, activation, dilation_rate=1):
+    # One convolution per kernel size, the branches with 0 filters are left out
+    return [Conv1D(filters=filters,
+                   kernel_size=kernel_size,
+                   activation=activation,
+                   dilation_rate=dilation_rate,
+                   strides=1,
+                   padding='same')(x) for filters, kernel_size in zip(branch_filters, kernel_sizes) if filters > 0]
 
-    NLB0 = Conv1D(filters=int(layers / 8),
-                  kernel_size=3,
-                  activation='relu',
-                  strides=1,
-                  padding='same')(x)
-    NLB1 = Conv1D(filters=int(layers / 8),
-                 kernel_size=5,
-                 activation='relu',
-                 strides=1,
-                 padding='same')(x)
-    NLB2 = Conv1D(filters=int(layers / 8),
-                 kernel_size=9,
-                 activation='relu',
-                 strides=1,
-                 padding='same')(x)
-    NLB3 = Conv1D(filters=int(layers / 8),
-                 kernel_size=15,
-                 activation='relu',
-                 strides=1,
-                 padding='same')(x)
 
-    x = concatenate([LB0, LB1, LB2, LB3, NLB0, NLB1, NLB2, NLB3])
+def LANLFilter_module(x, layers, split_activation=False, merged=False, branch_filters=None):
+    # split_activation: the non linear branches are computed without activation and the ReLU is
+    # applied after the concatenation by a ChannelFloor layer, needed to fold a BatchNormalization
+    # merged: as in LFilter_module, the linear and non linear branches are split by the ChannelFloor
+    # branch_filters: filters of [LB0, LB1, LB2, LB3, NLB0, NLB1, NLB2, NLB3], int(layers / 8) each by
+    # default. The branches with 0 filters are removed (see dl_pruning), at least two have to be left
+    kernel_sizes = (3, 5, 9, 15)
+
+    if branch_filters is None:
+        branch_filters = [int(layers / 8)] * 8
+
+    linear_filters = sum(branch_filters[:4])
+    nonlinear_filters = sum(branch_filters[4:])
+
+    if merged:
+        x = Conv1D(filters=linear_filters + nonlinear_filters,
+                   kernel_size=max(kernel_sizes),
+                   activation='linear',
+                   strides=1,
+                   padding='same')(x)
+        return ChannelFloor([-np.inf] * linear_filters + [0.0] * nonlinear_filters)(x)
+
+    nl_activation = 'linear' if split_activation else 'relu'
+
+    LB = _branches(x, branch_filters[:4], kernel_sizes, 'linear')
+    NLB = _branches(x, branch_filters[4:], kernel_sizes, nl_activation)
+
+    x = concatenate(LB + NLB)
+
+    if split_activation:
+        x = ChannelFloor([-np.inf] * linear_filters + [0.0] * nonlinear_filters)(x)
 
     return x
 
 
-def LANLFilter_module_dilated(x, layers):
-    LB1 = Conv1D(filters=int(layers / 6),
-                kernel_size=5,
-                activation='linear',
-                dilation_rate=3,
-                padding='same')(x)
-    LB2 = Conv1D(filters=int(layers / 6),
-                kernel_size=9,
-                activation='linear',
-                dilation_rate=3,
-                padding='same')(x)
-    LB3 = Conv1D(filters=int(layers / 6),
-                kernel_size=15,
-                dilation_rate=3,
-                activation='linear',
-                padding='same')(x)
+def LANLFilter_module_dilated(x, layers, kernel_sizes=(5, 9, 15), dilation_rate=3, split_activation=False,
+                              merged=False, branch_filters=None):
+    # One linear and one non linear branch per kernel size
+    # split_activation, merged: as in LANLFilter_module
+    # branch_filters: as in LANLFilter_module, the linear branches and then the non linear ones
+    if branch_filters is None:
+        branch_filters = [int(layers / (2 * len(kernel_sizes)))] * (2 * len(kernel_sizes))
 
-    NLB1 = Conv1D(filters=int(layers / 6),
-                 kernel_size=5,
-                 activation='relu',
-                 dilation_rate=3,
-                 padding='same')(x)
-    NLB2 = Conv1D(filters=int(layers / 6),
-                 kernel_size=9,
-                 activation='relu',
-                 dilation_rate=3,
-                 padding='same')(x)
-    NLB3 = Conv1D(filters=int(layers / 6),
-                 kernel_size=15,
-                 dilation_rate=3,
-                 activation='relu',
-                 padding='same')(x)
+    linear_filters = sum(branch_filters[:len(kernel_sizes)])
+    nonlinear_filters = sum(branch_filters[len(kernel_sizes):])
+
+    if merged:
+        x = Conv1D(filters=linear_filters + nonlinear_filters,
+                   kernel_size=max(kernel_sizes),
+                   activation='linear',
+                   dilation_rate=dilation_rate,
+                   padding='same')(x)
+        return ChannelFloor([-np.inf] * linear_filters + [0.0] * nonlinear_filters)(x)
+
+    nl_activation = 'linear' if split_activation else 'relu'
+
+    LB = _branches(x, branch_filters[:len(kernel_sizes)], kernel_sizes, 'linear', dilation_rate)
+    NLB = _branches(x, branch_filters[len(kernel_sizes):], kernel_sizes, nl_activation, dilation_rate)
 
-    x = concatenate([LB1, LB2, LB3, NLB1, NLB2, NLB3])
+    x = concatenate(LB + NLB)
     # x = BatchNormalization()(x)
 
+    if split_activation:
+        x = ChannelFloor([-np.inf] * linear_filters + [0.0] * nonlinear_filters)(x)
+
     return x
 
 
 ###### MODELS #######
 
-def deep_filter_vanilla_linear():
+def deep_filter_vanilla_linear(input_length=512):
+    # input_length: samples of the input signals, None for any length (see deep_filter_I_LANL)
 
     model = Sequential()
 
     model.add(Conv1D(filters=64,
                      kernel_size=9,
                      activation='linear',
-                     input_shape=(512, 1),
+                     input_shape=(input_length, 1),
                      strides=1,
                      padding='same'))
     model.add(Conv1D(filters=64,
@@ -235,44 +405,50 @@ def deep_filter_vanilla_linear():
     return model
 
 
-def deep_filter_vanilla_Nlinear():
-    model = Sequential()
-
-    model.add(Conv1D(filters=64,
-                     kernel_size=9,
-                     activation='relu',
-                     input_shape=(512, 1),
-                     strides=1,
-                     padding='same'))
-    model.add(Conv1D(filters=64,
-                     kernel_size=9,
-                     activation='relu',
-                     strides=1,
-                     padding='same'))
-
-
-    model.add(Conv1D(filters=32,
-                     kernel_size=9,
-                     activation='relu',
-                     strides=1,
-                     padding='same'))
-    model.add(Conv1D(filters=32,
-                     kernel_size=9,
-                     activation='relu',
-                     strides=1,
-                     padding='same'))
+def deep_filter_vanilla_Nlinear(input_length=512, width=1.0, separable=False):
+    # input_length: as in deep_filter_vanilla_linear
+    # width: multiplier of the filters of the hidden layers, a thinner model for distillation
+    # separable: depthwise separable convolutions in the hidden layers (kernel_size * in + in * out
+    # weights instead of kernel_size * in * out), see dl_pipeline.train_distillation
+    conv = SeparableConv1D if separable else Conv1D
 
+    model = Sequential()
 
-    model.add(Conv1D(filters=16,
-                     kernel_size=9,
-                     activation='relu',
-                     strides=1,
-                     padding='same'))
-    model.add(Conv1D(filters=16,
-                     kernel_size=9,
-                     activation='relu',
-                     strides=1,
-                     padding='same'))
+    model.add(conv(filters=int(64 * width),
+                   kernel_size=9,
+                   activation='relu',
+                   input_shape=(input_length, 1),
+                   strides=1,
+                   padding='same'))
+    model.add(conv(filters=int(64 * width),
+                   kernel_size=9,
+                   activation='relu',
+                   strides=1,
+                   padding='same'))
+
+
+    model.add(conv(filters=int(32 * width),
+                   kernel_size=9,
+                   activation='relu',
+                   strides=1,
+                   padding='same'))
+    model.add(conv(filters=int(32 * width),
+                   kernel_size=9,
+                   activation='relu',
+                   strides=1,
+                   padding='same'))
+
+
+    model.add(conv(filters=int(16 * width),
+                   kernel_size=9,
+                   activation='relu',
+                   strides=1,
+                   padding='same'))
+    model.add(conv(filters=int(16 * width),
+                   kernel_size=9,
+                   activation='relu',
+                   strides=1,
+                   padding='same'))
 
 
     model.add(Conv1D(filters=1,
@@ -283,16 +459,18 @@ def deep_filter_vanilla_Nlinear():
     return model
 
 
-def deep_filter_I_linear():
-    input_shape = (512, 1)
+def deep_filter_I_linear(merged=False, input_length=512):
+    # merged: single convolution modules, see LFilter_module
+    # input_length: as in deep_filter_I_LANL
+    input_shape = (input_length, 1)
     input = Input(shape=input_shape)
 
-    tensor = LFilter_module(input, 64)
-    tensor = LFilter_module(tensor, 64)
-    tensor = LFilter_module(tensor, 32)
-    tensor = LFilter_module(tensor, 32)
-    tensor = LFilter_module(tensor, 16)
-    tensor = LFilter_module(tensor, 16)
+    tensor = LFilter_module(input, 64, merged=merged)
+    tensor = LFilter_module(tensor, 64, merged=merged)
+    tensor = LFilter_module(tensor, 32, merged=merged)
+    tensor = LFilter_module(tensor, 32, merged=merged)
+    tensor = LFilter_module(tensor, 16, merged=merged)
+    tensor = LFilter_module(tensor, 16, merged=merged)
     predictions = Conv1D(filters=1,
                          kernel_size=9,
                          activation='linear',
@@ -304,16 +482,18 @@ def deep_filter_I_linear():
     return model
 
 
-def deep_filter_I_Nlinear():
-    input_shape = (512, 1)
+def deep_filter_I_Nlinear(merged=False, input_length=512):
+    # merged: single convolution modules, see LFilter_module
+    # input_length: as in deep_filter_I_LANL
+    input_shape = (input_length, 1)
     input = Input(shape=input_shape)
 
-    tensor = NLFilter_module(input, 64)
-    tensor = NLFilter_module(tensor, 64)
-    tensor = NLFilter_module(tensor, 32)
-    tensor = NLFilter_module(tensor, 32)
-    tensor = NLFilter_module(tensor, 16)
-    tensor = NLFilter_module(tensor, 16)
+    tensor = NLFilter_module(input, 64, merged=merged)
+    tensor = NLFilter_module(tensor, 64, merged=merged)
+    tensor = NLFilter_module(tensor, 32, merged=merged)
+    tensor = NLFilter_module(tensor, 32, merged=merged)
+    tensor = NLFilter_module(tensor, 16, merged=merged)
+    tensor = NLFilter_module(tensor, 16, merged=merged)
     predictions = Conv1D(filters=1,
                          kernel_size=9,
                          activation='linear',
@@ -325,24 +505,35 @@ def deep_filter_I_Nlinear():
     return model
 
 
-def deep_filter_I_LANL():
+def deep_filter_I_LANL(folded=False, merged=False, input_length=512, branch_filters=None):
     # TODO: Make the doc
-
-    input_shape = (512, 1)
+    # folded: inference model with the BatchNormalization layers folded into the modules,
+    # see dl_export.fold_batchnorm
+    # merged: single convolution modules, see LANLFilter_module
+    # input_length: samples of the input signals, None for any length. All the convolutions have
+    # stride 1 and 'same' padding, so the output has the length of the input and the trained
+    # weights (512 samples) can be loaded for any length. The samples closer to the borders than
+    # the receptive field see the zero padding, as the borders of the 512 samples beats do.
+    # branch_filters: branch_filters of each module (see LANLFilter_module), for the pruned models
+
+    if branch_filters is None:
+        branch_filters = [None] * 6
+
+    input_shape = (input_length, 1)
     input = Input(shape=input_shape)
 
-    tensor = LANLFilter_module(input, 64)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module(tensor, 64)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module(tensor, 32)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module(tensor, 32)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module(tensor, 16)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module(tensor, 16)
-    tensor = BatchNormalization()(tensor)
+    tensor = LANLFilter_module(input, 64, split_activation=folded, merged=merged, branch_filters=branch_filters[0])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module(tensor, 64, split_activation=folded, merged=merged, branch_filters=branch_filters[1])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module(tensor, 32, split_activation=folded, merged=merged, branch_filters=branch_filters[2])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module(tensor, 32, split_activation=folded, merged=merged, branch_filters=branch_filters[3])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module(tensor, 16, split_activation=folded, merged=merged, branch_filters=branch_filters[4])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module(tensor, 16, split_activation=folded, merged=merged, branch_filters=branch_filters[5])
+    tensor = _BatchNormalization(tensor, folded)
     predictions = Conv1D(filters=1,
                     kernel_size=9,
                     activation='linear',
@@ -354,24 +545,33 @@ def deep_filter_I_LANL():
     return model
 
 
-def deep_filter_model_I_LANL_dilated():
+def deep_filter_model_I_LANL_dilated(kernel_sizes=(5, 9, 15), dilation_rate=3, folded=False, merged=False,
+                                     input_length=512, branch_filters=None):
     # TODO: Make the doc
+    # kernel_sizes, dilation_rate: branches of the dilated modules
+    # folded, merged, input_length, branch_filters: as in deep_filter_I_LANL
 
-    input_shape = (512, 1)
+    if branch_filters is None:
+        branch_filters = [None] * 6
+
+    input_shape = (input_length, 1)
     input = Input(shape=input_shape)
 
-    tensor = LANLFilter_module(input, 64)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module_dilated(tensor, 64)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module(tensor, 32)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module_dilated(tensor, 32)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module(tensor, 16)
-    tensor = BatchNormalization()(tensor)
-    tensor = LANLFilter_module_dilated(tensor, 16)
-    tensor = BatchNormalization()(tensor)
+    tensor = LANLFilter_module(input, 64, split_activation=folded, merged=merged, branch_filters=branch_filters[0])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module_dilated(tensor, 64, kernel_sizes, dilation_rate, split_activation=folded,
+                                       merged=merged, branch_filters=branch_filters[1])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module(tensor, 32, split_activation=folded, merged=merged, branch_filters=branch_filters[2])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module_dilated(tensor, 32, kernel_sizes, dilation_rate, split_activation=folded,
+                                       merged=merged, branch_filters=branch_filters[3])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module(tensor, 16, split_activation=folded, merged=merged, branch_filters=branch_filters[4])
+    tensor = _BatchNormalization(tensor, folded)
+    tensor = LANLFilter_module_dilated(tensor, 16, kernel_sizes, dilation_rate, split_activation=folded,
+                                       merged=merged, branch_filters=branch_filters[5])
+    tensor = _BatchNormalization(tensor, folded)
     predictions = Conv1D(filters=1,
                     kernel_size=9,
                     activation='linear',
@@ -383,17 +583,23 @@ def deep_filter_model_I_LANL_dilated():
     return model
 
 
-def FCN_DAE():
+def FCN_DAE(input_length=512):
     # Implementation of FCN_DAE approach presented in
     # Chiang, H. T., Hsieh, Y. Y., Fu, S. W., Hung, K. H., Tsao, Y., & Chien, S. Y. (2019).
     # Noise reduction in ECG signals using fully convolutional denoising autoencoders.
     # IEEE Access, 7, 60806-60813.
+    # input_length: samples of the input signals, None for any length. The encoder halves the
+    # length 5 times and the decoder doubles it back, so the length has to be a multiple of 32
+    # (2 ** 5) to get an output as long as the input, pad the signals otherwise.
+
+    if input_length is not None and input_length % 32 != 0:
+        raise ValueError('The FCN_DAE input length has to be a multiple of 32, got ' + str(input_length))
 
-    input_shape = (512, 1)
+    input_shape = (input_length, 1)
     input = Input(shape=input_shape)
 
     x = Conv1D(filters=40,
-               input_shape=(512, 1),
+               input_shape=input_shape,
                kernel_size=16,
                activation='elu',
                strides=2,
@@ -441,80 +647,78 @@ def FCN_DAE():
 
     x = BatchNormalization()(x)
 
-    # Keras has no 1D Traspose Convolution, instead we use Conv2DTranspose function
-    # in a souch way taht is mathematically equivalent
-    x = Conv1DTranspose(input_tensor=x,
-                        filters=1,
+    # Keras has no 1D Traspose Convolution, instead we use the Conv1DTranspose layer defined above
+    x = Conv1DTranspose(filters=1,
                         kernel_size=16,
                         activation='elu',
                         strides=1,
-                        padding='same')
+                        padding='same')(x)
 
     x = BatchNormalization()(x)
 
-    x = Conv1DTranspose(input_tensor=x,
-                        filters=40,
+    x = Conv1DTranspose(filters=40,
                         kernel_size=16,
                         activation='elu',
                         strides=2,
-                        padding='same')
+                        padding='same')(x)
 
     x = BatchNormalization()(x)
 
-    x = Conv1DTranspose(input_tensor=x,
-                        filters=20,
+    x = Conv1DTranspose(filters=20,
                         kernel_size=16,
                         activation='elu',
                         strides=2,
-                        padding='same')
+                        padding='same')(x)
 
     x = BatchNormalization()(x)
 
-    x = Conv1DTranspose(input_tensor=x,
-                        filters=20,
+    x = Conv1DTranspose(filters=20,
                         kernel_size=16,
                         activation='elu',
                         strides=2,
-                        padding='same')
+                        padding='same')(x)
 
     x = BatchNormalization()(x)
 
-    x = Conv1DTranspose(input_tensor=x,
-                        filters=20,
+    x = Conv1DTranspose(filters=20,
                         kernel_size=16,
                         activation='elu',
                         strides=2,
-                        padding='same')
+                        padding='same')(x)
 
     x = BatchNormalization()(x)
 
-    x = Conv1DTranspose(input_tensor=x,
-                        filters=40,
+    x = Conv1DTranspose(filters=40,
                         kernel_size=16,
                         activation='elu',
                         strides=2,
-                        padding='same')
+                        padding='same')(x)
 
     x = BatchNormalization()(x)
 
-    predictions = Conv1DTranspose(input_tensor=x,
-                        filters=1,
+    predictions = Conv1DTranspose(filters=1,
                         kernel_size=16,
                         activation='linear',
                         strides=1,
-                        padding='same')
+                        padding='same')(x)
 
     model = Model(inputs=[input], outputs=predictions)
     return model
 
 
-def DRRN_denoising():
+def DRRN_denoising(unroll=False, stateful=False):
     # Implementation of DRNN approach presented in
     # Antczak, K. (2018). Deep recurrent neural networks for ECG signal denoising.
     # arXiv preprint arXiv:1807.11551.
+    # unroll: build the LSTM without a while loop (same weights), needed by the TFLite converter
+    # stateful: streaming model, one signal of any length per call and the LSTM state is kept between
+    # calls (model.reset_states() starts a new signal), see dl_streaming.DRNNStream
 
     model = Sequential()
-    model.add(LSTM(64, input_shape=(512, 1), return_sequences=True))
+    if stateful:
+        model.add(LSTM(64, batch_input_shape=(1, None, 1), return_sequences=True, stateful=True))
+    else:
+        model.add(LSTM(64, input_shape=(512, 1), return_sequences=True, unroll=unroll))
     model.add(Dense(64, activation='relu'))
     model.add(Dense(64, activation='relu'))
     model.add(Dense(1, activation='linear'))
@@ -0,0 +1,62 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  ONNX Runtime inference backend
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+
+import numpy as np
+import onnxruntime as ort
+
+from deepFilter.dl_pipeline import get_model_label
+
+# Runs the models exported with dl_export.export_onnx on ONNX Runtime (CPU), the inference does not
+# build the Keras model.
+
+
+class OnnxModel:
+    """
+        ONNX model with the Keras predict interface.
+
+        filepath: ONNX model
+        intra_op_threads: ONNX Runtime threads, 0 lets it decide
+    """
+
+    def __init__(self, filepath, intra_op_threads=0):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = ort.InferenceSession(filepath, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+
+    def predict(self, x, batch_size=32):
+        outputs = []
+        for start in range(0, len(x), batch_size):
+            batch = np.asarray(x[start:start + batch_size], dtype=np.float32)
+            outputs.append(self.session.run([self.output_name], {self.input_name: batch})[0])
+
+        return np.concatenate(outputs, axis=0)
+
+
+def test_onnx(Dataset, experiment, output_dir='.', intra_op_threads=0):
+    # Same as dl_pipeline.test_dl with the ONNX model saved in output_dir by dl_export.export_onnx
+
+    print('ONNX Runtime pipeline: Testing the model')
+
+    [train_set, train_set_GT, X_test, y_test] = Dataset
+
+    batch_size = 32
+
+    model = OnnxModel(os.path.join(output_dir, get_model_label(experiment) + '.onnx'), intra_op_threads)
+
+    y_pred = model.predict(X_test, batch_size=batch_size)
+
+    return [X_test, y_test, y_pred]
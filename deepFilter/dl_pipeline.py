@@ -9,88 +9,131 @@
 #
 #===========================================================
 
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
 import keras
 from keras import backend as K
 from keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, EarlyStopping, TensorBoard
-from keras import losses
 from sklearn.model_selection import train_test_split
+from prettytable import PrettyTable
 
 import deepFilter.dl_models as models
+from deepFilter.dl_callbacks import TrainingStateCheckpoint, TrainingProfiler, load_training_state
+from deepFilter.dl_losses import ssd_loss, combined_ssd_mse_loss, combined_ssd_mad_loss, sad_loss, mad_loss,\
+                                training_metrics, distillation_loss, distillation_metrics
+from utils.metrics import SSD, MAD, PRD, COS_SIM
 
+# Default student of train_distillation, half the filters and depthwise separable convolutions
+DISTILLATION_STUDENT = {'width': 0.5, 'separable': True}
 
-# Custom loss SSD
-def ssd_loss(y_true, y_pred):
-    return K.sum(K.square(y_pred - y_true), axis=-2)
-
-# Combined loss SSD + MSE
-def combined_ssd_mse_loss(y_true, y_pred):
-    return K.mean(K.square(y_true - y_pred), axis=-2) * 500 + K.sum(K.square(y_true - y_pred), axis=-2)
-
-def combined_ssd_mad_loss(y_true, y_pred):
-    return K.max(K.square(y_true - y_pred), axis=-2) * 50 + K.sum(K.square(y_true - y_pred), axis=-2)
 
-# Custom loss SAD
-def sad_loss(y_true, y_pred):
-    return K.sum(K.sqrt(K.square(y_pred - y_true)), axis=-2)
+def configure_session(intra_op_threads=0, inter_op_threads=0, xla=False):
+    # Set a new Keras session with fixed TensorFlow thread pools. 0 lets TensorFlow decide.
+    # Note that K.clear_session() drops this configuration, so it has to be set again
+    # before building the next model.
+    # xla: JIT compile the graph with XLA, the element-wise ops of the losses and metrics
+    # (see dl_losses) are fused
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
 
-# Custom loss MAD
-def mad_loss(y_true, y_pred):
-    return K.max(K.square(y_pred - y_true), axis=-2)
+    if xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
 
+    # Do not reserve the whole GPU memory, several experiments may share the same device
+    config.gpu_options.allow_growth = True
 
-def train_dl(Dataset, experiment):
-
-    print('Deep Learning pipeline: Training the model for exp ' + str(experiment))
-
-    [X_train, y_train, X_test, y_test] = Dataset
+    K.set_session(tf.Session(config=config))
 
-    X_train, X_val, y_train, y_val = train_test_split(X_train, y_train, test_size=0.3, shuffle=True, random_state=1)
 
-    # ==================
-    # LOAD THE DL MODEL
-    # ==================
+def get_model(experiment, model_params=None):
+    # Builds the model of an experiment, model_params are passed to the model builder
+    # Returns the model and its label (used to name the weights and logs files)
 
+    model_params = {} if model_params is None else model_params
 
     if experiment == 'FCN-DAE':
         # FCN_DAE
-        model = models.FCN_DAE()
+        model = models.FCN_DAE(**model_params)
         model_label = 'FCN_DAE'
 
     if experiment == 'DRNN':
         # DRNN
-        model = models.DRRN_denoising()
+        model = models.DRRN_denoising(**model_params)
         model_label = 'DRNN'
 
     if experiment == 'Vanilla L':
         # Vanilla CNN linear
-        model = models.deep_filter_vanilla_linear()
+        model = models.deep_filter_vanilla_linear(**model_params)
         model_label = 'Vanilla_L'
 
     if experiment == 'Vanilla NL':
         # Vanilla CNN non linear
-        model = models.deep_filter_vanilla_Nlinear()
+        model = models.deep_filter_vanilla_Nlinear(**model_params)
         model_label = 'Vanilla_NL'
 
     if experiment == 'Multibranch LANL':
         # Multibranch linear and non linear
-        model = models.deep_filter_I_LANL()
+        model = models.deep_filter_I_LANL(**model_params)
         model_label = 'Multibranch_LANL'
 
     if experiment == 'Multibranch LANLD':
         # Inception-like linear and non linear dilated
-        model = models.deep_filter_model_I_LANL_dilated()
+        model = models.deep_filter_model_I_LANL_dilated(**model_params)
         model_label = 'Multibranch_LANLD'
 
+    return model, model_label
+
+
+def get_model_label(experiment):
+    # Same labels as get_model, without building the model
+    return experiment.replace('-', '_').replace(' ', '_')
+
+
+def load_weights(model, experiment, model_dir):
+    # Loads the trained weights of an experiment model from the output_dir of train_dl
+    model_label = get_model_label(experiment)
+    model_filepath = os.path.join(model_dir, model_label + '_weights.best.hdf5')
+
+    if experiment == 'FCN-DAE':
+        # Also loads the weights saved with the former Conv1DTranspose (Lambda + Conv2DTranspose)
+        models.load_FCN_DAE_weights(model, model_filepath)
+    else:
+        model.load_weights(model_filepath)
+
+
+def train_dl(Dataset, experiment, output_dir='.', resume=False, state_period=1, profile=False, trace_steps=None,
+             epochs=int(1e5), batch_size=128, lr=1e-3, min_delta=0.05, lr_patience=2, stop_patience=10,
+             model_params=None, distillation_alpha=None):
+    # resume: continue from the training state saved by a previous (interrupted) run
+    # state_period: interval (in epochs) between saves of the full training state
+    # profile: write a JSON report with data wait/compute time per step, throughput and peak memory
+    # trace_steps: (first, last) training steps to capture a TensorFlow trace of, needs profile=True
+    # epochs, batch_size, lr: training hyperparameters
+    # min_delta, lr_patience, stop_patience: ReduceLROnPlateau and EarlyStopping settings
+    # model_params: arguments for the model builder
+    # distillation_alpha: weight of the teacher outputs in the loss, y_train has the clean beats and the
+    # teacher outputs in the channels axis (see train_distillation)
+    # Returns the keras History of the training (None if a resumed training was already finished)
+
+    print('Deep Learning pipeline: Training the model for exp ' + str(experiment))
+
+    [X_train, y_train, X_test, y_test] = Dataset
+
+    X_train, X_val, y_train, y_val = train_test_split(X_train, y_train, test_size=0.3, shuffle=True, random_state=1)
+
+    # ==================
+    # LOAD THE DL MODEL
+    # ==================
+
+    model, model_label = get_model(experiment, model_params)
 
     print('\n ' + model_label + '\n ')
 
     model.summary()
 
-    epochs = int(1e5)  # 100000
-    # epochs = 100
-    batch_size = 128
-    lr = 1e-3
-    # lr = 1e-4
     minimum_lr = 1e-10
 
 
@@ -104,15 +147,30 @@ def train_dl(Dataset, experiment):
     else:
         criterion = combined_ssd_mad_loss
 
+    metrics = training_metrics
+
+    if distillation_alpha is not None:
+        criterion = distillation_loss(distillation_alpha)
+        metrics = distillation_metrics
+
+
+    # Training profiler, the report is kept next to the checkpoint
+    profiler = None
+    session_kwargs = {}
+    if profile:
+        profiler = TrainingProfiler(os.path.join(output_dir, model_label + '_profile.json'),
+                                    trace_steps=trace_steps)
+        session_kwargs = profiler.session_kwargs()
 
     model.compile(loss=criterion,
                   optimizer=keras.optimizers.Adam(lr=lr),
-                  metrics=[losses.mean_squared_error, losses.mean_absolute_error, ssd_loss, mad_loss])
+                  metrics=metrics,
+                  **session_kwargs)
 
     # Keras Callbacks
 
     # checkpoint
-    model_filepath = model_label + '_weights.best.hdf5'
+    model_filepath = os.path.join(output_dir, model_label + '_weights.best.hdf5')
 
     checkpoint = ModelCheckpoint(model_filepath,
                                  monitor="val_loss",
@@ -123,19 +181,19 @@ def train_dl(Dataset, experiment):
 
     reduce_lr = ReduceLROnPlateau(monitor="val_loss",
                                   factor=0.5,
-                                  min_delta=0.05,
+                                  min_delta=min_delta,
                                   mode='min',  # on acc has to go max
-                                  patience=2,
+                                  patience=lr_patience,
                                   min_lr=minimum_lr,
                                   verbose=1)
 
     early_stop = EarlyStopping(monitor="val_loss",  # "val_loss"
-                               min_delta=0.05,
+                               min_delta=min_delta,
                                mode='min',  # on acc has to go max
-                               patience=10,
+                               patience=stop_patience,
                                verbose=1)
 
-    tb_log_dir = './runs/' + model_label
+    tb_log_dir = os.path.join(output_dir, 'runs', model_label)
 
     tboard = TensorBoard(log_dir=tb_log_dir, histogram_freq=0,
                          write_graph=False, write_grads=False,
@@ -146,22 +204,48 @@ def train_dl(Dataset, experiment):
     # To run the tensor board
     # tensorboard --logdir=./runs
 
-    # GPU
-    model.fit(x=X_train, y=y_train,
-              validation_data=(X_val, y_val),
-              batch_size=batch_size,
-              epochs=epochs,
-              verbose=1,
-              callbacks=[early_stop,
-                         reduce_lr,
-                         checkpoint,
-                         tboard])
+    # Full training state (optimizer, epoch, callbacks counters and RNG) to resume interrupted runs
+    state_filepath = os.path.join(output_dir, model_label + '_train_state.pkl')
+
+    state = load_training_state(state_filepath) if resume else None
+    initial_epoch = 0 if state is None else state['epoch']
+
+    train_state = TrainingStateCheckpoint(state_filepath,
+                                          callbacks=[early_stop, reduce_lr, checkpoint],
+                                          period=state_period,
+                                          state=state)
+
+    callbacks = [early_stop,
+                 reduce_lr,
+                 checkpoint,
+                 tboard,
+                 train_state]
+
+    if profiler is not None:
+        callbacks.append(profiler)
+
+    history = None
+
+    if state is not None and state['stopped']:
+        print('Training of ' + model_label + ' already finished at epoch ' + str(initial_epoch))
+
+    else:
+        # GPU
+        history = model.fit(x=X_train, y=y_train,
+                            validation_data=(X_val, y_val),
+                            batch_size=batch_size,
+                            epochs=epochs,
+                            initial_epoch=initial_epoch,
+                            verbose=1,
+                            callbacks=callbacks)
 
     K.clear_session()
 
+    return history
+
 
 
-def test_dl(Dataset, experiment):
+def test_dl(Dataset, experiment, output_dir='.', model_params=None):
 
     print('Deep Learning pipeline: Testing the model')
 
@@ -173,35 +257,7 @@ def test_dl(Dataset, experiment):
     # LOAD THE DL MODEL
     # ==================
 
-    if experiment == 'FCN-DAE':
-        # FCN_DAE
-        model = models.FCN_DAE()
-        model_label = 'FCN_DAE'
-
-    if experiment == 'DRNN':
-        # DRNN
-        model = models.DRRN_denoising()
-        model_label = 'DRNN'
-
-    if experiment == 'Vanilla L':
-        # Vanilla CNN linear
-        model = models.deep_filter_vanilla_linear()
-        model_label = 'Vanilla_L'
-
-    if experiment == 'Vanilla NL':
-        # Vanilla CNN non linear
-        model = models.deep_filter_vanilla_Nlinear()
-        model_label = 'Vanilla_NL'
-
-    if experiment == 'Multibranch LANL':
-        # Multibranch linear and non linear
-        model = models.deep_filter_I_LANL()
-        model_label = 'Multibranch_LANL'
-
-    if experiment == 'Multibranch LANLD':
-        # Inception-like linear and non linear dilated
-        model = models.deep_filter_model_I_LANL_dilated()
-        model_label = 'Multibranch_LANLD'
+    model, model_label = get_model(experiment, model_params)
 
     print('\n ' + model_label + '\n ')
 
@@ -219,12 +275,10 @@ def test_dl(Dataset, experiment):
 
     model.compile(loss=criterion,
                   optimizer=keras.optimizers.Adam(lr=0.01),
-                  metrics=[losses.mean_squared_error, losses.mean_absolute_error, ssd_loss, mad_loss])
+                  metrics=training_metrics)
 
-    # checkpoint
-    model_filepath = model_label + '_weights.best.hdf5'
     # load weights
-    model.load_weights(model_filepath)
+    load_weights(model, experiment, output_dir)
 
     # Test score
     y_pred = model.predict(X_test, batch_size=batch_size, verbose=1)
@@ -233,3 +287,94 @@ def test_dl(Dataset, experiment):
     K.clear_session()
 
     return [X_test, y_test, y_pred]
+
+
+def train_distillation(Dataset, teacher_experiment, teacher_dir, experiment='Vanilla NL', output_dir='.',
+                       alpha=0.5, teacher_params=None, model_params=None, **train_params):
+    """
+        Trains a compact student model with the outputs of a trained teacher model.
+
+        The loss is (1 - alpha) * combined_ssd_mad_loss against the clean beats plus
+        alpha * combined_ssd_mad_loss against the teacher outputs, the teacher smooths the targets of
+        the beats it denoises well. The student is tested with test_dl(Dataset, experiment,
+        output_dir, model_params) as any other model.
+
+        Dataset: [X_train, y_train, X_test, y_test]
+        teacher_experiment, teacher_dir: experiment of the teacher and folder with its weights
+        experiment: experiment of the student
+        output_dir: folder of the student weights, not the one of the full size experiment
+        alpha: weight of the teacher outputs in the loss
+        teacher_params: arguments used to build the teacher
+        model_params: arguments of the student builder, DISTILLATION_STUDENT by default
+        train_params: other arguments of train_dl (epochs, batch_size, lr, ...)
+
+        Returns the keras History of the training
+    """
+    [X_train, y_train, X_test, y_test] = Dataset
+
+    if model_params is None:
+        model_params = DISTILLATION_STUDENT
+
+    print('Deep Learning pipeline: Teacher ' + teacher_experiment + ' outputs for the distillation')
+
+    teacher, _ = get_model(teacher_experiment, teacher_params)
+    load_weights(teacher, teacher_experiment, teacher_dir)
+    y_teacher = teacher.predict(X_train, batch_size=128, verbose=1)
+    K.clear_session()
+
+    y_distillation = np.concatenate([y_train, y_teacher], axis=-1)
+
+    return train_dl([X_train, y_distillation, X_test, y_test], experiment,
+                    output_dir=output_dir,
+                    model_params=model_params,
+                    distillation_alpha=alpha,
+                    **train_params)
+
+
+def distillation_report(Dataset, models_to_compare, batch_size=32):
+    """
+        Speed/accuracy tradeoff of several models, usually a teacher and its students.
+
+        Dataset: [X_train, y_train, X_test, y_test]
+        models_to_compare: list of (name, experiment, model_dir, model_params)
+        batch_size: beats per batch of the predictions
+
+        Returns a dict {name: {'params', 'throughput', 'SSD', 'MAD', 'PRD', 'COS_SIM'}}, the
+        throughput in beats per second and the mean of the metrics on the test set
+    """
+    [X_train, y_train, X_test, y_test] = Dataset
+
+    report = {}
+
+    for name, experiment, model_dir, model_params in models_to_compare:
+        model, _ = get_model(experiment, model_params)
+        load_weights(model, experiment, model_dir)
+
+        # Warm up, the first call builds the predict function
+        model.predict(X_test[:batch_size], batch_size=batch_size)
+
+        start = time.time()
+        y_pred = model.predict(X_test, batch_size=batch_size)
+        elapsed = time.time() - start
+
+        report[name] = {'params': model.count_params(),
+                        'throughput': len(X_test) / elapsed,
+                        'SSD': float(np.mean(SSD(y_test, y_pred))),
+                        'MAD': float(np.mean(MAD(y_test, y_pred))),
+                        'PRD': float(np.mean(PRD(y_test, y_pred))),
+                        'COS_SIM': float(np.mean(COS_SIM(y_test, y_pred)))}
+
+        K.clear_session()
+
+    baseline = report[models_to_compare[0][0]]['throughput']
+
+    tb = PrettyTable()
+    tb.field_names = ['Model', 'Params', 'Beats/s', 'Speedup', 'SSD (au)', 'MAD (au)', 'PRD (au)', 'Cosine Sim']
+    for name, _, _, _ in models_to_compare:
+        result = report[name]
+        tb.add_row([name, result['params'], '{:.0f}'.format(result['throughput']),
+                    '{:.2f}x'.format(result['throughput'] / baseline)] +
+                   ['{:.3f}'.format(result[metric]) for metric in ['SSD', 'MAD', 'PRD', 'COS_SIM']])
+    print(tb)
+
+    return report
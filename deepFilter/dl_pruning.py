@@ -0,0 +1,293 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Structured pruning of the Multibranch models
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+
+import numpy as np
+import keras
+from keras import backend as K
+from sklearn.model_selection import train_test_split
+
+from deepFilter.dl_export import multibranch_modules
+from deepFilter.dl_losses import combined_ssd_mad_loss
+from deepFilter.dl_pipeline import get_model, load_weights
+from utils.metrics import SSD, PRD
+
+# Every pruning step scores the output channels of the multibranch modules, removes the lowest
+# scored ones (a branch without channels is removed too) and builds the smaller model with the
+# branch_filters argument of the builders, so the pruned model is physically smaller. The pruned
+# model is fine-tuned and evaluated on the validation split of train_dl, pruning stops when its
+# SSD or PRD gets worse than the allowed degradation and the last accepted model is kept.
+#
+# The pruned weights are saved as label_weights.best.hdf5 in output_dir together with
+# pruning.json, load_pruned_params gives the model_params to build it (test_dl, dl_export).
+
+PRUNABLE_EXPERIMENTS = ['Multibranch LANL', 'Multibranch LANLD']
+
+PRUNING_FILE = 'pruning.json'
+
+
+def _module_weights(model):
+    # [(branch convolutions, BatchNormalization)] of each module and the output convolution
+    modules = multibranch_modules(model)
+    for _, batch_norm in modules:
+        if not isinstance(batch_norm, keras.layers.BatchNormalization):
+            raise ValueError('Layer ' + batch_norm.name + ' after a module is not a BatchNormalization, '
+                             'only the trained (not folded) Multibranch models can be pruned')
+
+    return modules, model.layers[-1]
+
+
+def channel_scores(model, x=None, score='magnitude'):
+    """
+        Importance of the output channels of each module, normalized by the mean of the module so
+        the modules can be compared.
+
+        'magnitude':  L1 norm of the filter times the BatchNormalization scale |gamma| / sqrt(var + eps)
+        'activation': mean absolute output of the BatchNormalization on x times the L1 norm of the
+                      weights that read the channel in the next layer
+
+        model: Multibranch LANL or LANLD model
+        x: validation beats, needed for 'activation'
+        score: 'magnitude' | 'activation'
+
+        Returns a list with the scores of each module, in the concatenation order
+    """
+    modules, output_conv = _module_weights(model)
+
+    if score == 'activation':
+        if x is None:
+            raise ValueError('The activation score needs the validation beats')
+        outputs = K.function([model.input], [batch_norm.output for _, batch_norm in modules])
+        activations = [np.zeros(K.int_shape(batch_norm.output)[-1]) for _, batch_norm in modules]
+        for start in range(0, len(x), 256):
+            for i, output in enumerate(outputs([x[start:start + 256]])):
+                activations[i] += np.sum(np.abs(output), axis=(0, 1))
+        activations = [activation / (len(x) * x.shape[1]) for activation in activations]
+
+    scores = []
+    for i, (branches, batch_norm) in enumerate(modules):
+        if score == 'magnitude':
+            kernel_norm = np.concatenate([np.sum(np.abs(branch.get_weights()[0]), axis=(0, 1)) for branch in branches])
+            gamma, _, _, variance = batch_norm.get_weights()
+            module_scores = kernel_norm * np.abs(gamma) / np.sqrt(variance + batch_norm.epsilon)
+
+        elif score == 'activation':
+            if i + 1 < len(modules):
+                next_kernels = [branch.get_weights()[0] for branch in modules[i + 1][0]]
+            else:
+                next_kernels = [output_conv.get_weights()[0]]
+            next_norm = np.sum([np.sum(np.abs(kernel), axis=(0, 2)) for kernel in next_kernels], axis=0)
+            module_scores = activations[i] * next_norm
+
+        else:
+            raise ValueError('Unknown score ' + str(score))
+
+        scores.append(module_scores / max(np.mean(module_scores), 1e-12))
+
+    return scores
+
+
+def select_channels(branch_filters, scores, fraction, min_branches=2):
+    """
+        Chooses the channels to keep after removing a fraction of the lowest scored ones.
+
+        branch_filters: filters of every branch of each module (0 for the removed branches)
+        scores: channel_scores of the model
+        fraction: fraction of the remaining channels to remove
+        min_branches: branches that every module keeps at least, at least 2 (the module concatenates them)
+
+        Returns the new branch_filters and, for each module, the indexes of the kept channels
+    """
+    if min_branches < 2:
+        raise ValueError('Every module has to keep at least two branches to concatenate, got min_branches ' +
+                         str(min_branches))
+
+    # Branch of each channel of each module, in the concatenation order
+    channel_branch = [np.repeat(np.arange(len(filters)), filters) for filters in branch_filters]
+
+    candidates = sorted((score, module, channel) for module, module_scores in enumerate(scores)
+                        for channel, score in enumerate(module_scores))
+    n_remove = int(fraction * len(candidates))
+
+    new_filters = [list(filters) for filters in branch_filters]
+    removed = [set() for _ in branch_filters]
+
+    for _, module, channel in candidates:
+        if n_remove == 0:
+            break
+
+        branch = channel_branch[module][channel]
+        if new_filters[module][branch] == 1 and sum(f > 0 for f in new_filters[module]) <= min_branches:
+            continue
+
+        new_filters[module][branch] -= 1
+        removed[module].add(channel)
+        n_remove -= 1
+
+    keep = [np.array([channel for channel in range(len(module_scores)) if channel not in removed[module]])
+            for module, module_scores in enumerate(scores)]
+
+    return new_filters, keep
+
+
+def copy_pruned_weights(model, pruned_model, keep):
+    """
+        Copies the weights of the kept channels into the pruned model.
+
+        model: Multibranch model
+        pruned_model: the same model built with the pruned branch_filters
+        keep: indexes of the kept channels of each module (see select_channels)
+    """
+    modules, output_conv = _module_weights(model)
+    pruned_modules, pruned_output_conv = _module_weights(pruned_model)
+
+    input_keep = np.arange(K.int_shape(model.input)[-1])
+
+    for module_keep, (branches, batch_norm), (pruned_branches, pruned_batch_norm) in zip(keep, modules,
+                                                                                       pruned_modules):
+        channel = 0
+        pruned_branch = 0
+        for branch in branches:
+            kernel, bias = branch.get_weights()
+            branch_keep = module_keep[(module_keep >= channel) & (module_keep < channel + branch.filters)] - channel
+            channel += branch.filters
+
+            if len(branch_keep) == 0:
+                # Removed branch
+                continue
+
+            pruned_branches[pruned_branch].set_weights([kernel[:, input_keep][:, :, branch_keep], bias[branch_keep]])
+            pruned_branch += 1
+
+        pruned_batch_norm.set_weights([weight[module_keep] for weight in batch_norm.get_weights()])
+        input_keep = module_keep
+
+    kernel, bias = output_conv.get_weights()
+    pruned_output_conv.set_weights([kernel[:, input_keep], bias])
+
+
+def _evaluate(model, X_val, y_val):
+    y_pred = model.predict(X_val, batch_size=128)
+    return float(np.mean(SSD(y_val, y_pred))), float(np.mean(PRD(y_val, y_pred)))
+
+
+def prune(Dataset, experiment, model_dir, output_dir, model_params=None, score='magnitude', step=0.1,
+          max_steps=20, max_ssd_increase=0.05, max_prd_increase=0.05, finetune_epochs=5, batch_size=128,
+          lr=1e-4, min_branches=2):
+    """
+        Prunes a trained Multibranch model step by step until it gets too inaccurate.
+
+        Dataset: [X_train, y_train, X_test, y_test]
+        experiment: 'Multibranch LANL' or 'Multibranch LANLD'
+        model_dir: folder with the trained weights (output_dir of train_dl)
+        output_dir: folder for the pruned weights and pruning.json
+        model_params: arguments used to build the trained model
+        score: channel score, see channel_scores
+        step: fraction of the remaining channels removed on every step
+        max_steps: maximum amount of pruning steps
+        max_ssd_increase, max_prd_increase: allowed relative degradation of the validation SSD and PRD
+                                            with respect to the trained model (0.05 is 5 %)
+        finetune_epochs, batch_size, lr: fine-tuning after every step
+        min_branches: branches that every module keeps at least, at least 2 (the module concatenates them)
+
+        Returns the model_params of the pruned model
+    """
+    if experiment not in PRUNABLE_EXPERIMENTS:
+        raise ValueError('Only the models of ' + str(PRUNABLE_EXPERIMENTS) + ' can be pruned')
+    if min_branches < 2:
+        raise ValueError('Every module has to keep at least two branches to concatenate, got min_branches ' +
+                         str(min_branches))
+
+    [X_train, y_train, X_test, y_test] = Dataset
+
+    # Same validation split as train_dl
+    X_train, X_val, y_train, y_val = train_test_split(X_train, y_train, test_size=0.3, shuffle=True, random_state=1)
+
+    model_params = {} if model_params is None else dict(model_params)
+
+    model, model_label = get_model(experiment, model_params)
+    load_weights(model, experiment, model_dir)
+
+    modules, _ = _module_weights(model)
+    branch_filters = model_params.get('branch_filters') or [[branch.filters for branch in branches]
+                                                            for branches, _ in modules]
+    weights = model.get_weights()
+
+    base_ssd, base_prd = _evaluate(model, X_val, y_val)
+    history = [{'step': 0, 'branch_filters': branch_filters, 'params': model.count_params(),
+                'ssd': base_ssd, 'prd': base_prd, 'accepted': True}]
+    print('Pruning ' + model_label + ': SSD {:.3f}, PRD {:.3f}, '.format(base_ssd, base_prd) +
+          str(model.count_params()) + ' parameters')
+
+    K.clear_session()
+
+    for step_number in range(1, max_steps + 1):
+        model, _ = get_model(experiment, dict(model_params, branch_filters=branch_filters))
+        model.set_weights(weights)
+
+        scores = channel_scores(model, X_val, score)
+        new_filters, keep = select_channels(branch_filters, scores, step, min_branches)
+
+        if new_filters == branch_filters:
+            print('Nothing left to prune')
+            K.clear_session()
+            break
+
+        pruned_model, _ = get_model(experiment, dict(model_params, branch_filters=new_filters))
+        copy_pruned_weights(model, pruned_model, keep)
+
+        pruned_model.compile(loss=combined_ssd_mad_loss, optimizer=keras.optimizers.Adam(lr=lr))
+        pruned_model.fit(x=X_train, y=y_train,
+                         validation_data=(X_val, y_val),
+                         batch_size=batch_size,
+                         epochs=finetune_epochs,
+                         verbose=1)
+
+        ssd, prd = _evaluate(pruned_model, X_val, y_val)
+        accepted = ssd <= base_ssd * (1 + max_ssd_increase) and prd <= base_prd * (1 + max_prd_increase)
+
+        history.append({'step': step_number, 'branch_filters': new_filters, 'params': pruned_model.count_params(),
+                        'ssd': ssd, 'prd': prd, 'accepted': accepted})
+        print('Pruning step ' + str(step_number) + ': SSD {:.3f}, PRD {:.3f}, '.format(ssd, prd) +
+              str(pruned_model.count_params()) + ' parameters, ' + ('accepted' if accepted else 'rejected'))
+
+        if accepted:
+            branch_filters = new_filters
+            weights = pruned_model.get_weights()
+
+        K.clear_session()
+
+        if not accepted:
+            break
+
+    # Save the last accepted model
+    pruned_params = dict(model_params, branch_filters=branch_filters)
+
+    os.makedirs(output_dir, exist_ok=True)
+    model, _ = get_model(experiment, pruned_params)
+    model.set_weights(weights)
+    model.save_weights(os.path.join(output_dir, model_label + '_weights.best.hdf5'))
+    K.clear_session()
+
+    with open(os.path.join(output_dir, PRUNING_FILE), 'w') as output:
+        json.dump({'experiment': experiment, 'model_params': pruned_params, 'history': history}, output, indent=2)
+
+    print('Pruned model saved to ' + output_dir)
+
+    return pruned_params
+
+
+def load_pruned_params(output_dir):
+    # model_params of the pruned model saved by prune
+    with open(os.path.join(output_dir, PRUNING_FILE), 'r') as input:
+        return json.load(input)['model_params']
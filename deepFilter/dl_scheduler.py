@@ -0,0 +1,239 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Experiment scheduler
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from datetime import timedelta
+import _pickle as pickle
+
+from utils.results_store import ResultsStore
+
+# Each experiment runs in its own spawned process and folder (results_dir/Vanilla_L/, with its
+# status.json), a job marked as done is not run again.
+
+STATUS_FILE = 'status.json'
+# Former per experiment results, [X_test, y_test, y_pred], still read by load_results
+RESULTS_FILE = 'test_results.pkl'
+STORE_DIR = 'store'
+
+
+def job_dir(results_dir, experiment):
+    return os.path.join(results_dir, experiment.replace(' ', '_'))
+
+
+def read_status(results_dir, experiment):
+    status_path = os.path.join(job_dir(results_dir, experiment), STATUS_FILE)
+
+    if not os.path.exists(status_path):
+        return {'experiment': experiment, 'status': 'pending', 'attempts': 0}
+
+    with open(status_path, 'r') as input:
+        return json.load(input)
+
+
+def _write_status(results_dir, experiment, status):
+    status_path = os.path.join(job_dir(results_dir, experiment), STATUS_FILE)
+
+    # Write and rename so an interrupted job never leaves a truncated status file
+    with open(status_path + '.tmp', 'w') as output:
+        json.dump(status, output, indent=2)
+    os.replace(status_path + '.tmp', status_path)
+
+
+def results_store(results_dir):
+    return ResultsStore(os.path.join(results_dir, STORE_DIR))
+
+
+def save_results(results_dir, experiment, test_results):
+    # The test beats are saved once in the store, the experiment only adds its predictions
+    [X_test, y_test, y_pred] = test_results
+    results_store(results_dir).add_method(experiment, y_pred, X_test, y_test)
+
+
+def has_results(results_dir, experiment):
+    return results_store(results_dir).has_method(experiment) or \
+           os.path.exists(os.path.join(job_dir(results_dir, experiment), RESULTS_FILE))
+
+
+def load_results(results_dir, experiment):
+    # [X_test, y_test, y_pred], memory mapped from the store
+    store = results_store(results_dir)
+    if store.has_method(experiment):
+        return store.results(experiment)
+
+    with open(os.path.join(job_dir(results_dir, experiment), RESULTS_FILE), 'rb') as input:
+        return pickle.load(input)
+
+
+def load_timing(results_dir, experiments):
+    # Returns [train_time_list, test_time_list] as timedelta lists, the same format DeepFilter_main uses
+    train_time_list = []
+    test_time_list = []
+
+    for experiment in experiments:
+        status = read_status(results_dir, experiment)
+        train_time_list.append(timedelta(seconds=status.get('train_time', 0)))
+        test_time_list.append(timedelta(seconds=status.get('test_time', 0)))
+
+    return [train_time_list, test_time_list]
+
+
+def _run_job(dataset_path, experiment, results_dir, intra_op_threads, inter_op_threads, cpus, attempt, backend):
+    # Entry point of the worker process
+
+    # Pin the process to its cpu slot and size the OpenMP/MKL pools before TensorFlow is imported
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    os.environ['MKL_NUM_THREADS'] = str(intra_op_threads)
+
+    status = {'experiment': experiment, 'status': 'running', 'attempts': attempt,
+              'intra_op_threads': intra_op_threads, 'inter_op_threads': inter_op_threads,
+              'cpus': sorted(cpus) if cpus is not None else None, 'backend': backend}
+    _write_status(results_dir, experiment, status)
+
+    try:
+        from deepFilter.dl_pipeline import train_dl, test_dl, configure_session
+
+        with open(dataset_path, 'rb') as input:
+            Dataset = pickle.load(input)
+
+        output_dir = job_dir(results_dir, experiment)
+
+        configure_session(intra_op_threads, inter_op_threads)
+        start_train = time.time()
+        # A retried job continues the training where the failed attempt left it
+        train_dl(Dataset, experiment, output_dir=output_dir, resume=True)
+        status['train_time'] = time.time() - start_train
+
+        if backend == 'onnx':
+            from deepFilter.dl_export import export_onnx, verify_onnx
+            from deepFilter.dl_onnx import test_onnx
+            from deepFilter.dl_pipeline import get_model_label
+
+            onnx_filepath = os.path.join(output_dir, get_model_label(experiment) + '.onnx')
+            if not os.path.exists(onnx_filepath):
+                configure_session(intra_op_threads, inter_op_threads)
+                export_onnx(experiment, output_dir, onnx_filepath)
+
+            # The ONNX model has to give the outputs of the Keras model, otherwise the job fails
+            configure_session(intra_op_threads, inter_op_threads)
+            status['onnx_max_diff'] = verify_onnx(experiment, output_dir, Dataset[2][:64], onnx_filepath)
+
+            start_test = time.time()
+            [X_test, y_test, y_pred] = test_onnx(Dataset, experiment, output_dir=output_dir,
+                                                 intra_op_threads=intra_op_threads)
+            status['test_time'] = time.time() - start_test
+
+        else:
+            # train_dl clears the session, so the thread settings have to be applied again
+            configure_session(intra_op_threads, inter_op_threads)
+            start_test = time.time()
+            [X_test, y_test, y_pred] = test_dl(Dataset, experiment, output_dir=output_dir)
+            status['test_time'] = time.time() - start_test
+
+        save_results(results_dir, experiment, [X_test, y_test, y_pred])
+
+        status['status'] = 'done'
+        _write_status(results_dir, experiment, status)
+
+    except Exception:
+        status['status'] = 'failed'
+        status['error'] = traceback.format_exc()
+        _write_status(results_dir, experiment, status)
+        raise
+
+
+def run_experiments(experiments, dataset_path, results_dir='results', n_jobs=2,
+                    intra_op_threads=None, inter_op_threads=1, max_retries=1, pin_cpus=True, backend='keras'):
+    # Runs the train_dl/test_dl jobs of the experiments in n_jobs parallel processes
+    # intra_op_threads: TensorFlow threads per job, by default the cpus are split among the jobs
+    # pin_cpus: bind each job to its own cpus (where the OS supports it)
+    # backend: 'keras' or 'onnx' (the trained model is exported and tested on ONNX Runtime)
+    # Returns a dict {experiment: status}
+
+    n_cpus = mp.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(experiments)))
+
+    if intra_op_threads is None:
+        intra_op_threads = max(1, n_cpus // n_jobs)
+
+    # Every slot owns a fixed cpu set, a job started on a slot inherits it
+    slots_cpus = [None] * n_jobs
+    if pin_cpus and hasattr(os, 'sched_setaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+        per_slot = max(1, len(available) // n_jobs)
+        for slot in range(n_jobs):
+            slot_cpus = available[slot * per_slot:(slot + 1) * per_slot]
+            slots_cpus[slot] = set(slot_cpus) if slot_cpus else set(available)
+
+    dataset_path = os.path.abspath(dataset_path)
+    os.makedirs(results_dir, exist_ok=True)
+
+    # Queue the jobs that are not already done
+    queue = []
+    for experiment in experiments:
+        status = read_status(results_dir, experiment)
+        if status['status'] == 'done' and has_results(results_dir, experiment):
+            print('Experiment ' + experiment + ' already done, skipping')
+            continue
+
+        os.makedirs(job_dir(results_dir, experiment), exist_ok=True)
+        queue.append((experiment, status['attempts'], 0))
+
+    ctx = mp.get_context('spawn')
+    running = {}  # process sentinel -> (process, experiment, slot, attempt, retries)
+    free_slots = list(range(n_jobs))
+
+    while queue or running:
+
+        # Fill the free slots
+        while queue and free_slots:
+            experiment, attempts, retries = queue.pop(0)
+            slot = free_slots.pop(0)
+            attempt = attempts + 1
+
+            process = ctx.Process(target=_run_job,
+                                  args=(dataset_path, experiment, results_dir, intra_op_threads,
+                                        inter_op_threads, slots_cpus[slot], attempt, backend),
+                                  name='DeepFilter-' + experiment)
+            process.start()
+            running[process.sentinel] = (process, experiment, slot, attempt, retries)
+            print('Experiment ' + experiment + ' started (attempt ' + str(attempt) + ')')
+
+        # Wait for any job to finish
+        for sentinel in wait(list(running.keys())):
+            process, experiment, slot, attempt, retries = running.pop(sentinel)
+            process.join()
+            free_slots.append(slot)
+
+            status = read_status(results_dir, experiment)
+            if process.exitcode == 0 and status['status'] == 'done':
+                print('Experiment ' + experiment + ' done')
+                continue
+
+            # A killed worker can not report its own failure
+            if status['status'] != 'failed':
+                status['status'] = 'failed'
+                status['error'] = 'Worker exited with code ' + str(process.exitcode)
+                _write_status(results_dir, experiment, status)
+
+            if retries < max_retries:
+                print('Experiment ' + experiment + ' failed, queued again')
+                queue.append((experiment, attempt, retries + 1))
+            else:
+                print('Experiment ' + experiment + ' failed after ' + str(attempt) + ' attempts')
+
+    return {experiment: read_status(results_dir, experiment) for experiment in experiments}
@@ -0,0 +1,229 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Sliding window inference for long signals
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+
+# A long signal is denoised in overlapping windows of 512 samples, blended with per window weights.
+# 'center' keeps the samples at least margin away from the window borders (the same output as the
+# whole signal), 'ola' blends Hann windows with 50 % overlap (an approximation).
+
+WINDOW = 512
+
+
+def _predict_fn(model, batch_size):
+    # A Keras/ONNX model (predict method) or a function (n, window, 1) -> (n, window, 1)
+    if hasattr(model, 'predict'):
+        return lambda x: model.predict(x, batch_size=batch_size)
+    return model
+
+
+def estimate_margin(model, window=WINDOW, batch_size=32, rtol=1e-4, seed=1):
+    # Receptive field radius of a model, how far from a perturbed sample the output changes by more
+    # than rtol times the largest change
+    predict = _predict_fn(model, batch_size)
+
+    x = np.random.RandomState(seed).normal(scale=0.1, size=(1, window, 1)).astype(np.float32)
+    x_perturbed = x.copy()
+    x_perturbed[0, window // 2, 0] += 1.0
+
+    y = predict(np.concatenate([x, x_perturbed]))
+    diff = np.ravel(np.abs(y[1] - y[0]))
+    changed = np.flatnonzero(diff > rtol * np.max(diff))
+
+    if len(changed) == 0:
+        return 0
+
+    return int(max(window // 2 - changed[0], changed[-1] - window // 2))
+
+
+def window_weights(window=WINDOW, margin=0, mode='center'):
+    # Returns the hop and the blending weights of the windows
+    if mode == 'center':
+        if 2 * margin >= window:
+            raise ValueError('A margin of ' + str(margin) + ' samples leaves nothing of a window of ' + str(window))
+        weights = np.zeros(window, dtype=np.float32)
+        weights[margin:window - margin] = 1.0
+        return window - 2 * margin, weights
+
+    if mode == 'ola':
+        # Periodic Hann, the windows at window // 2 add up to one
+        weights = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(window) / window)).astype(np.float32)
+        return window // 2, weights
+
+    raise ValueError('Unknown mode ' + str(mode))
+
+
+def stream_denoise(chunks, model, window=WINDOW, margin=None, mode='auto', batch_size=32):
+    # Denoises a signal given as consecutive chunks, yields the samples no pending window covers
+    # margin: receptive field radius for 'center', estimated if None
+    # mode: 'center', 'ola' or 'auto' ('center' if the windows overlap less than a half). 'ola' only
+    # approximates the whole signal output
+    predict = _predict_fn(model, batch_size)
+
+    if mode == 'auto':
+        if margin is None:
+            margin = estimate_margin(predict, window)
+        mode = 'center' if 4 * margin <= window else 'ola'
+    elif mode == 'center' and margin is None:
+        margin = estimate_margin(predict, window)
+
+    hop, weights = window_weights(window, margin, mode)
+    peak_first = int(np.argmax(weights))
+    peak_last = window - 1 - int(np.argmax(weights[::-1]))
+
+    # Input samples and accumulators from buffer_start on
+    buffer = np.zeros(0, dtype=np.float32)
+    accumulator = np.zeros(0, dtype=np.float32)
+    normalization = np.zeros(0, dtype=np.float32)
+    buffer_start = 0
+    next_start = 0
+    length = 0
+
+    def process(starts, last):
+        for first in range(0, len(starts), batch_size):
+            batch_starts = starts[first:first + batch_size]
+            x = np.stack([buffer[start - buffer_start:start - buffer_start + window] for start in batch_starts])
+            y = np.reshape(predict(x[:, :, np.newaxis]), (len(batch_starts), window))
+
+            for start, y_window in zip(batch_starts, y):
+                w = weights
+                if start == 0 or (last and start == starts[-1]):
+                    w = weights.copy()
+                    if start == 0:
+                        w[:peak_first] = 1.0
+                    if last and start == starts[-1]:
+                        w[peak_last:] = 1.0
+
+                offset = start - buffer_start
+                accumulator[offset:offset + window] += w * y_window
+                normalization[offset:offset + window] += w
+
+    for chunk in chunks:
+        chunk = np.ravel(np.asarray(chunk, dtype=np.float32))
+        length += len(chunk)
+
+        buffer = np.concatenate([buffer, chunk])
+        accumulator = np.concatenate([accumulator, np.zeros(len(chunk), dtype=np.float32)])
+        normalization = np.concatenate([normalization, np.zeros(len(chunk), dtype=np.float32)])
+
+        starts = []
+        while next_start + window <= length:
+            starts.append(next_start)
+            next_start += hop
+
+        if not starts:
+            continue
+
+        process(starts, last=False)
+
+        # The samples before next_start are final
+        n = next_start - buffer_start
+        yield accumulator[:n] / normalization[:n]
+
+        buffer = buffer[n:]
+        accumulator = accumulator[n:]
+        normalization = normalization[n:]
+        buffer_start = next_start
+
+    # Zero pad the end of the signal to fill the last windows, as the model pads the whole signal
+    starts = []
+    while next_start < length:
+        starts.append(next_start)
+        next_start += hop
+
+    if not starts:
+        return
+
+    padding = starts[-1] + window - length
+    buffer = np.concatenate([buffer, np.zeros(padding, dtype=np.float32)])
+    accumulator = np.concatenate([accumulator, np.zeros(padding, dtype=np.float32)])
+    normalization = np.concatenate([normalization, np.zeros(padding, dtype=np.float32)])
+
+    process(starts, last=True)
+
+    n = length - buffer_start
+    yield accumulator[:n] / normalization[:n]
+
+
+def denoise_signal(signal, model, window=WINDOW, margin=None, mode='auto', batch_size=32, chunk_size=2 ** 20,
+                   out=None):
+    # Denoises a 1D array or np.memmap read in chunks of chunk_size samples into out (a new array if None)
+    signal = np.reshape(signal, (-1,))
+
+    if out is None:
+        out = np.zeros(len(signal), dtype=np.float32)
+
+    chunks = (signal[start:start + chunk_size] for start in range(0, len(signal), chunk_size))
+
+    position = 0
+    for y in stream_denoise(chunks, model, window, margin, mode, batch_size):
+        out[position:position + len(y)] = y
+        position += len(y)
+
+    return out
+
+
+def denoise_file(input_filepath, output_filepath, model, window=WINDOW, margin=None, mode='auto', batch_size=32,
+                 chunk_size=2 ** 20):
+    # Denoises a 1D .npy file into another .npy file, both memory mapped
+    signal = np.load(input_filepath, mmap_mode='r')
+    out = np.lib.format.open_memmap(output_filepath, mode='w+', dtype=np.float32, shape=(signal.size,))
+
+    denoise_signal(signal, model, window, margin, mode, batch_size, chunk_size, out)
+    out.flush()
+
+
+class DRNNStream:
+    # Streaming DRNN, a DRRN_denoising(stateful=True) model keeps the LSTM state between chunks
+
+    def __init__(self, model):
+        self.model = model
+        self.model.reset_states()
+
+    @classmethod
+    def from_weights(cls, weights_filepath):
+        from deepFilter.dl_models import DRRN_denoising
+
+        model = DRRN_denoising(stateful=True)
+        model.load_weights(weights_filepath)
+
+        return cls(model)
+
+    def reset(self):
+        # Starts a new signal
+        self.model.reset_states()
+
+    def process(self, chunk):
+        # Denoises the next samples of the signal, returns a 1D array of the same length
+        chunk = np.reshape(np.asarray(chunk, dtype=np.float32), (1, -1, 1))
+        if chunk.shape[1] == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        return self.model.predict(chunk, batch_size=1)[0, :, 0]
+
+
+def verify_drnn_stream(model, stream, x, chunk_size=16, atol=1e-5):
+    # Maximum difference between the streamed beats and the whole sequence model, ValueError if
+    # bigger than atol
+    y = model.predict(x, batch_size=32)
+
+    max_diff = 0.0
+    for beat, y_beat in zip(x, y):
+        stream.reset()
+        beat = np.ravel(beat)
+        y_stream = np.concatenate([stream.process(beat[start:start + chunk_size])
+                                   for start in range(0, len(beat), chunk_size)])
+        max_diff = max(max_diff, float(np.max(np.abs(y_stream - np.ravel(y_beat)))))
+
+    if max_diff > atol:
+        raise ValueError('The streamed DRNN is not equivalent, maximum absolute difference ' + str(max_diff))
+
+    return max_diff
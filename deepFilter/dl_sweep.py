@@ -0,0 +1,194 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Hyperparameter sweep
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+import math
+import time
+import itertools
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import _pickle as pickle
+
+import numpy as np
+from prettytable import PrettyTable
+
+# Successive halving, the best 1/eta trials of each rung continue training (from their saved state)
+# with eta times more epochs. The finished rungs are kept in sweep_dir/trials.jsonl.
+
+# Default search space for the Multibranch LANLD model
+search_space = {'batch_size': [32, 64, 128, 256],
+                'lr': [3e-4, 1e-3, 3e-3],
+                'kernel_sizes': [(3, 5, 9), (5, 9, 15), (9, 15, 21)],
+                'dilation_rate': [2, 3, 4]}
+
+# Parameters that go to the model builder, the others go to train_dl
+MODEL_PARAMS = ['kernel_sizes', 'dilation_rate']
+
+TRIALS_FILE = 'trials.jsonl'
+
+
+def sample_trials(search_space, n_trials, seed=1):
+    # Random configurations of the grid, without repetitions
+    keys = sorted(search_space.keys())
+    grid = list(itertools.product(*[search_space[key] for key in keys]))
+
+    rng = np.random.RandomState(seed)
+    selected = rng.permutation(len(grid))[:n_trials]
+
+    return [dict(zip(keys, grid[i])) for i in selected]
+
+
+def rung_budgets(min_epochs, max_epochs, eta):
+    # Epochs at the end of each rung: min_epochs, min_epochs * eta, ... up to max_epochs
+    budgets = []
+    budget = min_epochs
+    while budget < max_epochs:
+        budgets.append(budget)
+        budget *= eta
+    budgets.append(max_epochs)
+
+    return budgets
+
+
+def load_trials(sweep_dir):
+    trials_path = os.path.join(sweep_dir, TRIALS_FILE)
+    if not os.path.exists(trials_path):
+        return []
+
+    with open(trials_path, 'r') as input:
+        return [json.loads(line) for line in input if line.strip()]
+
+
+def _append_trial(sweep_dir, record):
+    with open(os.path.join(sweep_dir, TRIALS_FILE), 'a') as output:
+        output.write(json.dumps(record) + '\n')
+
+
+def _init_worker(intra_op_threads):
+    # Size the OpenMP/MKL pools before TensorFlow is imported in the worker
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    os.environ['MKL_NUM_THREADS'] = str(intra_op_threads)
+
+
+def _run_trial(dataset_path, experiment, trial_dir, config, epochs, intra_op_threads):
+    # Trains a trial up to the given amount of epochs, returns its best validation loss in this run
+    from deepFilter.dl_pipeline import train_dl, configure_session
+
+    with open(dataset_path, 'rb') as input:
+        Dataset = pickle.load(input)
+
+    model_params = {key: config[key] for key in MODEL_PARAMS if key in config}
+    train_params = {key: config[key] for key in config if key not in MODEL_PARAMS}
+
+    configure_session(intra_op_threads, 1)
+    history = train_dl(Dataset, experiment,
+                       output_dir=trial_dir,
+                       resume=True,
+                       epochs=epochs,
+                       model_params=model_params,
+                       **train_params)
+
+    if history is None or 'val_loss' not in history.history:
+        # Already finished (early stopping) on a previous rung
+        return None
+
+    return float(np.min(history.history['val_loss']))
+
+
+def run_sweep(dataset_path, experiment='Multibranch LANLD', search_space=search_space, n_trials=27,
+              min_epochs=2, max_epochs=54, eta=3, n_workers=2, intra_op_threads=None,
+              sweep_dir='sweeps', seed=1):
+    # Hyperparameter sweep with successive halving, n_workers trials are trained at the same time
+    # search_space: dict {parameter: list of values}, MODEL_PARAMS go to the model builder, the others
+    # to train_dl
+    # Returns the trials of the last rung sorted by validation loss
+    if intra_op_threads is None:
+        intra_op_threads = max(1, mp.cpu_count() // n_workers)
+
+    dataset_path = os.path.abspath(dataset_path)
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    configs = sample_trials(search_space, n_trials, seed)
+    budgets = rung_budgets(min_epochs, max_epochs, eta)
+
+    # Results already in the store, {(trial, rung): record}. Failed trials are trained again.
+    done = {(record['trial'], record['rung']): record for record in load_trials(sweep_dir)
+            if record['status'] == 'done'}
+
+    # Best validation loss of each trial so far
+    best_loss = {trial: math.inf for trial in range(len(configs))}
+    for (trial, rung), record in done.items():
+        if record['val_loss'] is not None and trial in best_loss:
+            best_loss[trial] = min(best_loss[trial], record['val_loss'])
+
+    survivors = list(range(len(configs)))
+
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=mp.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(intra_op_threads,)) as executor:
+
+        for rung, epochs in enumerate(budgets):
+            print('Sweep rung ' + str(rung) + ': ' + str(len(survivors)) + ' trials up to ' + str(epochs) + ' epochs')
+
+            futures = {}
+            for trial in survivors:
+                if (trial, rung) in done:
+                    continue
+
+                trial_dir = os.path.join(sweep_dir, 'trial_' + str(trial))
+                os.makedirs(trial_dir, exist_ok=True)
+                future = executor.submit(_run_trial, dataset_path, experiment, trial_dir, configs[trial],
+                                         epochs, intra_op_threads)
+                futures[future] = (trial, time.time())
+
+            for future in as_completed(futures):
+                trial, start = futures[future]
+                record = {'trial': trial,
+                          'rung': rung,
+                          'epochs': epochs,
+                          'config': configs[trial],
+                          'status': 'done',
+                          'val_loss': None,
+                          'time': None}
+
+                try:
+                    val_loss = future.result()
+                    record['val_loss'] = val_loss
+                    if val_loss is not None:
+                        best_loss[trial] = min(best_loss[trial], val_loss)
+
+                except Exception:
+                    record['status'] = 'failed'
+                    record['error'] = traceback.format_exc()
+                    best_loss[trial] = math.inf
+
+                record['best_val_loss'] = best_loss[trial] if math.isfinite(best_loss[trial]) else None
+                record['time'] = time.time() - start
+                _append_trial(sweep_dir, record)
+                done[(trial, rung)] = record
+
+            # Keep the best 1/eta trials for the next rung
+            survivors = sorted(survivors, key=lambda trial: best_loss[trial])
+            if rung < len(budgets) - 1:
+                survivors = survivors[:max(1, len(survivors) // eta)]
+
+    # Leaderboard of the last rung
+    tb = PrettyTable()
+    tb.field_names = ['Trial', 'val_loss'] + sorted(search_space.keys())
+    for trial in survivors:
+        tb.add_row([trial, '{:.3f}'.format(best_loss[trial])] +
+                   [configs[trial][key] for key in sorted(search_space.keys())])
+    print(tb)
+
+    return [{'trial': trial, 'config': configs[trial], 'val_loss': best_loss[trial]} for trial in survivors]
@@ -0,0 +1,213 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  TFLite export with int8 post-training quantization
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.lite.python.convert import ConverterError
+from keras import backend as K
+from prettytable import PrettyTable
+
+from deepFilter.dl_export import load_trained_model
+from deepFilter.dl_scheduler import job_dir, load_results
+from utils.metrics import SSD, MAD, PRD, COS_SIM
+
+# The models are converted with their weights and activations quantized to int8. The converter
+# calibrates the activation ranges running the float model on a representative dataset (training
+# beats), the model keeps float32 input and output so it is a drop-in replacement of the float one.
+# The models are built with dl_export.load_trained_model (inference graph, DRNN unrolled).
+
+REPORT_FILE = 'quantization_report.json'
+
+
+def representative_dataset(X_train, n_samples=500, seed=1):
+    # Generator of random training beats, one beat (1, 512, 1) per step, for the calibration
+    rng = np.random.RandomState(seed)
+    indexes = rng.choice(len(X_train), min(n_samples, len(X_train)), replace=False)
+
+    def generator():
+        for index in indexes:
+            yield [np.asarray(X_train[index:index + 1], dtype=np.float32)]
+
+    return generator
+
+
+def convert_tflite(model, X_train=None, quantize=True, n_samples=500):
+    """
+        Converts a Keras model of the current session to TFLite.
+
+        model: Keras model, built with the learning phase set to 0 (see dl_export.load_trained_model)
+        X_train: training beats for the representative dataset, needed when quantize is True
+        quantize: int8 post-training quantization of the weights and activations
+        n_samples: amount of beats of the representative dataset
+
+        Returns the TFLite flatbuffer
+    """
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), [model.input], [model.output])
+
+    if quantize:
+        if X_train is None:
+            raise ValueError('The int8 quantization needs the training beats for the representative dataset')
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset(X_train, n_samples))
+        # Fail instead of leaving float ops in the model
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    return converter.convert()
+
+
+def export_tflite(experiment, model_dir, X_train=None, output_filepath=None, model_params=None, quantize=True,
+                  n_samples=500):
+    """
+        Builds a trained experiment model and saves it as a TFLite model.
+
+        experiment: experiment of the model
+        model_dir: folder with the weights of the model (output_dir of train_dl)
+        X_train, quantize, n_samples: as in convert_tflite
+        output_filepath: TFLite file, by default label_int8.tflite (label_float.tflite) inside model_dir
+        model_params: arguments used to build the model
+
+        Returns the path of the TFLite model
+    """
+    model, model_label = load_trained_model(experiment, model_dir, model_params)
+
+    if output_filepath is None:
+        output_filepath = os.path.join(model_dir, model_label + ('_int8.tflite' if quantize else '_float.tflite'))
+
+    tflite_model = convert_tflite(model, X_train, quantize, n_samples)
+
+    K.clear_session()
+
+    with open(output_filepath, 'wb') as output:
+        output.write(tflite_model)
+    print('TFLite model saved to ' + output_filepath)
+
+    return output_filepath
+
+
+def predict_tflite(tflite_filepath, X):
+    """
+        Runs a TFLite model beat by beat.
+
+        tflite_filepath: TFLite model
+        X: beats (n, 512, 1)
+
+        Returns the predictions (n, 512, 1)
+    """
+    interpreter = tf.lite.Interpreter(model_path=tflite_filepath)
+    interpreter.allocate_tensors()
+
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+
+    # Integer input/output (converters that quantize them too) are (de)quantized here
+    input_scale, input_zero_point = input_details['quantization']
+    output_scale, output_zero_point = output_details['quantization']
+    integer_input = np.issubdtype(input_details['dtype'], np.integer)
+    integer_output = np.issubdtype(output_details['dtype'], np.integer)
+
+    y_pred = np.zeros((len(X),) + tuple(output_details['shape'][1:]), dtype=np.float32)
+
+    for i in range(len(X)):
+        beat = np.asarray(X[i:i + 1], dtype=np.float32)
+        if integer_input:
+            beat = np.round(beat / input_scale + input_zero_point).astype(input_details['dtype'])
+
+        interpreter.set_tensor(input_details['index'], beat)
+        interpreter.invoke()
+        prediction = interpreter.get_tensor(output_details['index'])
+
+        if integer_output:
+            prediction = (prediction.astype(np.float32) - output_zero_point) * output_scale
+
+        y_pred[i] = prediction[0]
+
+    return y_pred
+
+
+def _metrics(y, y_pred):
+    return [float(np.mean(SSD(y, y_pred))),
+            float(np.mean(MAD(y, y_pred))),
+            float(np.mean(PRD(y, y_pred))),
+            float(np.mean(COS_SIM(y, y_pred)))]
+
+
+def quantization_report(experiments, Dataset, results_dir='results', n_samples=500):
+    """
+        Exports the int8 TFLite model of each experiment and compares it with the float model.
+
+        The float predictions are the test results saved by the scheduler (see dl_scheduler) and the
+        models are taken from the experiment folders, where the TFLite models are saved too. The size
+        of the int8 model is compared with the float32 TFLite model of the same converter. A model
+        the converter can not quantize is reported with its error and the other ones continue.
+
+        experiments: list of experiment names
+        Dataset: [X_train, y_train, X_test, y_test]
+        results_dir: results folder of run_experiments
+        n_samples: amount of training beats of the representative dataset
+
+        Returns a dict {experiment: report}, also saved as results_dir/quantization_report.json
+    """
+    [X_train, y_train, X_test, y_test] = Dataset
+
+    report = {}
+
+    for experiment in experiments:
+        model_dir = job_dir(results_dir, experiment)
+        print('Quantizing the model of exp ' + experiment)
+
+        try:
+            float_filepath = export_tflite(experiment, model_dir, quantize=False)
+            tflite_filepath = export_tflite(experiment, model_dir, X_train, n_samples=n_samples)
+        except (ConverterError, RuntimeError) as e:
+            # Ops that the converter or the calibration can not quantize, other errors are raised
+            report[experiment] = {'status': 'failed', 'error': repr(e)}
+            print('The model of exp ' + experiment + ' could not be converted: ' + repr(e))
+            continue
+
+        [_, _, y_pred_float] = load_results(results_dir, experiment)
+        y_pred_int8 = predict_tflite(tflite_filepath, X_test)
+
+        report[experiment] = {'status': 'done',
+                              'tflite_filepath': tflite_filepath,
+                              'float_tflite_filepath': float_filepath,
+                              'float_size': os.path.getsize(float_filepath),
+                              'int8_size': os.path.getsize(tflite_filepath),
+                              # [SSD, MAD, PRD, COS_SIM] means against the clean beats
+                              'float': _metrics(y_test, y_pred_float),
+                              'int8': _metrics(y_test, y_pred_int8),
+                              # Quantization error, int8 against float predictions
+                              'int8_vs_float': _metrics(y_pred_float, y_pred_int8)}
+
+    with open(os.path.join(results_dir, REPORT_FILE), 'w') as output:
+        json.dump(report, output, indent=2)
+
+    tb = PrettyTable()
+    tb.field_names = ['Method/Model', 'Size (KB)', 'SSD (au)', 'MAD (au)', 'PRD (au)', 'Cosine Sim', 'SSD vs float']
+
+    for experiment in experiments:
+        result = report[experiment]
+        if result['status'] != 'done':
+            tb.add_row([experiment] + ['failed'] * 6)
+            continue
+
+        for version in ['float', 'int8']:
+            tb.add_row([experiment + ' ' + version,
+                        '{:.1f}'.format(result[version + '_size'] / 1024)] +
+                       ['{:.3f}'.format(value) for value in result[version]] +
+                       ['-' if version == 'float' else '{:.3f}'.format(result['int8_vs_float'][0])])
+
+    print(tb)
+
+    return report
@@ -0,0 +1,110 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the decimation
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+import pytest
+
+from utils.decimation import minmax, lttb, decimate, SignalPyramid
+
+
+# Positions of the spikes of the test signal
+SPIKES = [12345, 77777]
+
+
+def signal(n=100003):
+    # Random walk with two spikes
+    rng = np.random.RandomState(1)
+    y = np.cumsum(rng.normal(size=n))
+    for spike, sign in zip(SPIKES, [1, -1]):
+        if spike < n:
+            y[spike] += sign * 1000
+    return y
+
+
+@pytest.mark.parametrize('max_points', [2, 3, 100, 2001])
+def test_minmax(max_points):
+    y = signal()
+    index, values = minmax(y, max_points)
+
+    assert len(index) <= max_points
+    assert np.all(np.diff(index) >= 0)
+    np.testing.assert_array_equal(values, y[index])
+    # The extremes are kept
+    assert np.max(values) == np.max(y) and np.min(values) == np.min(y)
+
+
+@pytest.mark.parametrize('max_points', [3, 100, 2001])
+def test_lttb(max_points):
+    y = signal()
+    index, values = lttb(y, max_points)
+
+    assert len(index) == max_points
+    assert index[0] == 0 and index[-1] == len(y) - 1
+    assert np.all(np.diff(index) > 0)
+    np.testing.assert_array_equal(values, y[index])
+    # The spikes make the largest triangles of their buckets
+    if max_points > 3:
+        assert all(spike in index for spike in SPIKES)
+
+
+def test_short_signal():
+    y = signal(50)
+    for method in ['minmax', 'lttb']:
+        index, values = decimate(y, 100, method)
+        np.testing.assert_array_equal(index, np.arange(50))
+
+
+def test_max_points_validation():
+    y = signal(50)
+    with pytest.raises(ValueError):
+        minmax(y, 1)
+    with pytest.raises(ValueError):
+        lttb(y, 2)
+    with pytest.raises(ValueError):
+        SignalPyramid(y).envelope(max_points=0)
+    with pytest.raises(ValueError):
+        SignalPyramid(y).view(max_points=1)
+
+
+@pytest.mark.parametrize('min_length', [16, 1024, 10 ** 6])
+def test_pyramid_envelope(min_length):
+    y = signal()
+    pyramid = SignalPyramid(y, factor=4, min_length=min_length)
+    rng = np.random.RandomState(2)
+
+    for _ in range(100):
+        start = rng.randint(0, len(y))
+        stop = rng.randint(start + 1, len(y) + 10)
+        max_points = rng.randint(1, 3000)
+
+        x, lower, upper = pyramid.envelope(start, stop, max_points)
+        assert len(x) <= max_points and len(lower) == len(upper) == len(x)
+
+        # The envelope covers the samples of the range, the extremes of the range are kept
+        assert np.min(lower) <= np.min(y[start:stop]) and np.max(upper) >= np.max(y[start:stop])
+
+        if max_points >= 2:
+            assert len(pyramid.view(start, stop, max_points)[0]) <= max_points
+
+
+def test_pyramid_save_load(tmp_path):
+    y = signal(20000)
+    pyramid = SignalPyramid(y, factor=4, min_length=64)
+    filepath = str(tmp_path / 'pyramid.npz')
+    pyramid.save(filepath)
+
+    loaded = SignalPyramid.load(filepath, y)
+    for (mins, maxs), (loaded_mins, loaded_maxs) in zip(pyramid.levels, loaded.levels):
+        np.testing.assert_array_equal(mins, loaded_mins)
+        np.testing.assert_array_equal(maxs, loaded_maxs)
+
+    with pytest.raises(ValueError):
+        SignalPyramid.load(filepath, y[:100])
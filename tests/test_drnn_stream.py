@@ -0,0 +1,49 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the streaming DRNN
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from keras import backend as K
+
+from deepFilter.dl_models import DRRN_denoising
+from deepFilter.dl_streaming import DRNNStream
+
+
+@pytest.fixture(scope='module')
+def models():
+    # Stateful and whole sequence models with the same random weights
+    K.clear_session()
+    stream_model = DRRN_denoising(stateful=True)
+    model = DRRN_denoising()
+    model.set_weights(stream_model.get_weights())
+
+    yield model, DRNNStream(stream_model)
+
+    K.clear_session()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 512])
+def test_stream_matches_whole_sequence(models, chunk_size):
+    model, stream = models
+    x = np.random.RandomState(1).normal(size=(2, 512, 1)).astype(np.float32)
+
+    y = model.predict(x, batch_size=2)
+
+    for beat, y_beat in zip(x, y):
+        stream.reset()
+        beat = np.ravel(beat)
+        y_stream = np.concatenate([stream.process(beat[start:start + chunk_size])
+                                   for start in range(0, len(beat), chunk_size)])
+
+        np.testing.assert_allclose(y_stream, np.ravel(y_beat), atol=1e-5)
@@ -0,0 +1,72 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the evaluation
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+
+from utils.evaluation import group_by, StratifiedMetrics, bootstrap_means, compare_methods
+from utils.metrics import METRICS, MetricsTable
+
+
+def test_group_by():
+    rng = np.random.RandomState(1)
+    values = rng.normal(size=(3, 4, 500))
+    keys = rng.choice(['b', 'a', 'c'], size=500)
+
+    labels, counts, mean, std = group_by(values, keys)
+
+    assert list(labels) == ['a', 'b', 'c']
+    for i, label in enumerate(labels):
+        assert counts[i] == np.sum(keys == label)
+        np.testing.assert_allclose(mean[..., i], np.mean(values[..., keys == label], axis=-1), rtol=1e-12)
+        np.testing.assert_allclose(std[..., i], np.std(values[..., keys == label], axis=-1), rtol=1e-10)
+
+
+def test_stratified_snr():
+    rng = np.random.RandomState(1)
+    table = MetricsTable(['a', 'b'], rng.uniform(size=(2, len(METRICS), 200)))
+    snr = rng.uniform(-20, 25, size=200)
+
+    stratified = StratifiedMetrics(table, {'snr': snr}, by='snr')
+
+    # Buckets in value order, the SNR out of the edges in the first/last bucket
+    assert list(stratified.keys) == ['-15 to -10 dB', '-10 to -5 dB', '-5 to 0 dB', '0 to 5 dB', '5 to 10 dB',
+                                     '10 to 20 dB']
+    assert np.sum(stratified.counts) == 200
+
+    mean, _ = stratified.get('b', 'SSD')
+    np.testing.assert_allclose(mean[0], np.mean(table.get('b', 'SSD')[snr < -10]), rtol=1e-12)
+
+
+def test_bootstrap_means():
+    values = np.random.RandomState(1).normal(size=(3, 300))
+
+    # Reference, all the resamples drawn at once
+    indexes = np.random.RandomState(5).randint(0, 300, size=(1000, 300))
+    reference = np.mean(values[:, indexes], axis=-1).T
+
+    for block_size in [1, 64, 1000]:
+        np.testing.assert_allclose(bootstrap_means(values, 1000, seed=5, block_size=block_size), reference,
+                                   atol=1e-12)
+
+
+def test_compare_methods():
+    rng = np.random.RandomState(1)
+    reference = rng.uniform(1, 2, size=400)
+    values = np.stack([reference, reference * 1.001, reference * 1.5, reference])
+    table = MetricsTable(['same', 'close', 'worse', 'ref'], np.repeat(values[:, np.newaxis], len(METRICS), axis=1))
+
+    comparisons = {comparison['method']: comparison for comparison in compare_methods(table, 'ref', 'SSD')}
+
+    assert comparisons['same']['p_value'] == 1.0 and comparisons['same']['equivalent']
+    assert comparisons['close']['equivalent']
+    assert not comparisons['worse']['equivalent']
+    np.testing.assert_allclose(comparisons['worse']['diff'], 0.5, rtol=1e-12)
+    assert comparisons['worse']['diff_ci'][0] < 0.5 < comparisons['worse']['diff_ci'][1]
@@ -0,0 +1,98 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the metrics
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+import pytest
+
+from utils.metrics import SSD, MAD, PRD, COS_SIM, COS_SIM_chunks, METRICS, fused_metrics, compute_metrics,\
+                          RunningStats, accumulate
+
+
+def beats(n=300, seed=1):
+    # Clean beats and noisy predictions (n, 512, 1)
+    rng = np.random.RandomState(seed)
+    y = rng.normal(size=(n, 512, 1)) + 0.2
+    y_pred = y + 0.3 * rng.normal(size=y.shape)
+    return y, y_pred
+
+
+def test_cos_sim():
+    y, y_pred = beats()
+    y[0] = 0.0
+
+    # Row by row reference, 0 for a beat with zero norm
+    reference = [[0.0 if not np.any(a) else np.dot(np.ravel(a), np.ravel(b)) /
+                  (np.linalg.norm(a) * np.linalg.norm(b))] for a, b in zip(y, y_pred)]
+
+    np.testing.assert_allclose(COS_SIM(y, y_pred, chunk_size=64), reference, rtol=1e-12)
+
+    chunks = np.concatenate(list(COS_SIM_chunks((y[i:i + 100], y_pred[i:i + 100]) for i in range(0, len(y), 100))))
+    np.testing.assert_allclose(chunks, reference, rtol=1e-12)
+
+
+def test_cos_sim_sklearn():
+    cosine_similarity = pytest.importorskip('sklearn.metrics.pairwise').cosine_similarity
+    y, y_pred = beats(50)
+
+    reference = [cosine_similarity(a.reshape(1, -1), b.reshape(1, -1))[0] for a, b in zip(y, y_pred)]
+
+    np.testing.assert_allclose(COS_SIM(y, y_pred), reference, rtol=1e-12)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 64, 4096])
+def test_fused_metrics(chunk_size):
+    y, y_pred = beats()
+
+    values = fused_metrics(y, y_pred, chunk_size=chunk_size)
+
+    for metric, reference in zip(METRICS, [SSD(y, y_pred), MAD(y, y_pred), PRD(y, y_pred), COS_SIM(y, y_pred)]):
+        np.testing.assert_allclose(values[METRICS.index(metric)], np.ravel(reference), rtol=1e-10)
+
+
+def test_compute_metrics():
+    y, y_pred = beats()
+    _, y_pred_2 = beats(seed=2)
+
+    table = compute_metrics(['a', 'b'], [(y, y_pred), (y, y_pred_2)], chunk_size=100)
+
+    np.testing.assert_allclose(table.get('b', 'PRD'), PRD(y, y_pred_2), rtol=1e-10)
+    np.testing.assert_allclose(table.get('a', 'SSD'), SSD(y, y_pred), rtol=1e-10)
+
+
+def test_running_stats():
+    values = np.random.RandomState(1).gamma(2.0, 10.0, size=10000)
+    stats = RunningStats(0, 200, bins=1000)
+
+    # Batches of different sizes, an empty one too
+    for start, stop in [(0, 1), (1, 1), (1, 500), (500, 503), (503, 10000)]:
+        stats.update(values[start:stop])
+
+    assert stats.count == len(values)
+    np.testing.assert_allclose(stats.mean, np.mean(values), rtol=1e-12)
+    np.testing.assert_allclose(stats.std(), np.std(values), rtol=1e-10)
+    assert (stats.min, stats.max) == (np.min(values), np.max(values))
+    for q in [0.05, 0.5, 0.95]:
+        assert abs(stats.quantile(q) - np.quantile(values, q)) <= 0.2 + 1e-9
+
+
+def test_accumulate():
+    y, y_pred = beats()
+
+    accumulator = accumulate(((y[i:i + 32], y_pred[i:i + 32]) for i in range(0, len(y), 32)), y_mean=np.mean(y))
+
+    for metric, reference in zip(METRICS, [SSD(y, y_pred), MAD(y, y_pred), PRD(y, y_pred), COS_SIM(y, y_pred)]):
+        np.testing.assert_allclose(accumulator.mean_std(metric), (np.mean(reference), np.std(reference)),
+                                   rtol=1e-10)
+
+    # The PRD needs the mean of all the clean beats
+    accumulator = accumulate((y[i:i + 32], y_pred[i:i + 32]) for i in range(0, len(y), 32))
+    with pytest.raises(ValueError):
+        accumulator.mean_std('PRD')
@@ -0,0 +1,48 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the ONNX export
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('tf2onnx')
+pytest.importorskip('onnxruntime')
+
+from keras import backend as K
+
+from deepFilter.dl_export import EXPORT_PARAMS, load_trained_model, export_onnx
+from deepFilter.dl_onnx import OnnxModel
+from deepFilter.dl_pipeline import get_model
+
+EXPERIMENTS = ['DRNN', 'FCN-DAE', 'Vanilla L', 'Vanilla NL', 'Multibranch LANL', 'Multibranch LANLD']
+
+
+@pytest.mark.parametrize('experiment', EXPERIMENTS)
+def test_onnx_equivalence(experiment, tmp_path):
+    # Model with its random initial weights, saved as the trained weights of the experiment
+    K.clear_session()
+    model, model_label = get_model(experiment, dict(EXPORT_PARAMS.get(experiment, {})))
+    model.save_weights(os.path.join(str(tmp_path), model_label + '_weights.best.hdf5'))
+
+    x = np.random.RandomState(1).normal(size=(8, 512, 1)).astype(np.float32)
+
+    model, _ = load_trained_model(experiment, str(tmp_path))
+    y = model.predict(x, batch_size=4)
+
+    onnx_filepath = export_onnx(experiment, str(tmp_path))
+    y_onnx = OnnxModel(onnx_filepath).predict(x, batch_size=4)
+
+    K.clear_session()
+
+    assert y_onnx.shape == y.shape
+    np.testing.assert_allclose(y_onnx, y, atol=1e-4)
@@ -0,0 +1,51 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the structured pruning
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from keras import backend as K
+
+from deepFilter.dl_models import deep_filter_I_LANL
+from deepFilter.dl_pruning import select_channels
+
+
+def test_hard_pruning_keeps_two_branches():
+    # Prunes 90 % of the channels until nothing is left to prune, every module keeps two branches
+    # and the model can still be built
+    rng = np.random.RandomState(1)
+    branch_filters = [[8] * 8 for _ in range(6)]
+
+    for _ in range(30):
+        scores = [rng.uniform(size=sum(filters)) for filters in branch_filters]
+        new_filters, keep = select_channels(branch_filters, scores, 0.9, min_branches=2)
+
+        for filters, module_keep in zip(new_filters, keep):
+            assert sum(f > 0 for f in filters) >= 2
+            assert len(module_keep) == sum(filters)
+
+        if new_filters == branch_filters:
+            break
+        branch_filters = new_filters
+
+    assert all(sum(f > 0 for f in filters) == 2 for filters in branch_filters)
+
+    K.clear_session()
+    model = deep_filter_I_LANL(branch_filters=branch_filters)
+    assert model.predict(np.zeros((1, 512, 1), dtype=np.float32)).shape == (1, 512, 1)
+    K.clear_session()
+
+
+def test_min_branches_below_two():
+    with pytest.raises(ValueError):
+        select_channels([[1] * 8], [np.ones(8)], 0.5, min_branches=1)
@@ -0,0 +1,49 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the results store
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+
+import numpy as np
+import pytest
+
+from utils.metrics import SSD, PRD
+from utils.results_store import ResultsStore
+
+
+def test_add_method(tmp_path):
+    rng = np.random.RandomState(1)
+    X_test, y_test = rng.normal(size=(2, 40, 512, 1))
+    y_pred = y_test + 0.1 * rng.normal(size=y_test.shape)
+
+    store = ResultsStore(str(tmp_path))
+    store.add_method('Method A', y_pred, X_test, y_test)
+
+    assert store.methods() == ['Method A']
+    np.testing.assert_allclose(store.metric('Method A', 'SSD'), SSD(y_test, y_pred), rtol=1e-10)
+    np.testing.assert_allclose(store.metric('Method A', 'PRD'), PRD(y_test, y_pred), rtol=1e-10)
+
+
+def test_add_method_wrong_shape(tmp_path):
+    rng = np.random.RandomState(1)
+    X_test, y_test = rng.normal(size=(2, 40, 512, 1))
+
+    store = ResultsStore(str(tmp_path))
+    store.add_method('Method A', y_test, X_test, y_test)
+
+    # Neither a new method folder nor a change of the existing method
+    with pytest.raises(ValueError):
+        store.add_method('Method B', y_test[:30])
+    with pytest.raises(ValueError):
+        store.add_method('Method A', y_test[:30])
+
+    assert store.methods() == ['Method A']
+    assert not os.path.exists(os.path.join(str(tmp_path), 'methods', 'Method_B'))
+    assert store.y_pred('Method A').shape == y_test.shape
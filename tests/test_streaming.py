@@ -0,0 +1,55 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Tests of the sliding window inference
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+import pytest
+
+from deepFilter.dl_streaming import WINDOW, estimate_margin, stream_denoise, denoise_signal
+
+# A FIR filter stands for a convolutional model, 'same' convolution with zero padding of each window
+KERNEL = np.random.RandomState(2).normal(size=41)
+
+
+def fir_predict(x):
+    return np.stack([np.convolve(window, KERNEL, mode='same') for window in x[:, :, 0]])[:, :, np.newaxis]
+
+
+def test_estimate_margin():
+    assert estimate_margin(fir_predict) == len(KERNEL) // 2
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 511, 512, 3000, 10000])
+@pytest.mark.parametrize('length', [300, 512, 5000])
+def test_center_matches_whole_signal(chunk_size, length):
+    signal = np.random.RandomState(1).normal(size=length).astype(np.float32)
+    chunks = (signal[start:start + chunk_size] for start in range(0, length, chunk_size))
+
+    y = np.concatenate(list(stream_denoise(chunks, fir_predict, margin=len(KERNEL) // 2, mode='center')))
+
+    np.testing.assert_allclose(y, np.convolve(signal, KERNEL, mode='same'), atol=1e-4)
+
+
+def test_ola_pointwise_model():
+    # The Hann weights add up to one, a model without receptive field is reproduced exactly
+    signal = np.random.RandomState(1).normal(size=3333).astype(np.float32)
+
+    y = denoise_signal(signal, lambda x: 2 * x, mode='ola', chunk_size=700)
+
+    assert len(y) == len(signal)
+    np.testing.assert_allclose(y, 2 * signal, atol=1e-5)
+
+
+def test_auto_mode():
+    signal = np.random.RandomState(1).normal(size=2 * WINDOW + 77).astype(np.float32)
+
+    y = denoise_signal(signal, fir_predict, chunk_size=256)
+
+    np.testing.assert_allclose(y, np.convolve(signal, KERNEL, mode='same'), atol=1e-4)
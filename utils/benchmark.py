@@ -0,0 +1,182 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Latency and throughput benchmark
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+import time
+import platform
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from digitalFilters.dfilters import FIRRemoveBL, FIRRemoveHF, IIRRemoveBL, IIRRemoveHF
+
+# Every method is given as a predict function (beats (n, 512, 1) -> (n, 512, 1)). For each batch
+# size the function is called a few times to warm up (graph building, memory allocation, caches)
+# and then timed batch by batch, so the percentiles are of the steady state latency and nothing
+# else (model building, data loading) is measured.
+#
+# The results are a list of dicts, one per method, thread count and batch size:
+#   method, threads, batch_size, batches, latency_p50/p95/p99 (ms per batch),
+#   beat_latency_p50/p95/p99 (ms per beat) and throughput (beats/s)
+
+PERCENTILES = [50, 95, 99]
+
+
+class FilterPredict:
+    """
+        Predict function of the classical filters, same processing as FIR_test_Dataset and
+        IIR_test_Dataset. The beats of a batch are filtered by threads threads, close shuts the
+        threads down.
+
+        method: 'FIR' or 'IIR'
+        threads: threads filtering the beats of a batch
+    """
+
+    def __init__(self, method, threads=1):
+        if method not in ['FIR', 'IIR']:
+            raise ValueError('Unknown filter ' + str(method))
+
+        self.method = method
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    def filter_beat(self, beat):
+        # Same parameters as the test
+        Fs = 360
+        Fc_l = 0.67
+        Fc_h = 150.0
+
+        if self.method == 'FIR':
+            signal, _ = FIRRemoveBL(beat, Fs, Fc_l, 4.5)
+            signal, _ = FIRRemoveHF(signal, Fs, Fc_h, 4.5)
+            return signal
+
+        signal = IIRRemoveBL(beat, Fs, Fc_l)
+        return IIRRemoveHF(signal, Fs, Fc_h)
+
+    def __call__(self, x):
+        beats = [np.ravel(beat).tolist() for beat in x]
+        if self.executor is None:
+            y = [self.filter_beat(beat) for beat in beats]
+        else:
+            y = list(self.executor.map(self.filter_beat, beats))
+        return np.array(y)[:, :, np.newaxis]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def time_batches(predict, x, batch_size, warmup=3, repeats=50, max_seconds=60):
+    """
+        Steady state latency of predict on batches of x.
+
+        predict: function (n, 512, 1) -> (n, 512, 1)
+        x: beats, the batches go through them cyclically
+        batch_size: beats per batch
+        warmup: calls before the measurement, not timed
+        repeats: timed calls
+        max_seconds: the warm up stops after max_seconds (at least 1 call) and the measurement too
+                     (at least 3 calls), for the slow methods (the FIR filter designs its filter on
+                     every beat)
+
+        Returns the wall time of each timed call in seconds
+    """
+    n_batches = max(len(x) // batch_size, 1)
+    batches = [np.asarray(x[i * batch_size:(i + 1) * batch_size], dtype=np.float32) for i in range(n_batches)]
+
+    start = time.perf_counter()
+    for i in range(warmup):
+        predict(batches[i % n_batches])
+
+        if time.perf_counter() - start > max_seconds:
+            break
+
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        predict(batches[i % n_batches])
+        times.append(time.perf_counter() - start)
+
+        if len(times) >= 3 and sum(times) > max_seconds:
+            break
+
+    return np.array(times)
+
+
+def latency_stats(times, batch_size):
+    # Percentiles of the batch and per beat latency (ms) and the throughput (beats/s) of timed calls
+    stats = {'batches': len(times)}
+
+    for percentile, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+        stats['latency_p' + str(percentile)] = 1000 * float(value)
+        stats['beat_latency_p' + str(percentile)] = 1000 * float(value) / batch_size
+
+    stats['throughput'] = batch_size * len(times) / float(np.sum(times))
+
+    return stats
+
+
+def benchmark_method(method, predict, x, batch_sizes=(1, 32, 256), threads=None, warmup=3, repeats=50,
+                     max_seconds=60):
+    """
+        Benchmarks a method on several batch sizes.
+
+        method: method name
+        predict: predict function of the method
+        x: beats
+        batch_sizes: batch sizes of the sweep
+        threads: threads the predict function was built with, only saved in the results
+        warmup, repeats, max_seconds: as in time_batches
+
+        Returns a list with a result dict per batch size
+    """
+    results = []
+
+    for batch_size in batch_sizes:
+        times = time_batches(predict, x, batch_size, warmup, repeats, max_seconds)
+        result = {'method': method, 'threads': threads, 'batch_size': batch_size}
+        result.update(latency_stats(times, batch_size))
+        results.append(result)
+
+        print(method + ', ' + str(threads) + ' threads, batch ' + str(batch_size) +
+              ': p50 {:.2f} ms, p99 {:.2f} ms, {:.0f} beats/s'.format(result['latency_p50'], result['latency_p99'],
+                                                                       result['throughput']))
+
+    return results
+
+
+def environment():
+    # Description of the machine, saved with the results
+    return {'date': datetime.now().isoformat(timespec='seconds'),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__}
+
+
+def save_benchmark(filepath, results, settings=None):
+    # Saves the results and the environment as JSON, written and renamed
+    data = {'environment': environment(), 'settings': settings or {}, 'results': results}
+
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as output:
+        json.dump(data, output, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+def load_benchmark(filepath):
+    # {'environment', 'settings', 'results'} saved by save_benchmark
+    with open(filepath, 'r') as input:
+        return json.load(input)
@@ -0,0 +1,221 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Decimation of long signals for plotting
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import numpy as np
+
+# A plot can not show more points than the pixels of the figure, a long signal is reduced to a few
+# thousand points before plotting:
+#
+#   'minmax': the signal is split in buckets and the minimum and maximum of each bucket are kept, in
+#             their order, so every peak (R waves, artifacts) is still drawn
+#   'lttb':   Largest Triangle Three Buckets, one point per bucket, the one that forms the largest
+#             triangle with the point kept on the previous bucket and the mean of the next one
+#
+# SignalPyramid keeps the min/max envelopes of a record at several resolutions, the view of any
+# range of the record reads at most max_points values of the right level, so zooming across a 24 h
+# record does not go through its samples again.
+
+
+def minmax(y, max_points):
+    """
+        Min/max decimation.
+
+        y: 1D signal
+        max_points: maximum amount of points, two per bucket (at least 2)
+
+        Returns the indexes of the kept samples and their values
+    """
+    if max_points < 2:
+        raise ValueError('The min/max decimation needs max_points >= 2, got ' + str(max_points))
+
+    y = np.ravel(y)
+    if len(y) <= max_points:
+        return np.arange(len(y)), y
+
+    bucket = int(np.ceil(len(y) / (max_points // 2)))
+    starts = np.arange(0, len(y), bucket)
+
+    # Position of the minimum and maximum of each bucket, the last one may be shorter
+    n_full = len(y) // bucket
+    blocks = np.reshape(y[:n_full * bucket], (n_full, bucket))
+    arg_min = np.argmin(blocks, axis=1)
+    arg_max = np.argmax(blocks, axis=1)
+
+    if n_full < len(starts):
+        tail = y[n_full * bucket:]
+        arg_min = np.append(arg_min, np.argmin(tail))
+        arg_max = np.append(arg_max, np.argmax(tail))
+
+    index = np.stack([np.minimum(arg_min, arg_max), np.maximum(arg_min, arg_max)], axis=1) + starts[:, np.newaxis]
+    index = np.ravel(index)
+
+    return index, y[index]
+
+
+def lttb(y, max_points):
+    """
+        Largest Triangle Three Buckets decimation.
+
+        y: 1D signal
+        max_points: amount of points (at least 3, the first, the last and one per bucket)
+
+        Returns the indexes of the kept samples and their values
+    """
+    if max_points < 3:
+        raise ValueError('The LTTB decimation needs max_points >= 3, got ' + str(max_points))
+
+    y = np.ravel(y)
+    if len(y) <= max_points:
+        return np.arange(len(y)), y
+
+    # The first and last samples are always kept, the rest is split in max_points - 2 buckets
+    edges = np.linspace(1, len(y) - 1, max_points - 1).astype(np.int64)
+
+    index = np.zeros(max_points, dtype=np.int64)
+    index[-1] = len(y) - 1
+
+    for i in range(max_points - 2):
+        start, stop = edges[i], edges[i + 1]
+
+        # Mean of the next bucket (the last sample for the last bucket)
+        if i + 2 < len(edges):
+            next_x = (edges[i + 1] + edges[i + 2] - 1) / 2
+            next_y = np.mean(y[edges[i + 1]:edges[i + 2]])
+        else:
+            next_x, next_y = len(y) - 1, y[-1]
+
+        previous_x, previous_y = index[i], y[index[i]]
+
+        x = np.arange(start, stop)
+        area = np.abs((previous_x - next_x) * (y[start:stop] - previous_y) -
+                      (previous_x - x) * (next_y - previous_y))
+        index[i + 1] = start + np.argmax(area)
+
+    return index, y[index]
+
+
+def decimate(y, max_points, method='minmax'):
+    # Indexes and values of the decimated signal, method 'minmax' or 'lttb'
+    if method == 'minmax':
+        return minmax(y, max_points)
+    if method == 'lttb':
+        return lttb(y, max_points)
+
+    raise ValueError('Unknown decimation ' + str(method))
+
+
+class SignalPyramid:
+    """
+        Min/max envelopes of a signal at several resolutions, level k has buckets of factor ** k
+        samples (level 0 is the signal itself, it is not copied).
+
+        signal: 1D array or np.memmap
+        factor: samples per bucket of each level from the previous one
+        min_length: the last level has at most min_length buckets
+    """
+
+    def __init__(self, signal, factor=4, min_length=1024, levels=None):
+        self.signal = np.ravel(signal)
+        self.factor = factor
+
+        if levels is None:
+            levels = []
+            mins = maxs = self.signal
+            while len(mins) > min_length:
+                starts = np.arange(0, len(mins), factor)
+                mins = np.minimum.reduceat(mins, starts)
+                maxs = np.maximum.reduceat(maxs, starts)
+                levels.append((mins, maxs))
+
+        self.levels = levels
+
+    def envelope(self, start=0, stop=None, max_points=2000):
+        """
+            Envelope of the samples from start to stop with at most max_points buckets, from the
+            finest level that fits. If even the last level has too many buckets in the range, its
+            buckets are merged.
+
+            Returns the positions (samples, bucket centers) and the lower and upper values, the
+            samples themselves (lower and upper are the same) if there are less than max_points
+        """
+        if max_points < 1:
+            raise ValueError('The envelope needs max_points >= 1, got ' + str(max_points))
+
+        stop = len(self.signal) if stop is None else min(stop, len(self.signal))
+        start = max(start, 0)
+
+        if stop - start <= max_points:
+            y = np.asarray(self.signal[start:stop])
+            return np.arange(start, stop), y, y
+
+        # The signal is the level with buckets of 1 sample, the range covers the buckets from first
+        # to last (start and stop are not aligned to the buckets)
+        levels = [(self.signal, self.signal)] + list(self.levels)
+        level = 0
+        bucket = 1
+        while level + 1 < len(levels) and int(np.ceil(stop / bucket)) - start // bucket > max_points:
+            level += 1
+            bucket *= self.factor
+
+        first = start // bucket
+        last = int(np.ceil(stop / bucket))
+        mins = np.asarray(levels[level][0][first:last])
+        maxs = np.asarray(levels[level][1][first:last])
+        edges = np.arange(first, last + 1) * bucket
+
+        if last - first > max_points:
+            group = int(np.ceil((last - first) / max_points))
+            starts = np.arange(0, last - first, group)
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+            edges = edges[np.append(starts, last - first)]
+
+        return (edges[:-1] + edges[1:]) / 2, mins, maxs
+
+    def view(self, start=0, stop=None, max_points=2000):
+        """
+            Points to plot the samples from start to stop as a line.
+
+            Returns the positions (samples) and values of at most max_points points (at least 2),
+            the min and max of each bucket of the envelope
+        """
+        if max_points < 2:
+            raise ValueError('The view needs max_points >= 2, got ' + str(max_points))
+
+        # Two points per bucket, the samples themselves if they fit
+        length = (len(self.signal) if stop is None else min(stop, len(self.signal))) - max(start, 0)
+        x, lower, upper = self.envelope(start, stop, max_points if length <= max_points else max_points // 2)
+        if lower is upper:
+            return x, lower
+
+        return np.repeat(x, 2), np.ravel(np.stack([lower, upper], axis=1))
+
+    def save(self, filepath):
+        # Saves the levels (not the signal) in a .npz file
+        arrays = {'factor': self.factor, 'length': len(self.signal)}
+        for level, (mins, maxs) in enumerate(self.levels):
+            arrays['min_' + str(level)] = mins
+            arrays['max_' + str(level)] = maxs
+
+        np.savez(filepath, **arrays)
+
+    @classmethod
+    def load(cls, filepath, signal):
+        # Pyramid saved with save, signal is the same signal (it can be a np.memmap)
+        with np.load(filepath) as data:
+            if int(data['length']) != np.size(signal):
+                raise ValueError('The pyramid is of a signal of ' + str(int(data['length'])) + ' samples, got ' +
+                                 str(np.size(signal)))
+
+            n_levels = len([name for name in data.files if name.startswith('min_')])
+            levels = [(data['min_' + str(level)], data['max_' + str(level)]) for level in range(n_levels)]
+
+            return cls(signal, int(data['factor']), levels=levels)
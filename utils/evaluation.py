@@ -0,0 +1,236 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Evaluation of the per beat metrics
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import _pickle as pickle
+
+import numpy as np
+from scipy.stats import wilcoxon
+
+from utils.metrics import METRICS
+
+# Data_Preparation saves a test index with the record, pathology group, beat number, noise
+# amplitude (0.2 to 2 times the ECG peak to peak amplitude) and SNR (power of the beat over power of
+# the added noise, dB) of each test beat. The per beat metrics of the MetricsTable (or the results
+# store) are split by one of these keys with a single sort of the beats, the statistics of all the
+# methods and metrics are computed at once.
+
+STRATA = ['record', 'group', 'noise', 'snr']
+
+# Edges of the noise amplitude and SNR (dB) buckets, the values out of them go to the first/last one
+NOISE_EDGES = [0.2, 0.5, 1.0, 1.5, 2.0]
+SNR_EDGES = [-15, -10, -5, 0, 5, 10, 20]
+
+
+def load_test_index(filepath='data/test_index.pkl'):
+    # dict of arrays (one value per test beat): record, group, beat, noise_amplitude, snr
+    with open(filepath, 'rb') as input:
+        return pickle.load(input)
+
+
+def buckets(values, edges, label_format='{:g} to {:g}'):
+    # Bucket of each value and the labels of the buckets, e.g. '0.5 to 1'
+    bucket = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+    labels = np.array([label_format.format(low, high) for low, high in zip(edges[:-1], edges[1:])])
+
+    return bucket, labels
+
+
+def strata_keys(test_index, by):
+    # Key of each beat for a stratification of STRATA and the labels of the keys (None if the keys
+    # are the labels). The buckets are numbered so they are sorted by value
+    if by == 'record':
+        return np.asarray(test_index['record']), None
+    if by == 'group':
+        return np.asarray(test_index['group']), None
+    if by == 'noise':
+        return buckets(test_index['noise_amplitude'], NOISE_EDGES)
+    if by == 'snr':
+        if 'snr' not in test_index:
+            raise ValueError('The test index has no SNR, run Data_Preparation again')
+        return buckets(test_index['snr'], SNR_EDGES, '{:g} to {:g} dB')
+
+    raise ValueError('Unknown stratification ' + str(by) + ', use one of ' + str(STRATA))
+
+
+def group_by(values, keys):
+    """
+        Count, mean and std of the values of each key.
+
+        values: array (..., beats)
+        keys: key of each beat (beats,)
+
+        Returns the sorted keys, the counts (keys,) and the mean and std (..., keys)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.shape[-1] != len(keys):
+        raise ValueError('There are ' + str(values.shape[-1]) + ' beats and ' + str(len(keys)) + ' keys')
+
+    labels, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+    # Beats sorted by key, each key is a contiguous segment reduced at once
+    order = np.argsort(inverse, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sorted_values = values[..., order]
+
+    mean = np.add.reduceat(sorted_values, starts, axis=-1) / counts
+    # Population std, as np.std in generate_table
+    residual = sorted_values - np.repeat(mean, counts, axis=-1)
+    std = np.sqrt(np.add.reduceat(np.square(residual), starts, axis=-1) / counts)
+
+    return labels, counts, mean, std
+
+
+class StratifiedMetrics:
+    """
+        Metrics of several methods by groups of beats, mean[method, metric, key].
+
+        metrics_table: MetricsTable of the test set (same beat order as the test index)
+        test_index: see load_test_index
+        by: 'record', 'group', 'noise' or 'snr'
+    """
+
+    def __init__(self, metrics_table, test_index, by='record'):
+        self.methods = list(metrics_table.methods)
+        self.metrics = list(METRICS)
+        self.by = by
+
+        keys, labels = strata_keys(test_index, by)
+        self.keys, self.counts, self.mean, self.std = group_by(metrics_table.values, keys)
+        if labels is not None:
+            self.keys = labels[self.keys]
+
+    def get(self, method, metric):
+        # Mean and std of each key for a method and a metric
+        index = (self.methods.index(method), self.metrics.index(metric))
+        return self.mean[index], self.std[index]
+
+    def degradation(self, method, reference, metric='SSD'):
+        """
+            Relative degradation of a method with respect to a reference method on each key, e.g.
+            0.2 is a 20 % worse mean (higher SSD, MAD and PRD, lower COS_SIM).
+
+            Returns the keys and degradations sorted from the worst
+        """
+        mean, _ = self.get(method, metric)
+        reference_mean, _ = self.get(reference, metric)
+
+        degradation = (mean - reference_mean) / np.maximum(np.abs(reference_mean), 1e-12)
+        if metric == 'COS_SIM':
+            degradation = -degradation
+
+        order = np.argsort(-degradation, kind='stable')
+
+        return self.keys[order], degradation[order]
+
+
+# Paired comparison of methods
+#
+# The methods are compared on the same test beats, so the bootstrap resamples the beats once and
+# every method is evaluated on the same resample. A resample is a row of an index matrix
+# (resamples, beats), it is turned into a matrix with the times each beat was drawn and the means
+# of all the methods are one matrix product, for a block of resamples at a time.
+
+
+def bootstrap_means(values, n_resamples=2000, seed=1, block_size=256):
+    """
+        Bootstrap distribution of the mean of each row of values, the same resamples for all the rows.
+
+        values: (rows, beats) array
+        n_resamples: amount of resamples
+        seed: seed of the resamples
+        block_size: resamples drawn at once, it only limits the memory (the result does not depend on it)
+
+        Returns a (n_resamples, rows) array
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_beats = values.shape[1]
+
+    rng = np.random.RandomState(seed)
+    means = np.zeros((n_resamples, len(values)), dtype=np.float64)
+
+    for start in range(0, n_resamples, block_size):
+        size = min(block_size, n_resamples - start)
+        indexes = rng.randint(0, n_beats, size=(size, n_beats))
+
+        # Times each beat is drawn in each resample, (size, beats)
+        offsets = indexes + n_beats * np.arange(size)[:, np.newaxis]
+        counts = np.bincount(offsets.ravel(), minlength=size * n_beats).reshape(size, n_beats)
+
+        means[start:start + size] = np.dot(counts.astype(np.float64), values.T) / n_beats
+
+    return means
+
+
+def _holm(p_values):
+    # Holm-Bonferroni adjusted p-values
+    p_values = np.asarray(p_values, dtype=np.float64)
+    order = np.argsort(p_values)
+    adjusted = np.maximum.accumulate(p_values[order] * (len(p_values) - np.arange(len(p_values))))
+    result = np.empty_like(adjusted)
+    result[order] = np.minimum(adjusted, 1.0)
+
+    return result
+
+
+def compare_methods(metrics_table, reference, metric='SSD', methods=None, n_resamples=2000, confidence=0.95,
+                    margin=0.05, seed=1):
+    """
+        Paired comparison of several methods against a reference method on a metric: bootstrap
+        confidence interval of the mean of each method and of its relative difference with the
+        reference, and Wilcoxon signed-rank test of the per beat values.
+
+        metrics_table: MetricsTable of the test set
+        reference: method of the table the others are compared with
+        metric: metric of METRICS
+        methods: methods to compare, all the others of the table if None
+        n_resamples: bootstrap resamples
+        confidence: confidence level of the intervals
+        margin: a method is equivalent to the reference if the interval of the relative difference
+                of the means is inside (-margin, margin)
+        seed: as in bootstrap_means
+
+        Returns a list with a dict per method: method, mean, ci, diff, diff_ci, p_value (Holm
+        adjusted for the amount of methods) and equivalent
+    """
+    if methods is None:
+        methods = [method for method in metrics_table.methods if method != reference]
+
+    reference_values = np.ravel(metrics_table.get(reference, metric))
+    values = np.stack([np.ravel(metrics_table.get(method, metric)) for method in methods])
+
+    means = bootstrap_means(np.concatenate([values, reference_values[np.newaxis]]), n_resamples, seed)
+    reference_means = means[:, -1:]
+    diffs = (means[:, :-1] - reference_means) / np.maximum(np.abs(reference_means), 1e-12)
+
+    alpha = 1 - confidence
+    ci = np.percentile(means[:, :-1], [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    diff_ci = np.percentile(diffs, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+    p_values = []
+    for method_values in values:
+        if np.all(method_values == reference_values):
+            p_values.append(1.0)
+        else:
+            p_values.append(wilcoxon(method_values, reference_values).pvalue)
+    p_values = _holm(p_values)
+
+    reference_mean = np.mean(reference_values)
+    comparisons = []
+    for i, method in enumerate(methods):
+        comparisons.append({'method': method,
+                            'mean': float(np.mean(values[i])),
+                            'ci': (float(ci[0, i]), float(ci[1, i])),
+                            'diff': float((np.mean(values[i]) - reference_mean) / max(abs(reference_mean), 1e-12)),
+                            'diff_ci': (float(diff_ci[0, i]), float(diff_ci[1, i])),
+                            'p_value': float(p_values[i]),
+                            'equivalent': bool(-margin < diff_ci[0, i] and diff_ci[1, i] < margin)})
+
+    return comparisons
@@ -9,8 +9,10 @@
 #
 #===========================================================
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+
 
 def SSD(y, y_pred):
     return np.sum(np.square(y - y_pred), axis=1)  # axis 1 is the signal dimension
@@ -20,26 +22,257 @@ def MAD(y, y_pred):
     return np.max(np.abs(y - y_pred), axis=1) # axis 1 is the signal dimension
 
 
-def PRD(y, y_pred):
+def PRD(y, y_pred, y_mean=None):
+    # y_mean: mean of the clean signals, np.mean(y) by default (the mean of the whole test set, pass
+    # it to compute the PRD of a part of the test set with the same reference)
+    if y_mean is None:
+        y_mean = np.mean(y)
+
     N = np.sum(np.square(y_pred - y), axis=1)
-    D = np.sum(np.square(y_pred - np.mean(y)), axis=1)
+    D = np.sum(np.square(y_pred - y_mean), axis=1)
 
     PRD = np.sqrt(N/D) * 100
 
     return PRD
 
 
-def COS_SIM(y, y_pred):
-    cos_sim = []
+def _cos_sim(y, y_pred):
+    # Row-wise cosine similarity of a block of beats, 0 for the beats with zero norm (as sklearn)
+    y = np.reshape(y, (len(y), -1)).astype(np.float64)
+    y_pred = np.reshape(y_pred, (len(y_pred), -1)).astype(np.float64)
+
+    dot = np.einsum('ij,ij->i', y, y_pred)
+    norms = np.sqrt(np.einsum('ij,ij->i', y, y)) * np.sqrt(np.einsum('ij,ij->i', y_pred, y_pred))
+
+    cos_sim = np.zeros(len(y), dtype=np.float64)
+    np.divide(dot, norms, out=cos_sim, where=norms > 0)
+
+    return cos_sim
+
 
-    y = np.squeeze(y, axis=-1)
-    y_pred = np.squeeze(y_pred, axis=-1)
+def COS_SIM(y, y_pred, chunk_size=4096):
+    # Cosine similarity of each beat, (n, 1) as the other metrics
+    # The beats are processed in blocks of chunk_size, so y and y_pred can be np.memmap arrays
+    # bigger than the memory
+    cos_sim = np.zeros((len(y), 1), dtype=np.float64)
 
-    for idx in range(len(y)):
-        kl_temp = cosine_similarity(y[idx].reshape(1, -1), y_pred[idx].reshape(1, -1))
-        cos_sim.append(kl_temp)
+    for start in range(0, len(y), chunk_size):
+        cos_sim[start:start + chunk_size, 0] = _cos_sim(y[start:start + chunk_size],
+                                                        y_pred[start:start + chunk_size])
 
-    cos_sim = np.array(cos_sim)
     return cos_sim
 
 
+def COS_SIM_chunks(chunks):
+    # Cosine similarity of the beats of an iterable of (y, y_pred) blocks, yields a (n, 1) array per
+    # block, for results that are produced (or read) block by block
+    for y, y_pred in chunks:
+        yield _cos_sim(y, y_pred)[:, np.newaxis]
+
+
+# Fused metrics engine
+#
+# SSD, MAD, PRD and COS_SIM of a method are computed in one pass over its beats: for every block of
+# chunk_size beats the residual is computed once and the four metrics are reductions of the block.
+# The methods are computed in parallel threads (numpy releases the GIL in the reductions).
+
+METRICS = ['SSD', 'MAD', 'PRD', 'COS_SIM']
+
+
+def _mean(y, chunk_size):
+    # Mean of all the samples, by blocks so y can be a np.memmap
+    total = 0.0
+    for start in range(0, len(y), chunk_size):
+        total += np.sum(y[start:start + chunk_size], dtype=np.float64)
+    return total / np.size(y)
+
+
+def fused_metrics(y, y_pred, chunk_size=4096, y_mean=None):
+    # Returns a (4, n) array with the SSD, MAD, PRD and COS_SIM of each beat, same values as the
+    # functions above
+    # y_mean: as in PRD
+    values = np.zeros((len(METRICS), len(y)), dtype=np.float64)
+
+    # PRD uses the mean of the whole y
+    if y_mean is None:
+        y_mean = _mean(y, chunk_size)
+
+    for start in range(0, len(y), chunk_size):
+        y_block = np.reshape(y[start:start + chunk_size], (-1, np.size(y[0]))).astype(np.float64)
+        y_pred_block = np.reshape(y_pred[start:start + chunk_size], (-1, np.size(y_pred[0]))).astype(np.float64)
+        block = slice(start, start + len(y_block))
+
+        residual = y_pred_block - y_block
+        ssd = np.einsum('ij,ij->i', residual, residual)
+
+        # The residual buffer is reused for the PRD denominator
+        np.abs(residual, out=residual)
+        values[1, block] = np.max(residual, axis=1)
+        np.subtract(y_pred_block, y_mean, out=residual)
+        prd_denominator = np.einsum('ij,ij->i', residual, residual)
+
+        values[0, block] = ssd
+        values[2, block] = np.sqrt(ssd / prd_denominator) * 100
+
+        norms = np.sqrt(np.einsum('ij,ij->i', y_block, y_block) * np.einsum('ij,ij->i', y_pred_block, y_pred_block))
+        np.divide(np.einsum('ij,ij->i', y_block, y_pred_block), norms, out=values[3, block], where=norms > 0)
+
+    return values
+
+
+class MetricsTable:
+    """
+        Metrics of several methods, values[method, metric, beat].
+
+        methods: method names
+        values: (methods, metrics, beats) array, the metrics in the METRICS order
+    """
+
+    def __init__(self, methods, values):
+        self.methods = list(methods)
+        self.metrics = list(METRICS)
+        self.values = values
+
+    def get(self, method, metric):
+        # Values of a method and a metric, (n, 1) as the metric functions
+        return self.values[self.methods.index(method), self.metrics.index(metric)][:, np.newaxis]
+
+    def metric_values(self):
+        # [metric][method] lists of (n, 1) arrays, the format of visualization.generate_table
+        return [[self.get(method, metric) for method in self.methods] for metric in self.metrics]
+
+
+def compute_metrics(methods, results, chunk_size=4096, n_threads=None):
+    """
+        Computes the SSD, MAD, PRD and COS_SIM of several methods at once.
+
+        methods: method names
+        results: list of (y, y_pred) of each method, arrays or np.memmap (n, 512, 1), the same n for all
+        chunk_size: beats per block
+        n_threads: threads computing the methods, one per method by default
+
+        Returns a MetricsTable
+    """
+    n_threads = n_threads or len(methods)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        values = list(executor.map(lambda result: fused_metrics(result[0], result[1], chunk_size), results))
+
+    return MetricsTable(methods, np.stack(values))
+
+
+# Online metrics
+#
+# The accumulators are updated with one batch of beats at a time (model.predict batches, filtered
+# blocks, ...) and keep a constant amount of memory: the count, mean, M2 (Welford, merged by batches
+# as in Chan et al.), min and max, and a fixed bins histogram to estimate the quantiles.
+#
+# The PRD of a beat needs the mean of all the clean signals (np.mean(y_test) in PRD and
+# generate_table), which is not known until the last batch. The accumulators only compute the PRD if
+# y_mean is given, pass np.mean(y_test) to get the same PRD as generate_table (a running mean would
+# give each batch a different reference).
+
+# Histogram range of each metric, the values out of it are counted on the first/last bin
+HISTOGRAM_RANGES = {'SSD': (0, 200), 'MAD': (0, 5), 'PRD': (0, 200), 'COS_SIM': (-1, 1)}
+
+
+class RunningStats:
+    """
+        Running mean, std, min, max and histogram of a stream of values.
+
+        low, high: range of the histogram
+        bins: amount of bins of the histogram
+    """
+
+    def __init__(self, low=0.0, high=1.0, bins=1000):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.edges = np.linspace(low, high, bins + 1)
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values):
+        values = np.ravel(values).astype(np.float64)
+        if len(values) == 0:
+            return
+
+        count = len(values)
+        mean = np.mean(values)
+        m2 = np.sum(np.square(values - mean))
+
+        # Merge the statistics of the batch
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+        bins = np.searchsorted(self.edges, values, side='right') - 1
+        self.histogram += np.bincount(np.clip(bins, 0, len(self.histogram) - 1), minlength=len(self.histogram))
+
+    def std(self):
+        # Population std, as np.std
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def quantile(self, q):
+        # Quantile estimated from the histogram, the error is at most one bin width
+        if self.count == 0:
+            return np.nan
+
+        cumulative = np.cumsum(self.histogram)
+        target = q * self.count
+        index = min(np.searchsorted(cumulative, target), len(self.histogram) - 1)
+        previous = cumulative[index - 1] if index > 0 else 0
+        fraction = (target - previous) / max(self.histogram[index], 1)
+        value = self.edges[index] + fraction * (self.edges[index + 1] - self.edges[index])
+
+        return float(np.clip(value, self.min, self.max))
+
+
+class MetricsAccumulator:
+    """
+        Online SSD, MAD, PRD and COS_SIM statistics of a method.
+
+        y_mean: mean of all the clean signals for the PRD, the PRD is not computed if None
+        bins: bins of the histograms
+    """
+
+    def __init__(self, y_mean=None, bins=1000):
+        self.y_mean = y_mean
+        self.metrics = [metric for metric in METRICS if metric != 'PRD' or y_mean is not None]
+        self.stats = {metric: RunningStats(*HISTOGRAM_RANGES[metric], bins=bins) for metric in self.metrics}
+
+    def update(self, y, y_pred):
+        # Adds a batch of beats (n, 512, 1)
+        # Without y_mean the PRD values are computed with 0 (no extra pass over y) and dropped
+        values = fused_metrics(y, y_pred, y_mean=0.0 if self.y_mean is None else self.y_mean)
+        for metric, metric_values in zip(METRICS, values):
+            if metric in self.stats:
+                self.stats[metric].update(metric_values)
+
+    def mean_std(self, metric):
+        if metric not in self.stats:
+            raise ValueError(metric + ' was not accumulated (the PRD needs y_mean)')
+
+        return float(self.stats[metric].mean), float(self.stats[metric].std())
+
+
+def accumulate(batches, accumulator=None, y_mean=None):
+    """
+        Feeds (y, y_pred) batches to an accumulator, e.g.
+        accumulate((y_test[i:i + 32], model.predict(X_test[i:i + 32])) for i in range(0, len(X_test), 32),
+                   y_mean=np.mean(y_test))
+
+        Returns the accumulator (a new MetricsAccumulator with y_mean if None)
+    """
+    if accumulator is None:
+        accumulator = MetricsAccumulator(y_mean)
+
+    for y, y_pred in batches:
+        accumulator.update(y, y_pred)
+
+    return accumulator
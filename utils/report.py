@@ -0,0 +1,217 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Regression report between runs
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+import shutil
+from datetime import datetime
+
+import numpy as np
+
+from utils.metrics import METRICS
+
+# Every run saves a summary (metrics and the last benchmark) in results/runs/, the report compares it
+# with the baseline run and flags the changes beyond the tolerances.
+
+RUNS_DIR = 'runs'
+BASELINE_FILE = 'baseline.json'
+
+# Metrics where a higher value is better
+HIGHER_IS_BETTER = ['COS_SIM']
+
+LATENCIES = ['latency_p50', 'latency_p95', 'latency_p99']
+
+# Environment values (see utils.benchmark.environment) that must match to compare the timings
+MACHINE = ['platform', 'processor', 'cpu_count', 'python', 'numpy']
+
+
+def run_summary(metrics_table, benchmark=None):
+    # Summary of a run, benchmark as loaded by utils.benchmark.load_benchmark (None if it was not run)
+    metrics = {}
+    for method in metrics_table.methods:
+        metrics[method] = {}
+        for metric in METRICS:
+            values = metrics_table.get(method, metric)
+            metrics[method][metric] = {'mean': float(np.mean(values)), 'std': float(np.std(values))}
+
+    benchmark = benchmark or {}
+
+    return {'date': datetime.now().isoformat(timespec='seconds'),
+            'metrics': metrics,
+            'benchmark': benchmark.get('results', []),
+            'benchmark_environment': benchmark.get('environment'),
+            'benchmark_settings': benchmark.get('settings')}
+
+
+def save_run(results_dir, summary):
+    # Saves the summary in results_dir/runs/ with the date as name, returns its path
+    runs_dir = os.path.join(results_dir, RUNS_DIR)
+    os.makedirs(runs_dir, exist_ok=True)
+
+    filepath = os.path.join(runs_dir, 'run_' + summary['date'].replace(':', '-') + '.json')
+    with open(filepath, 'w') as output:
+        json.dump(summary, output, indent=2)
+
+    return filepath
+
+
+def load_run(filepath):
+    with open(filepath, 'r') as input:
+        return json.load(input)
+
+
+def set_baseline(results_dir, run_filepath):
+    # Makes a saved run the baseline of the next reports
+    shutil.copyfile(run_filepath, os.path.join(results_dir, BASELINE_FILE))
+
+
+def load_baseline(results_dir):
+    # Baseline summary, None if there is no baseline yet
+    filepath = os.path.join(results_dir, BASELINE_FILE)
+    if not os.path.exists(filepath):
+        return None
+
+    return load_run(filepath)
+
+
+def _change(current, baseline):
+    return (current - baseline) / max(abs(baseline), 1e-12)
+
+
+def benchmark_mismatch(current, baseline):
+    # Why the timings of two runs can not be compared, None if they can: the benchmark has to be run
+    # after the baseline run, on the same machine and backend
+    if not current['benchmark'] or not baseline['benchmark']:
+        return 'the benchmark is missing from the run or the baseline'
+
+    environment = current.get('benchmark_environment')
+    baseline_environment = baseline.get('benchmark_environment')
+    if environment is None or baseline_environment is None:
+        return 'the benchmark environment is missing from the run or the baseline'
+
+    if environment['date'] <= baseline['date']:
+        return 'the benchmark (' + environment['date'] + ') was not run after the baseline run (' + \
+               baseline['date'] + ')'
+
+    for name in MACHINE:
+        if environment.get(name) != baseline_environment.get(name):
+            return 'the benchmark environment changed, ' + name + ': ' + str(baseline_environment.get(name)) + \
+                   ' -> ' + str(environment.get(name))
+
+    backend = (current.get('benchmark_settings') or {}).get('backend')
+    baseline_backend = (baseline.get('benchmark_settings') or {}).get('backend')
+    if backend != baseline_backend:
+        return 'the benchmark backend changed, ' + str(baseline_backend) + ' -> ' + str(backend)
+
+    return None
+
+
+def compare_runs(current, baseline, metric_tolerance=0.02, latency_tolerance=0.10, throughput_tolerance=0.10):
+    # Compares a run summary with the baseline, the tolerances are relative changes (a metric drift in
+    # either direction, a latency increase, a throughput decrease)
+    # Returns a dict per compared value: kind, method, name, baseline, current, change, flagged and
+    # regression
+    findings = []
+
+    for method, metrics in current['metrics'].items():
+        if method not in baseline['metrics']:
+            continue
+
+        for metric, values in metrics.items():
+            baseline_mean = baseline['metrics'][method][metric]['mean']
+            change = _change(values['mean'], baseline_mean)
+            worse = change < 0 if metric in HIGHER_IS_BETTER else change > 0
+
+            findings.append({'kind': 'metric', 'method': method, 'name': metric,
+                             'baseline': baseline_mean, 'current': values['mean'], 'change': change,
+                             'flagged': abs(change) > metric_tolerance,
+                             'regression': abs(change) > metric_tolerance and worse})
+
+    if benchmark_mismatch(current, baseline) is not None:
+        return findings
+
+    # The benchmark results are matched by method, threads and batch size
+    baseline_benchmark = {(result['method'], result['threads'], result['batch_size']): result
+                          for result in baseline['benchmark']}
+
+    for result in current['benchmark']:
+        key = (result['method'], result['threads'], result['batch_size'])
+        if key not in baseline_benchmark:
+            continue
+
+        name = str(result['threads']) + ' threads, batch ' + str(result['batch_size'])
+
+        for latency in LATENCIES:
+            change = _change(result[latency], baseline_benchmark[key][latency])
+            findings.append({'kind': 'latency', 'method': result['method'], 'name': name + ' ' + latency[-3:],
+                             'baseline': baseline_benchmark[key][latency], 'current': result[latency],
+                             'change': change, 'flagged': change > latency_tolerance,
+                             'regression': change > latency_tolerance})
+
+        change = _change(result['throughput'], baseline_benchmark[key]['throughput'])
+        findings.append({'kind': 'throughput', 'method': result['method'], 'name': name,
+                         'baseline': baseline_benchmark[key]['throughput'], 'current': result['throughput'],
+                         'change': change, 'flagged': change < -throughput_tolerance,
+                         'regression': change < -throughput_tolerance})
+
+    return findings
+
+
+def _rows(findings):
+    # Table rows of the findings, the flagged ones first
+    rows = []
+    for finding in sorted(findings, key=lambda finding: (not finding['regression'], not finding['flagged'])):
+        status = 'REGRESSION' if finding['regression'] else ('drift' if finding['flagged'] else 'ok')
+        rows.append([status, finding['kind'], finding['method'], finding['name'],
+                     '{:.4g}'.format(finding['baseline']), '{:.4g}'.format(finding['current']),
+                     '{:+.1f} %'.format(100 * finding['change'])])
+
+    return rows
+
+
+def write_report(filepath, findings, current, baseline):
+    # Writes the comparison as Markdown or HTML (by the extension of filepath), True if there is no
+    # regression
+    regressions = [finding for finding in findings if finding['regression']]
+    flagged = [finding for finding in findings if finding['flagged']]
+
+    title = 'DeepFilter run report'
+    summary = ['Run: ' + current['date'] + ', baseline: ' + baseline['date'],
+               str(len(findings)) + ' values compared, ' + str(len(flagged)) + ' beyond the tolerances, ' +
+               str(len(regressions)) + ' regressions',
+               'Result: ' + ('FAILED' if regressions else 'PASSED')]
+
+    mismatch = benchmark_mismatch(current, baseline)
+    if mismatch is not None:
+        summary.insert(2, 'Timings not compared: ' + mismatch)
+    header = ['Status', 'Kind', 'Method/Model', 'Value', 'Baseline', 'Current', 'Change']
+    rows = _rows(findings)
+
+    if filepath.endswith('.html'):
+        lines = ['<html><head><meta charset="utf-8"><title>' + title + '</title></head><body>',
+                 '<h1>' + title + '</h1>']
+        lines += ['<p>' + line + '</p>' for line in summary]
+        lines.append('<table border="1" cellspacing="0" cellpadding="4">')
+        lines.append('<tr>' + ''.join('<th>' + cell + '</th>' for cell in header) + '</tr>')
+        for row in rows:
+            style = ' style="background-color:#f4cccc"' if row[0] == 'REGRESSION' else ''
+            lines.append('<tr' + style + '>' + ''.join('<td>' + cell + '</td>' for cell in row) + '</tr>')
+        lines.append('</table></body></html>')
+    else:
+        lines = ['# ' + title, '']
+        lines += ['- ' + line for line in summary]
+        lines += ['', '| ' + ' | '.join(header) + ' |', '|' + '---|' * len(header)]
+        lines += ['| ' + ' | '.join(row) + ' |' for row in rows]
+
+    with open(filepath, 'w') as output:
+        output.write('\n'.join(lines) + '\n')
+
+    return not regressions
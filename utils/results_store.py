@@ -0,0 +1,147 @@
+#============================================================
+#
+#  Deep Learning BLW Filtering
+#  Results store
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+#===========================================================
+
+import os
+import json
+
+import numpy as np
+
+from utils.metrics import METRICS, MetricsTable, fused_metrics, _mean
+
+# Test results in a columnar layout, one memory mapped .npy file per column: the test beats once
+# in root/, and y_pred.npy, one .npy per metric and meta.json (written last) in root/methods/<method>/.
+
+INPUTS_FILE = 'inputs.json'
+META_FILE = 'meta.json'
+
+
+def _save_npy(filepath, array):
+    # Write and rename (a temporary file per process), a reader never sees a partial file
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filepath, 'wb') as output:
+        np.save(output, np.asarray(array))
+    os.replace(tmp_filepath, filepath)
+
+
+def _save_json(filepath, data):
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filepath, 'w') as output:
+        json.dump(data, output, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+class ResultsStore:
+    # Columnar store of the test results in the folder root
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'methods'), exist_ok=True)
+
+    def _method_dir(self, method):
+        return os.path.join(self.root, 'methods', method.replace(' ', '_'))
+
+    def _load(self, filepath):
+        return np.load(filepath, mmap_mode='r')
+
+    # Inputs
+
+    def has_inputs(self):
+        return os.path.exists(os.path.join(self.root, INPUTS_FILE))
+
+    def add_inputs(self, X_test, y_test):
+        # Saves the test beats, only the first time (all the methods share them)
+        if self.has_inputs():
+            inputs = self.inputs()
+            if inputs['shape'] != list(np.shape(y_test)):
+                raise ValueError('The store has test beats of shape ' + str(inputs['shape']) +
+                                 ', got ' + str(list(np.shape(y_test))))
+            return
+
+        _save_npy(os.path.join(self.root, 'X_test.npy'), X_test)
+        _save_npy(os.path.join(self.root, 'y_test.npy'), y_test)
+        _save_json(os.path.join(self.root, INPUTS_FILE), {'n_beats': len(y_test),
+                                                          'shape': list(np.shape(y_test)),
+                                                          'y_mean': float(_mean(y_test, 4096))})
+
+    def inputs(self):
+        with open(os.path.join(self.root, INPUTS_FILE), 'r') as input:
+            return json.load(input)
+
+    def X_test(self):
+        return self._load(os.path.join(self.root, 'X_test.npy'))
+
+    def y_test(self):
+        return self._load(os.path.join(self.root, 'y_test.npy'))
+
+    # Methods
+
+    def methods(self):
+        methods_dir = os.path.join(self.root, 'methods')
+        methods = []
+        for name in sorted(os.listdir(methods_dir)):
+            meta_path = os.path.join(methods_dir, name, META_FILE)
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as input:
+                    methods.append(json.load(input)['method'])
+        return methods
+
+    def has_method(self, method):
+        return os.path.exists(os.path.join(self._method_dir(method), META_FILE))
+
+    def add_method(self, method, y_pred, X_test=None, y_test=None):
+        # Adds (or replaces) the predictions of a method and its per beat metrics
+        # X_test, y_test: test beats, only needed for the first method of the store
+        if X_test is not None and y_test is not None:
+            self.add_inputs(X_test, y_test)
+        elif not self.has_inputs():
+            raise ValueError('The first method of the store needs X_test and y_test')
+
+        # Checked before anything of the method is removed or written
+        shape = self.inputs()['shape']
+        if list(np.shape(y_pred)) != shape:
+            raise ValueError('The store has test beats of shape ' + str(shape) + ', got predictions of shape ' +
+                             str(list(np.shape(y_pred))))
+
+        method_dir = self._method_dir(method)
+        os.makedirs(method_dir, exist_ok=True)
+
+        # The method is out of the store until its meta.json is written again
+        if os.path.exists(os.path.join(method_dir, META_FILE)):
+            os.remove(os.path.join(method_dir, META_FILE))
+
+        _save_npy(os.path.join(method_dir, 'y_pred.npy'), y_pred)
+
+        values = fused_metrics(self.y_test(), self._load(os.path.join(method_dir, 'y_pred.npy')),
+                               y_mean=self.inputs()['y_mean'])
+        for metric, metric_values in zip(METRICS, values):
+            _save_npy(os.path.join(method_dir, metric + '.npy'), metric_values)
+
+        _save_json(os.path.join(method_dir, META_FILE), {'method': method,
+                                                         'shape': list(np.shape(y_pred)),
+                                                         'metrics': METRICS})
+
+    def y_pred(self, method):
+        return self._load(os.path.join(self._method_dir(method), 'y_pred.npy'))
+
+    def results(self, method):
+        # [X_test, y_test, y_pred] as the test_dl results
+        return [self.X_test(), self.y_test(), self.y_pred(method)]
+
+    def metric(self, method, metric):
+        # Per beat values of a metric, (n, 1) as the metric functions
+        return self._load(os.path.join(self._method_dir(method), metric + '.npy'))[:, np.newaxis]
+
+    def metrics_table(self, methods, labels=None):
+        # MetricsTable of the stored metrics, labels are the names in the table (the methods if None)
+        values = np.stack([np.stack([self._load(os.path.join(self._method_dir(method), metric + '.npy'))
+                                     for metric in METRICS]) for method in methods])
+
+        return MetricsTable(labels if labels is not None else methods, values)
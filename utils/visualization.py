@@ -8,101 +8,180 @@
 #  github id: fperdigon
 #
 #===========================================================
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
 import matplotlib.pyplot as plt
 import seaborn as sns
-import pandas as pd
 import numpy as np
 from prettytable import PrettyTable
 
-def generate_violinplots(np_data, description, ylabel, log):
-    # Process the results and store in Panda objects
+from utils.decimation import decimate
 
-    col = description
-    loss_val_np = np.rot90(np_data)
-    pd_df = pd.DataFrame.from_records(loss_val_np, columns=col)
+# Headless rendering
+#
+# After set_output_dir the figures are rendered with the Agg backend and saved in the output folder
+# instead of shown, together with a small thumbnail and the hash of the data and arguments of the
+# figure (thumbnails/). A figure whose hash has not changed is not drawn again. render_figures
+# renders a list of figures in a process pool.
 
-    # Set up the matplotlib figure
+FIGURE_FORMAT = '.png'
+FIGURE_DPI = 150
+THUMBNAIL_DIR = 'thumbnails'
+THUMBNAIL_DPI = 20
 
-    f, ax = plt.subplots()
+_output_dir = None
 
-    sns.set(style="whitegrid")
 
-    ax = sns.violinplot(data=pd_df, palette="Set3", bw=.2, cut=1, linewidth=1)
+def set_output_dir(output_dir):
+    # Saves the figures in output_dir with the Agg backend, None shows them again
+    global _output_dir
 
-    if log:
-        ax.set_yscale("log")
+    if output_dir is not None:
+        plt.switch_backend('Agg')
+        os.makedirs(os.path.join(output_dir, THUMBNAIL_DIR), exist_ok=True)
 
-    ax.set(xlabel='Models/Methods', ylabel=ylabel)
-    ax = sns.despine(left=True, bottom=True)
+    _output_dir = output_dir
 
-    plt.show()
 
-    #plt.savefig(store_folder + 'violinplot_fco' + info + description + '.png')
+def _digest(*data):
+    # Hash of the arrays and arguments of a figure
+    sha = hashlib.sha1()
 
+    def update(item):
+        if isinstance(item, (list, tuple)):
+            sha.update(b'[' + str(len(item)).encode())
+            for element in item:
+                update(element)
+        elif isinstance(item, np.ndarray):
+            sha.update(str((item.shape, item.dtype.str)).encode())
+            sha.update(np.ascontiguousarray(item).tobytes())
+        else:
+            sha.update(repr(item).encode())
 
-def generate_barplot(np_data, description, ylabel, log):
-    # Process the results and store in Panda objects
-    col = description
-    loss_val_np = np.rot90(np_data)
-    pd_df = pd.DataFrame.from_records(loss_val_np, columns=col)
+    update(data)
 
-    # Set up the matplotlib figure
+    return sha.hexdigest()
 
-    f, ax = plt.subplots()
 
-    sns.set(style="whitegrid")
+def _is_cached(filename, digest):
+    # True if the figure was already saved from the same data
+    if _output_dir is None:
+        return False
 
-    ax = sns.barplot(data=pd_df)
+    digest_path = os.path.join(_output_dir, THUMBNAIL_DIR, filename + '.sha1')
+    if not os.path.exists(os.path.join(_output_dir, filename + FIGURE_FORMAT)) or not os.path.exists(digest_path):
+        return False
 
-    if log:
-        ax.set_yscale("log")
+    with open(digest_path, 'r') as input:
+        return input.read() == digest
 
-    ax.set(xlabel='Models/Methods', ylabel=ylabel)
-    ax = sns.despine(left=True, bottom=True)
 
-    plt.show()
+def _finish(fig, filename, digest):
+    # Shows the figure, or saves it with its thumbnail and hash in headless mode
+    if _output_dir is None:
+        plt.show()
+        return
 
-    #plt.savefig(store_folder + 'violinplot_fco' + info + description + '.png')
+    fig.savefig(os.path.join(_output_dir, filename + FIGURE_FORMAT), dpi=FIGURE_DPI, bbox_inches='tight')
+    fig.savefig(os.path.join(_output_dir, THUMBNAIL_DIR, filename + FIGURE_FORMAT), dpi=THUMBNAIL_DPI)
+    plt.close(fig)
 
+    # The hash is written last, an interrupted render is drawn again
+    with open(os.path.join(_output_dir, THUMBNAIL_DIR, filename + '.sha1'), 'w') as output:
+        output.write(digest)
 
-def generate_boxplot(np_data, description, ylabel, log):
-    # Process the results and store in Panda objects
-    col = description
-    loss_val_np = np.rot90(np_data)
-    pd_df = pd.DataFrame.from_records(loss_val_np, columns=col)
 
-    # Set up the matplotlib figure
+def _filename(filename, kind, label):
+    # Default file name of a figure
+    if filename is not None:
+        return filename
+    return kind + '_' + ''.join(c if c.isalnum() else '_' for c in str(label)).strip('_')
+
+
+def render_figures(figures, output_dir, n_jobs=None):
+    """
+        Renders figures to files in parallel processes.
+
+        figures: list of (function, kwargs), e.g. (generate_hboxplot, {'np_data': SSD_all, ...}),
+                 the functions of this module with a filename argument
+        output_dir: folder of the figures
+        n_jobs: processes, os.cpu_count() by default
+    """
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=set_output_dir, initargs=(output_dir,)) as executor:
+        futures = [executor.submit(function, **kwargs) for function, kwargs in figures]
+        for future in futures:
+            future.result()
 
-    f, ax = plt.subplots()
 
+def _columns(np_data):
+    # One 1D array per method, np_data is a list of (n, 1) arrays (views, nothing is copied)
+    return [np.ravel(values) for values in np_data]
+
+
+def _plot_methods(plot, np_data, description, ylabel, log, filename, kind):
+    # Vertical plot of the values of each method
+    filename = _filename(filename, kind, ylabel)
+    digest = _digest(kind, _columns(np_data), description, ylabel, log)
+    if _is_cached(filename, digest):
+        return
+
+    # Set up the matplotlib figure
     sns.set(style="whitegrid")
 
-    ax = sns.boxplot(data=pd_df)
+    fig, ax = plt.subplots()
+
+    plot(ax, _columns(np_data))
+
+    ax.set_xticks(np.arange(1, len(description) + 1))
+    ax.set_xticklabels(description)
 
     if log:
         ax.set_yscale("log")
 
     ax.set(xlabel='Models/Methods', ylabel=ylabel)
-    ax = sns.despine(left=True, bottom=True)
+    sns.despine(left=True, bottom=True)
+
+    _finish(fig, filename, digest)
+
+
+def generate_violinplots(np_data, description, ylabel, log, filename=None):
+    _plot_methods(lambda ax, columns: ax.violinplot(columns, bw_method=.2, showmedians=True),
+                  np_data, description, ylabel, log, filename, 'violinplot')
+
+
+def generate_barplot(np_data, description, ylabel, log, filename=None):
+    def plot(ax, columns):
+        ax.bar(np.arange(1, len(columns) + 1), [np.mean(column) for column in columns],
+               yerr=[np.std(column) for column in columns], color=sns.color_palette(n_colors=len(columns)))
 
-    plt.show()
+    _plot_methods(plot, np_data, description, ylabel, log, filename, 'barplot')
 
-    #plt.savefig(store_folder + 'violinplot_fco' + info + description + '.png')
 
+def generate_boxplot(np_data, description, ylabel, log, filename=None):
+    _plot_methods(lambda ax, columns: ax.boxplot(columns),
+                  np_data, description, ylabel, log, filename, 'boxplot')
 
-def generate_hboxplot(np_data, description, ylabel, log, set_x_axis_size=None):
-    # Process the results and store in Panda objects
-    col = description
-    loss_val_np = np.rot90(np_data)
 
-    pd_df = pd.DataFrame.from_records(loss_val_np, columns=col)
+def generate_hboxplot(np_data, description, ylabel, log, set_x_axis_size=None, filename=None):
+    filename = _filename(filename, 'hboxplot', ylabel)
+    digest = _digest('hboxplot', _columns(np_data), description, ylabel, log, set_x_axis_size)
+    if _is_cached(filename, digest):
+        return
 
     # Set up the matplotlib figure
     sns.set(style="whitegrid")
 
-    f, ax = plt.subplots(figsize=(15, 6))
+    fig, ax = plt.subplots(figsize=(15, 6))
 
-    ax = sns.boxplot(data=pd_df, orient="h", width=0.4)
+    # First method on top, as the seaborn plot
+    boxes = ax.boxplot(_columns(np_data), vert=False, widths=0.4, patch_artist=True,
+                       positions=np.arange(len(np_data))[::-1], medianprops={'color': 'k'})
+    for box, color in zip(boxes['boxes'], sns.color_palette(n_colors=len(np_data))):
+        box.set_facecolor(color)
+    ax.set_yticks(np.arange(len(description))[::-1])
+    ax.set_yticklabels(description)
 
     if log:
         ax.set_xscale("log")
@@ -111,20 +190,33 @@ def generate_hboxplot(np_data, description, ylabel, log, set_x_axis_size=None):
         ax.set_xlim(set_x_axis_size)
 
     ax.set(ylabel='Models/Methods', xlabel=ylabel)
-    ax = sns.despine(left=True, bottom=True)
+    sns.despine(left=True, bottom=True)
 
-    plt.show()
+    _finish(fig, filename, digest)
 
-    #plt.savefig(store_folder + 'violinplot_fco' + info + description + '.png')
 
+def _trace(y, max_points, method):
+    # Positions and values of a trace to plot, decimated to max_points (None plots every sample)
+    y = np.ravel(y)
+    if max_points is None:
+        return np.arange(len(y)), y
+    return decimate(y, max_points, method)
 
-def ecg_view(ecg, ecg_blw, ecg_dl, ecg_f, signal_name=None, beat_no=None):
+
+def ecg_view(ecg, ecg_blw, ecg_dl, ecg_f, signal_name=None, beat_no=None, filename=None, max_points=4000,
+             method='minmax'):
+    # max_points, method: longer signals are decimated (see utils.decimation), a beat is plotted whole
+
+    filename = _filename(filename, 'ecg_view', str(signal_name) + '_' + str(beat_no))
+    digest = _digest('ecg_view', ecg, ecg_blw, ecg_dl, ecg_f, signal_name, beat_no, max_points, method)
+    if _is_cached(filename, digest):
+        return
 
     fig, ax = plt.subplots(figsize=(16, 9))
-    plt.plot(ecg_blw, 'k', label='ECG + BLW')
-    plt.plot(ecg, 'g', label='ECG orig')
-    plt.plot(ecg_dl, 'b', label='ECG DL Filtered')
-    plt.plot(ecg_f, 'r', label='ECG IIR Filtered')
+    plt.plot(*_trace(ecg_blw, max_points, method), 'k', label='ECG + BLW')
+    plt.plot(*_trace(ecg, max_points, method), 'g', label='ECG orig')
+    plt.plot(*_trace(ecg_dl, max_points, method), 'b', label='ECG DL Filtered')
+    plt.plot(*_trace(ecg_f, max_points, method), 'r', label='ECG IIR Filtered')
     plt.grid(True)
 
     plt.ylabel('au')
@@ -137,17 +229,24 @@ def ecg_view(ecg, ecg_blw, ecg_dl, ecg_f, signal_name=None, beat_no=None):
     else:
         plt.title('ECG signal for comparison')
 
-    plt.show()
+    _finish(fig, filename, digest)
+
 
+def ecg_view_diff(ecg, ecg_blw, ecg_dl, ecg_f, signal_name=None, beat_no=None, filename=None, max_points=4000,
+                  method='minmax'):
+    # max_points, method: as in ecg_view, the differences are computed before the decimation
 
-def ecg_view_diff(ecg, ecg_blw, ecg_dl, ecg_f, signal_name=None, beat_no=None):
+    filename = _filename(filename, 'ecg_view_diff', str(signal_name) + '_' + str(beat_no))
+    digest = _digest('ecg_view_diff', ecg, ecg_blw, ecg_dl, ecg_f, signal_name, beat_no, max_points, method)
+    if _is_cached(filename, digest):
+        return
 
     fig, ax = plt.subplots(figsize=(16, 9))
-    plt.plot(ecg, 'g', label='ECG orig')
-    plt.plot(ecg_dl, 'b', label='ECG DL Filtered')
-    plt.plot(ecg_f, 'r', label='ECG IIR Filtered')
-    plt.plot(ecg - ecg_dl, color='#0099ff', lw=3, label='Difference ECG - DL Filter')
-    plt.plot(ecg - ecg_f, color='#cb828d', lw=3, label='Difference ECG - IIR Filter')
+    plt.plot(*_trace(ecg, max_points, method), 'g', label='ECG orig')
+    plt.plot(*_trace(ecg_dl, max_points, method), 'b', label='ECG DL Filtered')
+    plt.plot(*_trace(ecg_f, max_points, method), 'r', label='ECG IIR Filtered')
+    plt.plot(*_trace(ecg - ecg_dl, max_points, method), color='#0099ff', lw=3, label='Difference ECG - DL Filter')
+    plt.plot(*_trace(ecg - ecg_f, max_points, method), color='#cb828d', lw=3, label='Difference ECG - IIR Filter')
     plt.grid(True)
 
     plt.ylabel('Amplitude (au)')
@@ -160,7 +259,45 @@ def ecg_view_diff(ecg, ecg_blw, ecg_dl, ecg_f, signal_name=None, beat_no=None):
     else:
         plt.title('ECG signal for comparison')
 
-    plt.show()
+    _finish(fig, filename, digest)
+
+
+def ecg_view_record(pyramids, start=0, stop=None, max_points=2000, fs=360, signal_name=None, filename=None):
+    """
+        Plots a range of a long record from the SignalPyramid of each trace, only the buckets of
+        the range are read. A decimated trace is drawn as its min/max envelope.
+
+        pyramids: dict {label: SignalPyramid}, e.g. {'ECG + BLW': ..., 'ECG DL Filtered': ...}
+        start, stop: range of samples, the whole record if stop is None
+        max_points: buckets per trace
+        fs: sampling frequency, for the time axis
+    """
+    envelopes = [(label, pyramid.envelope(start, stop, max_points)) for label, pyramid in pyramids.items()]
+
+    filename = _filename(filename, 'ecg_view_record', str(signal_name) + '_' + str(start) + '_' + str(stop))
+    digest = _digest('ecg_view_record', envelopes, fs, signal_name)
+    if _is_cached(filename, digest):
+        return
+
+    fig, ax = plt.subplots(figsize=(16, 9))
+    for label, (x, lower, upper) in envelopes:
+        if lower is upper:
+            plt.plot(x / fs, lower, label=label, lw=0.8)
+        else:
+            plt.fill_between(x / fs, lower, upper, label=label, lw=0, alpha=0.8)
+    plt.grid(True)
+
+    plt.ylabel('au')
+    plt.xlabel('time (s)')
+
+    leg = ax.legend()
+
+    if signal_name != None:
+        plt.title('Signal ' + str(signal_name))
+    else:
+        plt.title('ECG record')
+
+    _finish(fig, filename, digest)
 
 
 def generate_table(metrics, metric_values, Exp_names):
@@ -188,6 +325,91 @@ def generate_table(metrics, metric_values, Exp_names):
     print(tb)
 
 
+def generate_table_stats(metrics, accumulators, Exp_names):
+    # Same table as generate_table from online accumulators (see utils.metrics.MetricsAccumulator),
+    # the PRD is only the same if the accumulators were given np.mean(y_test), '-' if they have no PRD
+    print('\n')
+
+    tb = PrettyTable()
+    tb.field_names = ['Method/Model'] + metrics
+
+    for exp_name, accumulator in zip(Exp_names, accumulators):
+        tb_row = [exp_name]
+
+        for metric in metrics:
+            if metric not in accumulator.metrics:
+                tb_row.append('-')
+                continue
+
+            m_mean, m_std = accumulator.mean_std(metric)
+            tb_row.append('{:.3f}'.format(m_mean) + ' (' + '{:.3f}'.format(m_std) + ')')
+
+        tb.add_row(tb_row)
+
+    print(tb)
+
+
+def generate_table_strata(stratified, metric, Exp_names=None):
+    # Mean (std) of a metric by groups of beats (see utils.evaluation.StratifiedMetrics), a row per
+    # group and a column per method
+    print('\n')
+
+    if Exp_names is None:
+        Exp_names = stratified.methods
+
+    tb = PrettyTable()
+    tb.field_names = [{'snr': 'SNR'}.get(stratified.by, stratified.by.capitalize()), 'Beats'] + [exp_name + ' ' + metric for exp_name in Exp_names]
+
+    for ind, key in enumerate(stratified.keys):
+        tb_row = [key, stratified.counts[ind]]
+
+        for exp_name in Exp_names:
+            m_mean, m_std = stratified.get(exp_name, metric)
+            tb_row.append('{:.3f}'.format(m_mean[ind]) + ' (' + '{:.3f}'.format(m_std[ind]) + ')')
+
+        tb.add_row(tb_row)
+
+    print(tb)
+
+
+def generate_table_comparison(comparisons, reference, metric):
+    # Paired comparison against a reference method (see utils.evaluation.compare_methods)
+    print('\n')
+
+    tb = PrettyTable()
+    tb.field_names = ['Method/Model', metric + ' (95% CI)', 'Diff. vs ' + reference + ' (95% CI)', 'Wilcoxon p',
+                      'Equivalent']
+
+    for comparison in comparisons:
+        tb.add_row([comparison['method'],
+                    '{:.3f} ({:.3f}, {:.3f})'.format(comparison['mean'], *comparison['ci']),
+                    '{:+.1f} % ({:+.1f}, {:+.1f})'.format(100 * comparison['diff'],
+                                                        *[100 * value for value in comparison['diff_ci']]),
+                    '{:.2e}'.format(comparison['p_value']),
+                    'yes' if comparison['equivalent'] else 'no'])
+
+    print(tb)
+
+
+def generate_table_benchmark(results):
+    # Latency and throughput of each method, thread count and batch size (see utils.benchmark)
+    print('\n')
+
+    tb = PrettyTable()
+    tb.field_names = ['Method/Model', 'Threads', 'Batch', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'p50 per beat (ms)',
+                      'Throughput (beats/s)']
+
+    for result in results:
+        tb.add_row([result['method'], result['threads'], result['batch_size'],
+                    '{:.2f}'.format(result['latency_p50']),
+                    '{:.2f}'.format(result['latency_p95']),
+                    '{:.2f}'.format(result['latency_p99']),
+                    '{:.3f}'.format(result['beat_latency_p50']),
+                    '{:.0f}'.format(result['throughput'])])
+
+    print(tb)
+
+
 def generate_table_time(column_names, all_values, Exp_names, gpu=True):
     # Print tabular results in the console, in a pretty way
 